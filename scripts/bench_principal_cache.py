@@ -0,0 +1,80 @@
+# Requests per second on GET /users/me of a running api, which resolves the profile of the user behind
+# the token on every request. Run it once against an api started with PRINCIPAL_CACHE_ENABLED=true and once
+# with false to compare the cached principal with a users SELECT per request. --users tokens of different
+# users are spread over the requests. The users are created in the database the api uses and removed afterwards.
+#
+#   uv run python -m scripts.bench_principal_cache --url http://localhost:8000 --duration 10 --concurrency 50
+import argparse
+import asyncio
+import itertools
+import statistics
+import time
+from datetime import timedelta
+
+from aiohttp import ClientSession
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from src.config import settings
+from src.db.models import User
+from src.utils import create_jwt_token
+
+BENCH_EMAIL_DOMAIN = 'principal-bench.test'
+
+
+async def run(http: ClientSession, tokens: list[str], args) -> tuple[list[float], int, float]:
+    latencies: list[float] = []
+    failures = 0
+    tokens = itertools.cycle(tokens)
+    deadline = time.monotonic() + args.duration
+
+    async def client():
+        nonlocal failures
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            headers = {'Authorization': f"Bearer {next(tokens)}"}
+            async with http.get(f"{args.url}/users/me", headers=headers) as response:
+                await response.read()
+            latencies.append(time.monotonic() - started)
+            failures += response.status != 200
+
+    started = time.monotonic()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    return latencies, failures, time.monotonic() - started
+
+
+async def main(args):
+    engine = create_async_engine(settings.POSTGRESQL_DB_URL)
+    sessions = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+    async with sessions() as db:
+        users = [User(email=f"user{i}@{BENCH_EMAIL_DOMAIN}", name=f"user{i}") for i in range(args.users)]
+        db.add_all(users)
+        await db.commit()
+    tokens = [create_jwt_token(user_id=user.id, expires_in=timedelta(hours=1)) for user in users]
+
+    try:
+        async with ClientSession() as http:
+            # the first request of every user fills the caches
+            await run(http, tokens, argparse.Namespace(**{**vars(args), 'duration': 1}))
+            latencies, failures, elapsed = await run(http, tokens, args)
+
+        latencies.sort()
+        print(f"{len(latencies)} requests in {elapsed:.2f} s, {len(latencies) / elapsed:.1f} requests/s, "
+              f"{failures} failed")
+        print(f"  p50 {statistics.median(latencies) * 1000:8.1f} ms, "
+              f"p99 {latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000:8.1f} ms")
+    finally:
+        async with sessions() as db:
+            await db.execute(delete(User).where(User.email.like(f"%@{BENCH_EMAIL_DOMAIN}")))
+            await db.commit()
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m scripts.bench_principal_cache')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--users', type=int, default=100, help="distinct users the requests are made as")
+    parser.add_argument('--concurrency', type=int, default=50, help="requests in flight")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of measurement")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,92 @@
+# Checkout throughput on a single hot product: the former locking flow (SELECT ... FOR UPDATE first,
+# then the rest of the transaction) against the conditional decrement (the rest of the transaction first,
+# then a single UPDATE right before the commit). The rest of the checkout (order insert and reload)
+# is simulated by --work-ms of sleep inside the transaction.
+#
+#   uv run python -m scripts.bench_stock_decrement --workers 50 --duration 10 --work-ms 5
+import argparse
+import asyncio
+import statistics
+import time
+
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+
+from src.config import settings
+from src.crud import ProductCRUD
+from src.db.models import Product
+
+BENCH_SKU = 'bench-hot-product'
+
+
+async def locking_checkout(db: AsyncSession, product_id: int, work: float) -> bool:
+    product = (await ProductCRUD(db).get_all([product_id], for_update=True))[0]
+    if product.quantity < 1:
+        return False
+    product.quantity -= 1
+    await db.flush()
+    await asyncio.sleep(work)
+    return True
+
+
+async def conditional_checkout(db: AsyncSession, product_id: int, work: float) -> bool:
+    await ProductCRUD(db).get_final_prices([product_id])
+    await asyncio.sleep(work)
+    return bool(await ProductCRUD(db).decrement_stock({product_id: 1}))
+
+
+CHECKOUTS = {
+    'locking': locking_checkout,
+    'conditional': conditional_checkout,
+}
+
+
+async def run(mode: str, sessions: async_sessionmaker, product_id: int, args) -> tuple[int, list[float]]:
+    checkout = CHECKOUTS[mode]
+    latencies: list[float] = []
+    deadline = time.monotonic() + args.duration
+
+    async def worker():
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            async with sessions() as db:
+                if await checkout(db, product_id, args.work_ms / 1000):
+                    await db.commit()
+                    latencies.append(time.monotonic() - started)
+
+    await asyncio.gather(*(worker() for _ in range(args.workers)))
+    return len(latencies), latencies
+
+
+async def main(args):
+    engine = create_async_engine(settings.POSTGRESQL_DB_URL, pool_size=args.workers, max_overflow=0)
+    sessions = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+    async with sessions() as db:
+        await db.execute(delete(Product).where(Product.sku == BENCH_SKU))
+        product = Product(sku=BENCH_SKU, title='benchmark product', description='', full_price=100,
+                          quantity=10 ** 9)
+        db.add(product)
+        await db.commit()
+
+    try:
+        for mode in args.modes:
+            checkouts, latencies = await run(mode, sessions, product.id, args)
+            latencies.sort()
+            print(f"{mode:>12}: {checkouts / args.duration:8.1f} checkouts/s, "
+                  f"p50 {statistics.median(latencies) * 1000:7.1f} ms, "
+                  f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.1f} ms")
+    finally:
+        async with sessions() as db:
+            await db.execute(delete(Product).where(Product.id == product.id))
+            await db.commit()
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m scripts.bench_stock_decrement')
+    parser.add_argument('--workers', type=int, default=50, help="concurrent checkouts")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per mode")
+    parser.add_argument('--work-ms', type=float, default=5, help="simulated rest of the checkout transaction")
+    parser.add_argument('--modes', nargs='+', choices=list(CHECKOUTS), default=list(CHECKOUTS))
+    asyncio.run(main(parser.parse_args()))
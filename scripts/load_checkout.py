@@ -0,0 +1,119 @@
+# Flash sale load against a running api: --users buyers with one unit of the same product in their carts
+# check out at once. In the inline mode an order is placed when POST /orders returns; in the queued mode
+# (CHECKOUT_MODE=queued) the checkouts are polled until the workers have placed them, so both the acceptance
+# and the completion latency are reported. The buyers and the product are created in the database
+# the api uses and removed afterwards.
+#
+#   uv run python -m scripts.load_checkout --url http://localhost:8000 --users 500 --concurrency 100
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import timedelta
+
+from aiohttp import ClientSession
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from src.config import settings
+from src.db.models import Product, User, Order, CartItem
+from src.utils import create_jwt_token
+
+LOAD_SKU = 'load-flash-sale-product'
+LOAD_EMAIL_DOMAIN = 'checkout-load.test'
+
+
+async def checkout(http: ClientSession, url: str, token: str, args) -> tuple[str, float, float]:
+    headers = {'Authorization': f"Bearer {token}"}
+    started = time.monotonic()
+    async with http.post(f"{url}/orders", headers=headers) as response:
+        accepted = time.monotonic() - started
+        body = await response.json()
+        if response.status == 201:
+            return 'completed', accepted, accepted
+        if response.status != 202:
+            return f"rejected ({body.get('detail')})", accepted, accepted
+        location = response.headers['Location']
+
+    while True:
+        await asyncio.sleep(args.poll_interval)
+        async with http.get(f"{url}{location}", headers=headers) as response:
+            body = await response.json()
+        if body['status'] != 'queued':
+            return body['status'] if body['status'] == 'completed' else f"failed ({body.get('detail')})", \
+                accepted, time.monotonic() - started
+
+
+def describe(latencies: list[float]) -> str:
+    latencies = sorted(latencies)
+    return (f"p50 {statistics.median(latencies) * 1000:8.1f} ms, "
+            f"p99 {latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000:8.1f} ms")
+
+
+async def run(http: ClientSession, product_id: int, tokens: list[str], args) -> tuple[list, float]:
+    for token in tokens:
+        async with http.patch(f"{args.url}/cart/items", headers={'Authorization': f"Bearer {token}"},
+                              json=[{'product_id': product_id, 'quantity': 1}]) as response:
+            response.raise_for_status()
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(token: str):
+        async with semaphore:
+            return await checkout(http, args.url, token, args)
+
+    started = time.monotonic()
+    results = await asyncio.gather(*(limited(token) for token in tokens))
+    return results, time.monotonic() - started
+
+
+async def main(args):
+    engine = create_async_engine(settings.POSTGRESQL_DB_URL)
+    sessions = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+    async with sessions() as db:
+        product = Product(sku=LOAD_SKU, title='flash sale product', description='', full_price=100,
+                          quantity=args.stock)
+        users = [User(email=f"buyer{i}@{LOAD_EMAIL_DOMAIN}", name=f"buyer{i}") for i in range(args.users)]
+        db.add_all([product, *users])
+        await db.commit()
+    tokens = [create_jwt_token(user_id=user.id, expires_in=timedelta(hours=1)) for user in users]
+
+    try:
+        async with ClientSession() as http:
+            try:
+                results, elapsed = await run(http, product.id, tokens, args)
+            finally:
+                # carts kept in redis are written back later, they must not outlive their users with items
+                for token in tokens:
+                    async with http.post(f"{args.url}/cart/clear", headers={'Authorization': f"Bearer {token}"}):
+                        pass
+
+        outcomes: dict[str, int] = {}
+        for outcome, _, _ in results:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        placed = outcomes.get('completed', 0)
+        print(f"{len(results)} checkouts in {elapsed:.2f} s, {placed / elapsed:.1f} orders/s")
+        print(f"  accepted:  {describe([accepted for _, accepted, _ in results])}")
+        print(f"  completed: {describe([completed for _, _, completed in results])}")
+        for outcome, count in sorted(outcomes.items()):
+            print(f"  {outcome}: {count}")
+    finally:
+        async with sessions() as db:
+            user_ids = select(User.id).where(User.email.like(f"%@{LOAD_EMAIL_DOMAIN}")).scalar_subquery()
+            await db.execute(delete(Order).where(Order.user_id.in_(user_ids)))
+            await db.execute(delete(CartItem).where(CartItem.user_id.in_(user_ids)))
+            await db.execute(delete(User).where(User.email.like(f"%@{LOAD_EMAIL_DOMAIN}")))
+            await db.execute(delete(Product).where(Product.sku == LOAD_SKU))
+            await db.commit()
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m scripts.load_checkout')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--users', type=int, default=500, help="buyers checking out at once")
+    parser.add_argument('--concurrency', type=int, default=100, help="requests in flight")
+    parser.add_argument('--stock', type=int, default=10 ** 6, help="stock of the product, below --users to sell out")
+    parser.add_argument('--poll-interval', type=float, default=0.1, help="seconds between polls of a queued checkout")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,260 @@
+import asyncio
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Iterable
+
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import settings
+from src.crud import CartItemCRUD, ProductCRUD
+from src.custom_exceptions import ResourceDoesNotExistError
+from src.db.db import SessionLocal, after_commit
+from src.logger import logger
+from src.schemas.cart import Cart, CartItem
+from src.versioning import CATALOG_VERSION_KEY, ResourceVersions
+
+DIRTY_CARTS_KEY = 'carts:dirty'
+# marks a cart hash as loaded, so an emptied cart is not loaded from cart_items again
+_LOADED_FIELD = '_'
+
+# applies quantity deltas to a loaded cart, items that reach zero are dropped; returns 0 if the cart is not loaded
+# KEYS: cart, dirty carts; ARGV: user id, ttl, *(product id, delta)
+_CHANGE_QUANTITIES_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+for i = 3, #ARGV, 2 do
+    if redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1]) <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('SADD', KEYS[2], ARGV[1])
+return 1
+"""
+
+# KEYS: cart, dirty carts; ARGV: user id, ttl
+_CLEAR_SCRIPT = """
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], '_', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('SADD', KEYS[2], ARGV[1])
+"""
+
+# loads a cart unless a concurrent request has done it already
+# KEYS: cart; ARGV: ttl, *(product id, quantity)
+_LOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], '_', 1, unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+class CartStore(ABC):
+    @abstractmethod
+    async def get_cart(self, user_id: int) -> Cart:
+        pass
+
+    # deltas maps product ids to the change of their quantity, items that reach zero are removed
+    @abstractmethod
+    async def apply_deltas(self, user_id: int, deltas: dict[int, int]):
+        pass
+
+    async def add_item(self, user_id: int, product_id: int, quantity: int):
+        await self.apply_deltas(user_id, {product_id: quantity})
+
+    async def remove_item(self, user_id: int, product_id: int, quantity: int):
+        await self.apply_deltas(user_id, {product_id: -quantity})
+
+    @abstractmethod
+    async def clear(self, user_id: int):
+        pass
+
+    # empties the cart an order has been placed from, once the order is committed
+    @abstractmethod
+    async def clear_on_checkout(self, user_id: int):
+        pass
+
+    # deletes a batch of carts that have not changed since the cutoff, returns the ids of their users
+    @abstractmethod
+    async def purge_idle(self, changed_before: datetime, limit: int) -> list[int]:
+        pass
+
+
+class DatabaseCartStore(CartStore):
+    def __init__(self, cart_item_crud: CartItemCRUD):
+        self.cart_crud = cart_item_crud
+
+    async def get_cart(self, user_id: int) -> Cart:
+        lines = await self.cart_crud.get_lines(user_id)
+        return Cart(
+            items=[CartItem(product_id=line.product_id,
+                            quantity=line.quantity,
+                            unit_price=line.unit_price,
+                            total_price=line.total_price) for line in lines],
+            total_price=lines[0].cart_total if lines else 0
+        )
+
+    # unknown products are rejected by the foreign key
+    async def apply_deltas(self, user_id: int, deltas: dict[int, int]):
+        await self.cart_crud.apply_deltas(user_id, deltas)
+
+    async def clear(self, user_id: int):
+        await self.cart_crud.delete_all_by_user_id(user_id)
+
+    # the rows are deleted in the transaction of the order
+    async def clear_on_checkout(self, user_id: int):
+        await self.clear(user_id)
+
+    async def purge_idle(self, changed_before: datetime, limit: int) -> list[int]:
+        return await self.cart_crud.purge_idle(changed_before, limit)
+
+
+# Final prices of products for the cart totals, kept per catalog version. Every catalog invalidation
+# (product updates, deletions, imports) moves the readers to a fresh map, so no price outlives a change.
+# Orders are still priced from the locked product rows.
+class ProductPriceCache:
+    def __init__(self, redis: Redis, product_crud: ProductCRUD, versions: ResourceVersions):
+        self.redis = redis
+        self.product_crud = product_crud
+        self.versions = versions
+
+    async def get(self, product_ids: list[int]) -> dict[int, int]:
+        if not product_ids:
+            return {}
+        key = f"cart:prices:{(await self.versions.get(CATALOG_VERSION_KEY))[0]}"
+        cached = await self.redis.hmget(key, product_ids)
+        prices = {product_id: int(price) for product_id, price in zip(product_ids, cached) if price is not None}
+
+        if missing := [product_id for product_id, price in zip(product_ids, cached) if price is None]:
+            if loaded := await self.product_crud.get_final_prices(missing):
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    pipe.hset(key, mapping=loaded)
+                    pipe.expire(key, settings.CART_PRICE_CACHE_EXPIRATION_SECONDS)
+                    await pipe.execute()
+            prices.update(loaded)
+        return prices
+
+
+# Keeps every cart as a redis hash of product id -> quantity, mutated atomically by lua scripts.
+# Carts are loaded from cart_items on first access, and changed carts are written back
+# in the background by run_cart_flusher.
+class RedisCartStore(CartStore):
+    def __init__(self, redis: Redis, db: AsyncSession, cart_item_crud: CartItemCRUD, prices: ProductPriceCache):
+        self.redis = redis
+        self.db = db
+        self.cart_crud = cart_item_crud
+        self.prices = prices
+        self._change_quantities_script = redis.register_script(_CHANGE_QUANTITIES_SCRIPT)
+        self._clear_script = redis.register_script(_CLEAR_SCRIPT)
+        self._load_script = redis.register_script(_LOAD_SCRIPT)
+
+    async def get_cart(self, user_id: int) -> Cart:
+        quantities = await self._get_quantities(user_id)
+        prices = await self.prices.get(list(quantities))
+        # products deleted in the meantime are left out
+        items = [CartItem(product_id=product_id,
+                          quantity=quantity,
+                          unit_price=prices[product_id],
+                          total_price=prices[product_id] * quantity)
+                 for product_id, quantity in sorted(quantities.items()) if product_id in prices]
+        return Cart(items=items, total_price=sum(item.total_price for item in items))
+
+    async def apply_deltas(self, user_id: int, deltas: dict[int, int]):
+        added = [product_id for product_id, delta in deltas.items() if delta > 0]
+        prices = await self.prices.get(added)
+        if unknown := [product_id for product_id in added if product_id not in prices]:
+            raise ResourceDoesNotExistError(f"There are no products with the ids {unknown}")
+        await self._change_quantities(user_id, deltas.items())
+
+    async def clear(self, user_id: int):
+        await self._clear_script(keys=[_cart_key(user_id), DIRTY_CARTS_KEY],
+                                 args=[user_id, settings.CART_EXPIRATION_SECONDS])
+
+    # a failed order leaves the cart as it was
+    async def clear_on_checkout(self, user_id: int):
+        after_commit(self.db, lambda: self.clear(user_id))
+
+    # The rows are written back by the flusher whenever a cart changes, so rows that have not changed
+    # for the whole cutoff belong to carts that are at most read; their redis copies are dropped as well.
+    async def purge_idle(self, changed_before: datetime, limit: int) -> list[int]:
+        user_ids = await self.cart_crud.purge_idle(changed_before, limit)
+        if user_ids:
+            after_commit(self.db, lambda: self.redis.delete(*(_cart_key(user_id) for user_id in user_ids)))
+        return user_ids
+
+    async def _get_quantities(self, user_id: int) -> dict[int, int]:
+        if not (cart := await self.redis.hgetall(_cart_key(user_id))):
+            await self._load(user_id)
+            cart = await self.redis.hgetall(_cart_key(user_id))
+        return _parse_cart(cart)
+
+    async def _change_quantities(self, user_id: int, deltas: Iterable[tuple[int, int]]):
+        args = [user_id, settings.CART_EXPIRATION_SECONDS, *(value for delta in deltas for value in delta)]
+        keys = [_cart_key(user_id), DIRTY_CARTS_KEY]
+        if not await self._change_quantities_script(keys=keys, args=args):
+            await self._load(user_id)
+            await self._change_quantities_script(keys=keys, args=args)
+
+    async def _load(self, user_id: int):
+        quantities = await self.cart_crud.get_quantities(user_id)
+        await self._load_script(keys=[_cart_key(user_id)],
+                                args=[settings.CART_EXPIRATION_SECONDS,
+                                      *(value for item in quantities.items() for value in item)])
+
+
+# Writes a batch of carts changed in redis back to cart_items and returns its size.
+# SPOP hands every change to a single worker, but a cart changed again can be popped by another one while
+# the first is still writing it. The carts are therefore read under per-user locks: the flush that commits last
+# has read the latest carts, and a change made after the read has put the cart back into the dirty set.
+# A failed batch is queued again.
+async def flush_dirty_carts(redis: Redis) -> int:
+    user_ids = await redis.spop(DIRTY_CARTS_KEY, settings.CART_FLUSH_BATCH_SIZE)
+    if not user_ids:
+        return 0
+
+    try:
+        async with SessionLocal() as db:
+            cart_crud = CartItemCRUD(db)
+            await cart_crud.lock_carts([int(user_id) for user_id in user_ids])
+            async with redis.pipeline(transaction=False) as pipe:
+                for user_id in user_ids:
+                    pipe.hgetall(_cart_key(user_id))
+                carts = await pipe.execute()
+            # an expired cart has nothing newer than the rows
+            await cart_crud.replace_carts(
+                {int(user_id): _parse_cart(cart) for user_id, cart in zip(user_ids, carts) if cart}
+            )
+            await db.commit()
+    except Exception:
+        await redis.sadd(DIRTY_CARTS_KEY, *user_ids)
+        raise
+    return len(user_ids)
+
+
+async def run_cart_flusher(redis: Redis):
+    try:
+        while True:
+            try:
+                while await flush_dirty_carts(redis) == settings.CART_FLUSH_BATCH_SIZE:
+                    pass
+            except Exception as e:
+                logger.error(f"Failed to flush the carts: {e}")
+            await asyncio.sleep(settings.CART_FLUSH_INTERVAL_SECONDS)
+    except asyncio.CancelledError:
+        # write back whatever changed since the last round before the worker exits
+        while await flush_dirty_carts(redis):
+            pass
+        raise
+
+
+def _cart_key(user_id: int | str) -> str:
+    return f"cart:{user_id}"
+
+
+def _parse_cart(cart: dict[str, str]) -> dict[int, int]:
+    return {int(product_id): int(quantity) for product_id, quantity in cart.items() if product_id != _LOADED_FIELD}
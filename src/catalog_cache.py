@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import json
+import uuid
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Iterable
+
+from fastapi import Response
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import settings
+from src.db.db import after_commit
+from src.serialization import product_fragments
+from src.versioning import CATALOG_VERSION_KEY, ResourceVersions, initial_version
+
+# every cached listing is tagged with the collection tag, since adding or removing products shifts all pages
+COLLECTION_TAG = 'products'
+# faceted pages aggregate over every match, not just the products on the page
+# (stock counts changed by orders are only refreshed on expiration)
+FACETS_TAG = 'facets'
+
+# stores a page only if no invalidation happened since its computation started
+# KEYS: catalog version, page, *tags; ARGV: version seen before computing, ttl, body, next cursor
+_STORE_PAGE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[2], 'body', ARGV[3], 'next_cursor', ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+for i = 3, #KEYS do
+    redis.call('SADD', KEYS[i], KEYS[2])
+    redis.call('EXPIRE', KEYS[i], ARGV[2])
+end
+return 1
+"""
+
+# bumps the catalog version and drops every page of the given tags in one step
+# KEYS: catalog version, *tags; ARGV: initial version
+_INVALIDATE_SCRIPT = """--!df flags=allow-undeclared-keys
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+redis.call('INCR', KEYS[1])
+for i = 2, #KEYS do
+    local pages = redis.call('SMEMBERS', KEYS[i])
+    for j = 1, #pages, 500 do
+        redis.call('DEL', unpack(pages, j, math.min(j + 499, #pages)))
+    end
+    redis.call('DEL', KEYS[i])
+end
+"""
+
+# releases the page lock only if it is still held by the releasing computation; a computation that outlived
+# the lock must not release the lock another worker has taken since
+# KEYS: lock; ARGV: token
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def product_tag(product_id: int) -> str:
+    return f"product:{product_id}"
+
+
+def category_tag(category_id: int) -> str:
+    return f"category:{category_id}"
+
+
+@dataclass
+class CachedPage:
+    body: str
+    next_cursor: str | None = None
+
+    def to_response(self, etag: str | None = None) -> Response:
+        headers = {}
+        if self.next_cursor:
+            headers['X-Next-Cursor'] = self.next_cursor
+        if etag:
+            headers['ETag'] = etag
+        return Response(content=self.body, media_type='application/json', headers=headers)
+
+
+# Caches serialized catalog pages in redis. Every page is tagged with the products it contains
+# (and the categories it was filtered by), so writes only evict the pages they affect.
+# Invalidations are applied after the request transaction commits and bump the catalog version;
+# a page is only stored if the version did not change while it was being computed,
+# so a reader that started before the commit cannot put the old state back.
+class CatalogCache:
+    def __init__(self, redis: Redis, db: AsyncSession):
+        self.redis = redis
+        self.db = db
+        self.versions = ResourceVersions(redis, db)
+        self._store_page_script = redis.register_script(_STORE_PAGE_SCRIPT)
+        self._invalidate_script = redis.register_script(_INVALIDATE_SCRIPT)
+        self._release_lock_script = redis.register_script(_RELEASE_LOCK_SCRIPT)
+        self._pending_tags: set[str] = set()
+        self._version: int | None = None
+
+    # read once per request, before any cached data is read
+    async def version(self) -> int:
+        if self._version is None:
+            self._version = (await self.versions.get(CATALOG_VERSION_KEY))[0]
+        return self._version
+
+    async def get_or_compute(self, route: str, params: dict,
+                             compute: Callable[[], Awaitable[list]], *,
+                             tags: Iterable[str] = ()) -> CachedPage:
+        key = _page_key(route, params)
+        version = await self.version()
+        if (page := await self._get(key)) is not None:
+            return page
+
+        lock_key = f"catalog:lock:{key}"
+        token = uuid.uuid4().hex
+        if await self.redis.set(lock_key, token, nx=True, px=settings.CATALOG_CACHE_LOCK_MILLISECONDS):
+            try:
+                return await self._compute_and_store(key, version, compute, tags)
+            finally:
+                await self._release_lock_script(keys=[lock_key], args=[token])
+
+        # another worker is computing the page, wait for it instead of hitting the database as well
+        for _ in range(settings.CATALOG_CACHE_LOCK_MILLISECONDS // settings.CATALOG_CACHE_LOCK_POLL_MILLISECONDS):
+            await asyncio.sleep(settings.CATALOG_CACHE_LOCK_POLL_MILLISECONDS / 1000)
+            if (page := await self._get(key)) is not None:
+                return page
+            if not await self.redis.exists(lock_key):
+                break
+        return await self._compute_and_store(key, version, compute, tags)
+
+    def invalidate(self, *tags: str):
+        if not self._pending_tags:
+            after_commit(self.db, self.apply_invalidations)
+        self._pending_tags.update(tags)
+
+    async def apply_invalidations(self):
+        tags, self._pending_tags = self._pending_tags, set()
+        await self._invalidate_script(keys=[CATALOG_VERSION_KEY, *map(_tag_key, tags)],
+                                      args=[initial_version()])
+
+    async def _get(self, key: str) -> CachedPage | None:
+        if not (cached := await self.redis.hgetall(key)):
+            return None
+        return CachedPage(body=cached['body'], next_cursor=cached.get('next_cursor') or None)
+
+    async def _compute_and_store(self, key: str, version: int, compute: Callable[[], Awaitable[list]],
+                                 tags: Iterable[str]) -> CachedPage:
+        products = await compute()
+        if (facets := getattr(products, 'facets', None)) is not None:
+            body = product_fragments.render_search(products, facets).decode()
+            tags = [*tags, FACETS_TAG]
+        else:
+            body = product_fragments.render_list(products).decode()
+        page = CachedPage(body=body, next_cursor=getattr(products, 'next_cursor', None))
+
+        tags = {COLLECTION_TAG, *tags, *(product_tag(product.id) for product in products)}
+        await self._store_page_script(
+            keys=[CATALOG_VERSION_KEY, key, *map(_tag_key, tags)],
+            args=[version, settings.CATALOG_CACHE_EXPIRATION_SECONDS, page.body, page.next_cursor or '']
+        )
+        return page
+
+
+def _page_key(route: str, params: dict) -> str:
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+    return f"catalog:page:{route}:{digest}"
+
+
+def _tag_key(tag: str) -> str:
+    return f"catalog:tag:{tag}"
@@ -11,5 +11,8 @@ class CeleryConfig(BaseSettings):
     SMTP_MAIL: str
     SMTP_SERVER: str
 
+    REAP_STALE_ORDERS_INTERVAL_SECONDS: float = 5 * 60
+    PURGE_IDLE_CARTS_INTERVAL_SECONDS: float = 60 * 60
+
 
 celery_config = CeleryConfig()
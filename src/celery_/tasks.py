@@ -1,9 +1,17 @@
+import asyncio
+
 from celery import Celery
 
 from .config import celery_config
 from .utils import send_email
 
 celery = Celery("celery", broker=celery_config.CELERY_BROKER_URL, backend=celery_config.CELERY_BACKEND_URL)
+celery.conf.beat_schedule = {
+    'reap-stale-orders': {'task': 'reap_stale_orders',
+                          'schedule': celery_config.REAP_STALE_ORDERS_INTERVAL_SECONDS},
+    'purge-idle-carts': {'task': 'purge_idle_carts',
+                         'schedule': celery_config.PURGE_IDLE_CARTS_INTERVAL_SECONDS},
+}
 
 
 @celery.task(name='send_password_recovery_email')
@@ -16,3 +24,16 @@ def send_password_recovery_email(username, link, email_address):
 def send_confirmation_code_email(code, email_address):
     send_email(email_address, subject="Confirmation code", template_name="confirmation_code.html",
                code=code)
+
+
+# the maintenance jobs work on the api's database, imported lazily so that sending emails needs none of it
+@celery.task(name='reap_stale_orders')
+def reap_stale_orders():
+    from src import reaper
+    return asyncio.run(reaper.reap_stale_orders())
+
+
+@celery.task(name='purge_idle_carts')
+def purge_idle_carts():
+    from src import reaper
+    return asyncio.run(reaper.purge_idle_carts())
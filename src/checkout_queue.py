@@ -0,0 +1,212 @@
+import asyncio
+import random
+import time
+import uuid
+from typing import Callable
+
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import settings
+from src.custom_exceptions import PetStoreApiError
+from src.db.db import SessionLocal, run_after_commit_callbacks, run_rollback_callbacks, savepoint
+from src.logger import logger
+from src.service.order import OrderService
+
+_GROUP = 'checkout'
+# a partition is consumed by one worker at a time (the lease holder), so all of them read as the same consumer
+# and the entries a dead worker left unacknowledged are delivered to the next lease holder
+_CONSUMER = 'worker'
+
+# releases a partition lease or clears the pending checkout of a user, provided it is still the given one
+# KEYS: lease or pending checkout; ARGV: token or checkout id
+_COMPARE_AND_DELETE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# extends the lease of a partition, provided it is still held by the given token; returns 0 if it is not
+# KEYS: lease; ARGV: token, ttl
+_RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# queues a checkout unless the user has one pending already; returns the id of the pending checkout
+# KEYS: pending checkout, checkout, stream; ARGV: checkout id, user id, status ttl, pending ttl
+_ENQUEUE_SCRIPT = """
+local pending = redis.call('GET', KEYS[1])
+if pending then
+    return pending
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[4])
+redis.call('HSET', KEYS[2], 'user_id', ARGV[2], 'status', 'queued')
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('XADD', KEYS[3], '*', 'checkout_id', ARGV[1], 'user_id', ARGV[2])
+return ARGV[1]
+"""
+
+
+# Checkouts waiting to be turned into orders, kept in redis streams. A checkout is routed to the partition
+# of the lowest product id in its cart, so flash sale carts of the same product queue up in one partition
+# and are placed in the order they arrived. A user has at most one checkout pending at a time, so a repeated
+# request (a double click, a retry) does not queue the same cart twice.
+class CheckoutQueue:
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self._enqueue_script = redis.register_script(_ENQUEUE_SCRIPT)
+
+    # returns the id of the queued checkout, or of the one the user has pending already
+    async def enqueue(self, user_id: int, product_ids: list[int]) -> str:
+        checkout_id = uuid.uuid4().hex
+        stream = _stream_key(min(product_ids) % settings.CHECKOUT_QUEUE_PARTITIONS)
+        return await self._enqueue_script(
+            keys=[_pending_key(user_id), _checkout_key(checkout_id), stream],
+            args=[checkout_id, user_id, settings.CHECKOUT_STATUS_EXPIRATION_SECONDS, settings.CHECKOUT_PENDING_SECONDS]
+        )
+
+    # user_id, status ('queued', 'completed' or 'failed') and, once processed, order_id or detail
+    async def get(self, checkout_id: str) -> dict[str, str] | None:
+        return await self.redis.hgetall(_checkout_key(checkout_id)) or None
+
+
+# Places the queued checkouts through OrderService.create_order, a batch per transaction: the stock rows
+# of a hot product are locked once per batch instead of once per checkout, and a batch costs a single commit.
+# Every checkout runs in a savepoint, so a failed one leaves the rest of the batch intact; the redis stock
+# holds of a failed checkout or batch are released by the rollback compensations.
+async def run_checkout_worker(redis: Redis, order_service_factory: Callable[[AsyncSession], OrderService]):
+    token = uuid.uuid4().hex
+    release_lease = redis.register_script(_COMPARE_AND_DELETE_SCRIPT)
+    renew_lease = redis.register_script(_RENEW_LEASE_SCRIPT)
+    for partition in range(settings.CHECKOUT_QUEUE_PARTITIONS):
+        try:
+            await redis.xgroup_create(_stream_key(partition), _GROUP, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    while True:
+        processed = 0
+        try:
+            for partition in random.sample(range(settings.CHECKOUT_QUEUE_PARTITIONS),
+                                           settings.CHECKOUT_QUEUE_PARTITIONS):
+                lease = f"{_stream_key(partition)}:lease"
+                if not await redis.set(lease, token, nx=True, ex=settings.CHECKOUT_LEASE_SECONDS):
+                    continue
+                lease_lost = asyncio.Event()
+                renewal = asyncio.create_task(_keep_lease(renew_lease, lease, token, lease_lost))
+                try:
+                    # entries left unacknowledged by a failed batch or a dead worker come first
+                    entries = (await _read(redis, partition, '0')) or (await _read(redis, partition, '>'))
+                    if entries:
+                        await _process_batch(redis, partition, entries, order_service_factory, lease_lost)
+                        processed += len(entries)
+                finally:
+                    renewal.cancel()
+                    await release_lease(keys=[lease], args=[token])
+        except Exception as e:
+            logger.error(f"Checkout worker failed: {e}")
+        if not processed:
+            await asyncio.sleep(settings.CHECKOUT_IDLE_SLEEP_SECONDS)
+
+
+# renews the lease while its batch is being processed, so a slow batch is not handed to another worker;
+# sets lease_lost once the lease cannot be renewed
+async def _keep_lease(renew_lease, lease: str, token: str, lease_lost: asyncio.Event):
+    while True:
+        await asyncio.sleep(settings.CHECKOUT_LEASE_SECONDS / 3)
+        try:
+            renewed = await renew_lease(keys=[lease], args=[token, settings.CHECKOUT_LEASE_SECONDS])
+        except Exception as e:
+            logger.error(f"Failed to renew the checkout lease {lease}: {e}")
+            renewed = False
+        if not renewed:
+            lease_lost.set()
+            return
+
+
+async def _read(redis: Redis, partition: int, after: str) -> list[tuple[str, dict[str, str]]]:
+    response = await redis.xreadgroup(_GROUP, _CONSUMER, {_stream_key(partition): after},
+                                      count=settings.CHECKOUT_BATCH_SIZE)
+    return response[0][1] if response else []
+
+
+async def _process_batch(redis: Redis, partition: int, entries: list[tuple[str, dict[str, str]]],
+                         order_service_factory, lease_lost: asyncio.Event):
+    started = time.monotonic()
+    async with redis.pipeline(transaction=False) as pipe:
+        for _, fields in entries:
+            pipe.hget(_checkout_key(fields['checkout_id']), 'status')
+        statuses = await pipe.execute()
+
+    outcomes: dict[str, dict] = {}
+    async with SessionLocal() as db:
+        order_service = order_service_factory(db)
+        # placed by an earlier delivery of the batch that died before recording the outcomes
+        placed_orders = await order_service.get_orders_of_checkouts([fields['checkout_id'] for _, fields in entries])
+        users_placed: set[int] = set()
+        for (_, fields), status in zip(entries, statuses):
+            checkout_id, user_id = fields['checkout_id'], int(fields['user_id'])
+            # redelivered after its outcome was recorded, or expired
+            if status != 'queued':
+                continue
+            if checkout_id in placed_orders:
+                outcomes[checkout_id] = {'status': 'completed', 'order_id': placed_orders[checkout_id]}
+                continue
+            # the cart of a user this batch has placed an order for is emptied only once the batch commits
+            if user_id in users_placed:
+                outcomes[checkout_id] = {'status': 'failed', 'detail': "The user's cart is empty"}
+                continue
+            try:
+                async with savepoint(db):
+                    order = await order_service.create_order(user_id, checkout_id)
+                outcomes[checkout_id] = {'status': 'completed', 'order_id': order.id}
+                users_placed.add(user_id)
+            except PetStoreApiError as e:
+                outcomes[checkout_id] = {'status': 'failed', 'detail': e.message}
+            except Exception as e:
+                logger.error(f"Checkout {checkout_id} failed: {e}")
+                outcomes[checkout_id] = {'status': 'failed', 'detail': "Checkout failed"}
+        try:
+            # another worker may be processing the batch by now, it is left to that one
+            if lease_lost.is_set():
+                raise RuntimeError(f"Lost the lease of checkout partition {partition}")
+            await db.commit()
+        except Exception:
+            await run_rollback_callbacks(db)
+            raise
+        await run_after_commit_callbacks(db)
+
+    # a worker dying right here leaves the batch to be delivered again, the orders it placed are found
+    # by their checkout ids and not placed twice
+    entry_ids = [entry_id for entry_id, _ in entries]
+    clear_pending = redis.register_script(_COMPARE_AND_DELETE_SCRIPT)
+    async with redis.pipeline(transaction=False) as pipe:
+        for checkout_id, outcome in outcomes.items():
+            pipe.hset(_checkout_key(checkout_id), mapping=outcome)
+        for _, fields in entries:
+            await clear_pending(keys=[_pending_key(int(fields['user_id']))], args=[fields['checkout_id']], client=pipe)
+        pipe.xack(_stream_key(partition), _GROUP, *entry_ids)
+        pipe.xdel(_stream_key(partition), *entry_ids)
+        await pipe.execute()
+
+    placed = sum(outcome['status'] == 'completed' for outcome in outcomes.values())
+    logger.info(f"Checkout batch on partition {partition}: {len(entries)} entries, {placed} orders placed, "
+                f"{len(outcomes) - placed} failed in {(time.monotonic() - started) * 1000:.1f} ms")
+
+
+def _stream_key(partition: int) -> str:
+    return f"checkouts:{partition}"
+
+
+def _checkout_key(checkout_id: str) -> str:
+    return f"checkout:{checkout_id}"
+
+
+def _pending_key(user_id: int) -> str:
+    return f"checkout:pending:{user_id}"
@@ -0,0 +1,60 @@
+import argparse
+import asyncio
+
+import aiofiles
+
+from src.catalog_cache import CatalogCache
+from src.clients.redis_client import redis
+from src.crud import ProductCRUD, CategoryCRUD
+from src.db.db import SessionLocal, run_after_commit_callbacks
+from src.logger import logger
+from src.service.product_import import ProductImportService
+
+
+async def recompute_ratings():
+    async with SessionLocal() as db:
+        updated = await ProductCRUD(db).recompute_ratings()
+        await db.commit()
+    logger.info(f"Recomputed rating aggregates of {updated} products")
+
+
+async def _read_file(path: str):
+    async with aiofiles.open(path, 'rb') as f:
+        while chunk := await f.read(64 * 1024):
+            yield chunk
+
+
+async def import_products(path: str, fmt: str):
+    async with SessionLocal() as db:
+        service = ProductImportService(ProductCRUD(db), CategoryCRUD(db), CatalogCache(redis, db))
+        report = await service.import_products(_read_file(path), fmt)
+        await db.commit()
+        await run_after_commit_callbacks(db)
+    print(report.model_dump_json(indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m src.cli')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('recompute-ratings',
+                        help="rebuild the stored product rating aggregates from the reviews table")
+
+    import_parser = commands.add_parser('import-products',
+                                        help="create or update products (matched by sku) from a csv or ndjson file")
+    import_parser.add_argument('path')
+    import_parser.add_argument('--format', choices=['csv', 'ndjson'],
+                               help="file format, derived from the file extension by default")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case 'recompute-ratings':
+            asyncio.run(recompute_ratings())
+        case 'import-products':
+            fmt = args.format or ('csv' if args.path.endswith('.csv') else 'ndjson')
+            asyncio.run(import_products(args.path, fmt))
+
+
+if __name__ == '__main__':
+    main()
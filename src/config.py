@@ -12,7 +12,16 @@ class Rules(BaseSettings):
     MAX_CATEGORY_NAME_LENGTH: int = 30
     MAX_PRODUCT_TITLE_LENGTH: int = 30
     MAX_PRODUCT_DESCRIPTION_LENGTH: int = 1000
+    MAX_PRODUCT_SKU_LENGTH: int = 64
+    MAX_CART_DELTAS_PER_REQUEST: int = 100
+    # bounds the quantity of a single cart change, the quantity columns are int4
+    MAX_CART_ITEM_QUANTITY: int = 10_000
+    MIN_STOCK_SHARDS: int = 2
+    MAX_STOCK_SHARDS: int = 64
+    DEFAULT_STOCK_SHARDS: int = 8
     MAX_REVIEW_CONTENT_LENGTH: int = 1000
+    MIN_REVIEW_RATING: int = 0
+    MAX_REVIEW_RATING: int = 10
 
     CONFIRMATION_CODE_LENGTH: int = 6
     CONFIRMATION_CODE_LOWER_BOUND: int = 10 ** (CONFIRMATION_CODE_LENGTH - 1)
@@ -25,6 +34,8 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRATION_MINUTES: int = 60
     REFRESH_TOKEN_EXPIRATION_DAYS: int = 15
     RECOVERY_TOKEN_EXPIRATION_MINUTES: int = 15
+    # signed in devices per user, the least recently refreshed session is ended beyond it
+    MAX_SESSIONS_PER_USER: int = 10
 
     CONFIRMATION_CODE_EXPIRATION_SECONDS: int = 15 * 60
     ALGORITHM: str = "HS256"
@@ -37,11 +48,95 @@ class Settings(BaseSettings):
     IMAGES_BASE_PATH: str = '/static/product_images/'
     IMAGES_BASE_URL: str = IMAGES_HOST + IMAGES_BASE_PATH
 
+    CATALOG_CACHE_EXPIRATION_SECONDS: int = 5 * 60
+    CATALOG_CACHE_LOCK_MILLISECONDS: int = 5 * 1000
+    CATALOG_CACHE_LOCK_POLL_MILLISECONDS: int = 50
+
+    # the users behind access tokens, an in-process LRU in front of records in redis
+    PRINCIPAL_CACHE_ENABLED: bool = True
+    PRINCIPAL_CACHE_SIZE: int = 10_000
+    PRINCIPAL_CACHE_LOCAL_TTL_SECONDS: float = 5
+    PRINCIPAL_CACHE_TTL_SECONDS: int = 10 * 60
+
+    TOKEN_VERSION_CACHE_SECONDS: int = 24 * 60 * 60
+
+    # sliding window limits of the auth endpoints, requests per window per client IP, email or user
+    RATE_LIMIT_ENABLED: bool = True
+    LOGIN_RATE_LIMIT_WINDOW_SECONDS: int = 60
+    LOGIN_RATE_LIMIT_PER_IP: int = 30
+    LOGIN_RATE_LIMIT_PER_EMAIL: int = 5
+    CONFIRMATION_CODE_RATE_LIMIT_WINDOW_SECONDS: int = 15 * 60
+    CONFIRMATION_CODE_RATE_LIMIT_PER_IP: int = 10
+    CONFIRMATION_CODE_RATE_LIMIT_PER_EMAIL: int = 3
+    PASSWORD_RECOVERY_RATE_LIMIT_WINDOW_SECONDS: int = 15 * 60
+    PASSWORD_RECOVERY_RATE_LIMIT_PER_IP: int = 10
+    PASSWORD_RECOVERY_RATE_LIMIT_PER_EMAIL: int = 3
+    REFRESH_RATE_LIMIT_WINDOW_SECONDS: int = 60
+    REFRESH_RATE_LIMIT_PER_USER: int = 30
+
+    # changing the cost factor rehashes the passwords as their users log in
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASHING_THREADS: int = 4
+    # operations that waited longer for a hashing thread are logged as warnings
+    PASSWORD_HASHING_SLOW_QUEUE_MILLISECONDS: float = 100
+
+    PRODUCT_FRAGMENT_CACHE_SIZE: int = 10_000
+
+    PRODUCT_IMPORT_CHUNK_SIZE: int = 1000
+    PRODUCT_IMPORT_MAX_REPORTED_ERRORS: int = 1000
+    # rows fetched from the server-side cursor and encoded at once by the exports
+    EXPORT_BATCH_SIZE: int = 1000
+
+    # 'redis' keeps the carts in redis and writes them back to the database in the background
+    CART_BACKEND: Literal['redis', 'database'] = 'redis'
+    CART_EXPIRATION_SECONDS: int = 30 * 24 * 60 * 60
+    CART_PRICE_CACHE_EXPIRATION_SECONDS: int = 10 * 60
+    CART_FLUSH_INTERVAL_SECONDS: float = 5
+    CART_FLUSH_BATCH_SIZE: int = 500
+
+    # 'redis' only holds the stock of a placed order in redis counters and takes it from the database
+    # once the order is paid for, 'database' takes it from the database as soon as the order is placed
+    INVENTORY_BACKEND: Literal['redis', 'database'] = 'database'
+    STOCK_HOLD_SECONDS: int = 30 * 60
+    STOCK_HOLD_RELEASE_INTERVAL_SECONDS: float = 10
+    STOCK_HOLD_RELEASE_BATCH_SIZE: int = 500
+    STOCK_RECONCILE_INTERVAL_SECONDS: float = 5 * 60
+    STOCK_RECONCILE_BATCH_SIZE: int = 1000
+
+    # 'queued' answers POST /orders with 202 and a checkout id, the orders are placed by background workers
+    CHECKOUT_MODE: Literal['inline', 'queued'] = 'inline'
+    CHECKOUT_QUEUE_PARTITIONS: int = 4
+    # worker tasks per api process
+    CHECKOUT_WORKERS: int = 2
+    CHECKOUT_BATCH_SIZE: int = 50
+    CHECKOUT_LEASE_SECONDS: int = 30
+    CHECKOUT_IDLE_SLEEP_SECONDS: float = 0.05
+    CHECKOUT_STATUS_EXPIRATION_SECONDS: int = 24 * 60 * 60
+    # a user cannot queue another checkout while one is pending, for at most this long
+    CHECKOUT_PENDING_SECONDS: int = 10 * 60
+
+    # periodic celery jobs: unpaid pending orders older than STALE_ORDER_AGE_SECONDS are cancelled
+    # and carts unchanged for IDLE_CART_AGE_SECONDS are deleted, REAPER_BATCH_SIZE rows per transaction
+    STALE_ORDER_AGE_SECONDS: int = 24 * 60 * 60
+    IDLE_CART_AGE_SECONDS: int = 90 * 24 * 60 * 60
+    REAPER_BATCH_SIZE: int = 500
+    # bounds a single run, whatever is left is picked up by the next one
+    REAPER_MAX_BATCHES: int = 100
+
+    # lower bounds (in cents) of the price bands reported by faceted search
+    SEARCH_PRICE_BUCKETS: list[int] = [0, 10000, 50000, 100000, 500000]
+
     CORS_ORIGINS: list[str] = ["*"]
 
     SAME_SITE_COOKIE: Literal['strict', 'lax', 'none'] = "strict"
 
     PAYMENT_SUCCESS_REDIRECT_URL: str = 'http://localhost:8000/payment/success'
+    # stripe checkout sessions expire after this long (stripe accepts 30 minutes to 24 hours); the stock held for
+    # an order paid through one is kept until then, plus the time the payment notification may take to arrive
+    PAYMENT_SESSION_EXPIRATION_SECONDS: int = 31 * 60
+    PAYMENT_NOTIFICATION_GRACE_SECONDS: int = 10 * 60
+    # ISO 4217 code of the prices, lower case as stripe expects it
+    CURRENCY: str = 'uah'
 
     GOOGLE_AUTH_URL: str = "https://accounts.google.com/o/oauth2/v2/auth"
     GOOGLE_TOKEN_URL: str = "https://oauth2.googleapis.com/token"
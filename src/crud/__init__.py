@@ -4,5 +4,4 @@ from .reviews import ReviewCRUD
 from .users import UserCRUD
 from .carts import CartItemCRUD
 from .orders import OrderCRUD
-from .tokens import RecoveryTokenCRUD, RefreshTokenCRUD
 from .payments import PaymentCRUD
@@ -1,40 +1,105 @@
+import binascii
+import json
 import re
-from typing import Literal, Callable, Any
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from typing import Literal, Callable, Any, AsyncIterator, Sequence
 
-from sqlalchemy import select
+from sqlalchemy import select, tuple_, cast, literal, and_, inspect
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-
-from src.custom_exceptions import ResourceDoesNotExistError, ResourceAlreadyExistsError, DependentEntityExistsError
+from sqlalchemy.orm.exc import StaleDataError
+
+from src.custom_exceptions import (
+    ResourceDoesNotExistError,
+    ResourceAlreadyExistsError,
+    DependentEntityExistsError,
+    InvalidCursorError,
+    VersionConflictError,
+)
 from src.db.db import Base
 from src.logger import logger
 from src.schemas.base import ObjUpdate
-from src.schemas.filtration import PaginationParams
+from src.schemas.filtration import PaginationParams, ExportFilter
+
+
+# a list of entities that also carries the keyset cursor of the following page
+class Page(list):
+    def __init__(self, items=(), next_cursor: str | None = None):
+        super().__init__(items)
+        self.next_cursor = next_cursor
 
 
 class _CRUDBase:
     model = None
     key = None
+    # Named sets of loader options for the different use cases (e.g. 'list', 'detail').
+    # Relationships are lazy='raise', so whatever a profile does not load fails loudly on access
+    # instead of silently issuing a query per entity.
+    loader_profiles: dict[str, list] = {}
 
     def __init__(self, db: AsyncSession):
         self.db: AsyncSession = db
 
-    async def _get_one(self, criteria):
-        result = await self.db.execute(select(self.__class__.model).filter(criteria))
+    # Flushes the pending changes. Entities of a model with a version_id_col are updated only if nobody
+    # else has changed them since they were read; the changes are flushed here rather than on the commit
+    # in the teardown of get_db, where a conflict would not be turned into a 409.
+    async def flush(self):
+        try:
+            await self.db.flush()
+        except StaleDataError:
+            raise VersionConflictError(f"{self.__class__.model.__name__} has been modified in the meantime")
+
+    def _loader_options(self, profile: str | None) -> list:
+        return self.__class__.loader_profiles[profile] if profile is not None else []
+
+    async def _get_one(self, criteria, profile: str | None = None):
+        result = await self.db.execute(select(self.__class__.model)
+                                       .filter(criteria)
+                                       .options(*self._loader_options(profile)))
         return result.scalars().first()
 
     async def _get_all(self,
                        criteria,
                        pagination: PaginationParams = None,
                        order_by=None,
-                       for_update: bool = False):
+                       for_update: bool = False,
+                       profile: str | None = None) -> Page:
+        sort_keys = list(order_by) if isinstance(order_by, (list, tuple)) else [order_by]
+        keyset = pagination is not None and pagination.cursor is not None and order_by is not None
+
         q = (select(self.__class__.model)
              .filter(criteria)
-             .order_by(order_by)
+             .options(*self._loader_options(profile))
+             .order_by(*sort_keys)
              .limit(pagination and pagination.limit)
-             .offset(pagination and pagination.offset))
+             .offset(None if keyset or pagination is None else pagination.offset))
+        if keyset:
+            q = q.filter(after_cursor(sort_keys, pagination.cursor))
+
         result = await self.db.execute(q.with_for_update() if for_update else q)
-        return result.scalars().all()
+        entities = result.scalars().all()
+
+        next_cursor = None
+        if order_by is not None and pagination is not None and len(entities) == pagination.limit:
+            next_cursor = encode_cursor([getattr(entities[-1], key.key) for key in sort_keys])
+        return Page(entities, next_cursor)
+
+    # Iterates over the matching entities in batches of batch_size fetched through a server-side cursor.
+    # A batch is detached from the session once the caller is done with it, so memory use stays flat.
+    async def _stream_all(self,
+                          criteria,
+                          order_by,
+                          batch_size: int,
+                          profile: str | None = None) -> AsyncIterator[Sequence]:
+        q = (select(self.__class__.model)
+             .filter(criteria)
+             .options(*self._loader_options(profile))
+             .order_by(order_by)
+             .execution_options(yield_per=batch_size))
+        result = await self.db.stream_scalars(q)
+        async for batch in result.partitions():
+            yield batch
+            self.db.expunge_all()
 
     def __init_subclass__(cls, **kwargs):
         if cls.__base__ is not _CRUDBase:
@@ -66,8 +131,11 @@ class Creatable(_CRUDBase):
 
 
 class Retrievable(_CRUDBase):
-    async def get(self, key, *, on_not_found: Literal['raise-error', 'return-none'] = 'raise-error'):
-        if (entity := await self._get_one(self.__class__.key == key)) is None and on_not_found == 'raise-error':
+    async def get(self, key, *,
+                  on_not_found: Literal['raise-error', 'return-none'] = 'raise-error',
+                  profile: str | None = None):
+        if ((entity := await self._get_one(self.__class__.key == key, profile)) is None
+                and on_not_found == 'raise-error'):
             raise ResourceDoesNotExistError(
                 f"{self.__class__.model.__name__} with the given {str(self.__class__.key).split('.')[-1]} does not exist.")
         return entity
@@ -75,9 +143,11 @@ class Retrievable(_CRUDBase):
 
 class Updatable(_CRUDBase):
 
+    # with expected_version (e.g. from If-Match) only that version of a versioned entity is updated
     async def update(self, key, obj_update: ObjUpdate, *,
                      predicate: Callable[[Any], bool] = None,
-                     on_not_found: Literal['raise-error', 'ignore'] = 'raise-error'):
+                     on_not_found: Literal['raise-error', 'ignore'] = 'raise-error',
+                     expected_version: int | None = None):
         if ((entity_to_update := await self._get_one(self.__class__.key == key)) is None
                 and on_not_found == 'raise-error'):
             raise ResourceDoesNotExistError(
@@ -85,9 +155,11 @@ class Updatable(_CRUDBase):
             )
 
         if entity_to_update and predicate is None or predicate(entity_to_update):
+            if expected_version is not None and version_of(entity_to_update) != expected_version:
+                raise VersionConflictError(f"{self.__class__.model.__name__} has been modified in the meantime")
             for k, v in obj_update.model_dump(exclude_none=True).items():
                 setattr(entity_to_update, k, v)
-            await self.db.flush()
+            await self.flush()
             await self.db.refresh(entity_to_update)
             return entity_to_update
         return None
@@ -106,7 +178,7 @@ class Deletable(_CRUDBase):
         if entity_to_delete and predicate is None or predicate(entity_to_delete):
             try:
                 await self.db.delete(entity_to_delete)
-                await self.db.flush()
+                await self.flush()
             except IntegrityError as e:
                 error_message = str(e.orig)
 
@@ -117,6 +189,41 @@ class Deletable(_CRUDBase):
                     logger.error(f"Unexpected IntegrityError: {e}")
 
 
+# the value of the version_id_col of a versioned entity
+def version_of(entity) -> int:
+    mapper = inspect(entity).mapper
+    return getattr(entity, mapper.get_property_by_column(mapper.version_id_col).key)
+
+
+def encode_cursor(values: list) -> str:
+    return urlsafe_b64encode(json.dumps(values, default=str).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, length: int) -> list:
+    try:
+        values = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, binascii.Error):
+        raise InvalidCursorError("Malformed pagination cursor")
+
+    if (not isinstance(values, list) or len(values) != length
+            or not all(isinstance(v, (str, int, float)) for v in values)):
+        raise InvalidCursorError("Pagination cursor does not match the requested listing")
+    return values
+
+
+def after_cursor(sort_keys: list, cursor: str, *, descending: bool = False):
+    # row-value comparison lets postgres seek straight to the cursor position using an index on sort_keys
+    values = [cast(literal(v), key.type) for key, v in zip(sort_keys, decode_cursor(cursor, len(sort_keys)))]
+    return tuple_(*sort_keys) < tuple_(*values) if descending else tuple_(*sort_keys) > tuple_(*values)
+
+
+def export_criteria(model, filter: ExportFilter):
+    return and_(
+        (model.created_at > filter.created_after) if filter.created_after is not None else True,
+        (model.updated_at > filter.updated_after) if filter.updated_after is not None else True
+    )
+
+
 def _craft_already_exists_error_message(model: Base, raw_sql_error_msg: str) -> str:
     err_msg = f"{model.__name__} with the given attributes already exists"
 
@@ -1,9 +1,50 @@
-from sqlalchemy import and_
+from datetime import datetime
 
-from src.crud.base import Creatable
+from sqlalchemy import and_, select, delete, insert, text, func, Row, exists
+from sqlalchemy.orm import aliased
+from sqlalchemy.exc import IntegrityError
+
+from src.crud.base import Creatable, _craft_doesnt_exist_error_message
+from src.custom_exceptions import ResourceDoesNotExistError
 from src.db import models
 from src.db.models import CartItem
 
+# first key of the advisory locks of the carts, the second one is the user id
+CART_LOCK_NAMESPACE = 1
+
+# Positive deltas are upserted, negative ones decrease the quantity or delete the item once it reaches zero.
+# The three modifications touch disjoint rows, so they can share a single statement.
+_APPLY_DELTAS_QUERY = text("""
+    WITH deltas AS (
+        SELECT *
+        FROM unnest(CAST(:product_ids AS INTEGER[]), CAST(:deltas AS INTEGER[])) AS d(product_id, delta)
+    ), added AS (
+        INSERT INTO cart_items (user_id, product_id, quantity)
+        SELECT CAST(:user_id AS INTEGER), product_id, delta
+        FROM deltas
+        WHERE delta > 0
+        ON CONFLICT (user_id, product_id) DO UPDATE
+            SET quantity = cart_items.quantity + excluded.quantity,
+                updated_at = now() AT TIME ZONE 'utc'
+        RETURNING product_id
+    ), decreased AS (
+        UPDATE cart_items AS c
+        SET quantity = c.quantity + d.delta,
+            updated_at = now() AT TIME ZONE 'utc'
+        FROM deltas AS d
+        WHERE c.user_id = :user_id AND c.product_id = d.product_id
+          AND d.delta < 0 AND c.quantity + d.delta > 0
+        RETURNING c.product_id
+    ), removed AS (
+        DELETE FROM cart_items AS c
+        USING deltas AS d
+        WHERE c.user_id = :user_id AND c.product_id = d.product_id
+          AND d.delta < 0 AND c.quantity + d.delta <= 0
+        RETURNING c.product_id
+    )
+    SELECT (SELECT count(*) FROM added) + (SELECT count(*) FROM decreased) + (SELECT count(*) FROM removed)
+""")
+
 
 class CartItemCRUD(Creatable):
     model = models.CartItem
@@ -13,8 +54,81 @@ class CartItemCRUD(Creatable):
         return await self._get_one(and_(self.__class__.model.user_id == user_id,
                                         self.__class__.model.product_id == product_id))
 
-    async def get_all_by_user_id(self, user_id: int) -> list[CartItem]:
-        return await self._get_all(self.__class__.model.user_id == user_id)
+    # The items with their unit and line prices, each row also carries the total of the whole cart.
+    # Everything is computed by the database, no product is loaded.
+    async def get_lines(self, user_id: int) -> list[Row]:
+        cart_item, product = self.__class__.model, models.Product
+        line_total = product.final_price * cart_item.quantity
+        result = await self.db.execute(
+            select(cart_item.product_id,
+                   cart_item.quantity,
+                   product.final_price.label('unit_price'),
+                   line_total.label('total_price'),
+                   func.sum(line_total).over().label('cart_total'))
+            .join(product, product.id == cart_item.product_id)
+            .where(cart_item.user_id == user_id)
+            .order_by(cart_item.product_id)
+        )
+        return list(result.all())
+
+    # deltas maps product ids to the (non-zero) change of their quantity, returns the number of affected items
+    async def apply_deltas(self, user_id: int, deltas: dict[int, int]) -> int:
+        try:
+            result = await self.db.execute(_APPLY_DELTAS_QUERY, {
+                'user_id': user_id,
+                'product_ids': list(deltas),
+                'deltas': list(deltas.values()),
+            })
+        except IntegrityError as e:
+            raise ResourceDoesNotExistError(_craft_doesnt_exist_error_message(self.__class__.model, str(e.orig)))
+        return result.scalar_one()
+
+    async def get_quantities(self, user_id: int) -> dict[int, int]:
+        result = await self.db.execute(select(self.__class__.model.product_id, self.__class__.model.quantity)
+                                       .where(self.__class__.model.user_id == user_id))
+        return dict(result.tuples().all())
+
+    # Serializes the writers of the given carts until the end of the transaction. The locks are taken in
+    # the order of the user ids (the target list is evaluated after the sort), so two batches cannot deadlock.
+    async def lock_carts(self, user_ids: list[int]):
+        if user_ids:
+            await self.db.execute(text("""
+                SELECT pg_advisory_xact_lock(:namespace, user_id)
+                FROM unnest(CAST(:user_ids AS integer[])) AS user_id
+                ORDER BY user_id
+            """), {"namespace": CART_LOCK_NAMESPACE, "user_ids": user_ids})
+
+    # overwrites the stored carts of the given users, items of products deleted in the meantime are skipped
+    async def replace_carts(self, carts: dict[int, dict[int, int]]):
+        if not carts:
+            return
+        cart_item = self.__class__.model
+        await self.db.execute(delete(cart_item).where(cart_item.user_id.in_(carts)))
+
+        product_ids = {product_id for quantities in carts.values() for product_id in quantities}
+        existing = set((await self.db.execute(
+            select(models.Product.id).where(models.Product.id.in_(product_ids))
+        )).scalars().all()) if product_ids else set()
+        rows = [{'user_id': user_id, 'product_id': product_id, 'quantity': quantity}
+                for user_id, quantities in carts.items()
+                for product_id, quantity in quantities.items() if product_id in existing]
+        if rows:
+            await self.db.execute(insert(cart_item), rows)
+
+    # Deletes a batch of carts none of whose items changed since the cutoff, returns the ids of their users.
+    async def purge_idle(self, changed_before: datetime, limit: int) -> list[int]:
+        cart_item = self.__class__.model
+        fresh = aliased(cart_item)
+        idle = (select(cart_item.user_id)
+                .where(cart_item.updated_at < changed_before,
+                       ~exists().where(fresh.user_id == cart_item.user_id, fresh.updated_at >= changed_before))
+                .distinct()
+                .limit(limit))
+        result = await self.db.execute(delete(cart_item)
+                                       .where(cart_item.user_id.in_(idle))
+                                       .returning(cart_item.user_id)
+                                       .execution_options(synchronize_session=False))
+        return sorted(set(result.scalars().all()))
 
     async def delete_all_by_user_id(self, user_id: int):
         items = await self._get_all(self.__class__.model.user_id == user_id)
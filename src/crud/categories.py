@@ -1,3 +1,5 @@
+from sqlalchemy import select
+
 from src.crud.base import Retrievable, Deletable, Creatable
 from src.db import models
 
@@ -5,3 +7,7 @@ from src.db import models
 class CategoryCRUD(Creatable, Retrievable, Deletable):
     model = models.Category
     key = models.Category.id
+
+    async def get_existing_names(self, names: set[str]) -> set[str]:
+        result = await self.db.execute(select(models.Category.name).where(models.Category.name.in_(names)))
+        return set(result.scalars().all())
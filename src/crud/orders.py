@@ -1,25 +1,79 @@
-from sqlalchemy import and_
+from datetime import datetime
 
-from src.crud.base import Retrievable, Creatable, Deletable
+from sqlalchemy import and_, select, update, Row
+from sqlalchemy.orm import selectinload
+
+from src.crud.base import Retrievable, Creatable, Updatable, Deletable, Page, export_criteria
+from src.custom_types import OrderStatus
 from src.db import models
-from src.schemas.filtration import PaginationParams, OrderFilter
+from src.schemas.filtration import PaginationParams, OrderFilter, ExportFilter
 
 
-class OrderCRUD(Creatable, Retrievable, Deletable):
+class OrderCRUD(Creatable, Retrievable, Updatable, Deletable):
     model = models.Order
     key = models.Order.id
+    loader_profiles = {
+        'detail': [selectinload(models.Order.items)],
+        # the payment line items are named after the products
+        'checkout': [selectinload(models.Order.items)
+                     .selectinload(models.OrderItem.product)
+                     .load_only(models.Product.title)],
+    }
 
-    async def get_by_user(self, user_id: int) -> list[models.Order] | None:
-        return await self._get_all(self.__class__.model.user_id == user_id)
+    async def get_by_user(self, user_id: int, *, profile: str | None = 'detail') -> list[models.Order] | None:
+        return await self._get_all(self.__class__.model.user_id == user_id, profile=profile)
 
     async def get_all(self,
                       pagination: PaginationParams = None,
-                      filter: OrderFilter = None) -> list[models.Order] | None:
+                      filter: OrderFilter = None,
+                      profile: str | None = 'detail') -> Page:
         return await self._get_all(
             and_(
                 (self.__class__.model.status == filter.status) if filter.status is not None else True,
+                (self.__class__.model.refund_due == filter.refund_due) if filter.refund_due is not None else True,
                 (self.__class__.model.created_at >= filter.created_after) if filter.created_after is not None else True
             ) if filter is not None else True,
-            order_by=self.__class__.model.created_at,
+            order_by=(self.__class__.model.created_at, self.__class__.model.id),
             pagination=pagination,
+            profile=profile
+        )
+
+    def stream_all(self, filter: ExportFilter, *, batch_size: int):
+        return self._stream_all(
+            export_criteria(self.__class__.model, filter),
+            order_by=self.__class__.key,
+            batch_size=batch_size,
+            profile='detail'
         )
+
+    # Cancels a batch of the unpaid pending orders placed before the cutoff, the ones locked by a request
+    # (e.g. a payment being confirmed) are skipped. Returns the ids and users of the cancelled orders.
+    async def cancel_stale(self, placed_before: datetime, limit: int) -> list[Row]:
+        order = self.__class__.model
+        stale = (select(order.id)
+                 .where(order.status == OrderStatus.PENDING, order.is_paid.is_(False), order.created_at < placed_before)
+                 .order_by(order.created_at)
+                 .limit(limit)
+                 .with_for_update(skip_locked=True))
+        result = await self.db.execute(update(order)
+                                       .where(order.id.in_(stale))
+                                       .values(status=OrderStatus.CANCELLED, version=order.version + 1)
+                                       .returning(order.id, order.user_id)
+                                       .execution_options(synchronize_session=False))
+        return list(result.all())
+
+    # order id -> product id -> quantity
+    async def get_item_quantities(self, order_ids: list[int]) -> dict[int, dict[int, int]]:
+        item = models.OrderItem
+        result = await self.db.execute(select(item.order_id, item.product_id, item.quantity)
+                                       .where(item.order_id.in_(order_ids)))
+        quantities: dict[int, dict[int, int]] = {}
+        for order_id, product_id, quantity in result.tuples():
+            quantities.setdefault(order_id, {})[product_id] = quantity
+        return quantities
+
+    # checkout id -> id of the order it placed, for the given checkouts that have placed one
+    async def get_ids_by_checkout(self, checkout_ids: list[str]) -> dict[str, int]:
+        order = self.__class__.model
+        result = await self.db.execute(select(order.checkout_id, order.id).where(order.checkout_id.in_(checkout_ids)))
+        return dict(result.tuples().all())
@@ -1,44 +1,455 @@
-from sqlalchemy import and_, func, desc, select
+from sqlalchemy import and_, func, desc, select, update, text, Float, values, column, Integer, delete, insert
+from sqlalchemy.dialects.postgresql import array, JSON
+from sqlalchemy.orm import selectinload, load_only, undefer
 
-from src.crud.base import Retrievable, Updatable, Deletable, Creatable
+from src.config import rules, settings
+from src.crud.base import Retrievable, Updatable, Deletable, Creatable, Page, after_cursor, encode_cursor, \
+    export_criteria
 from src.db import models
 from src.db.models import product_category_association
-from src.schemas.filtration import PaginationParams
+from src.schemas.filtration import PaginationParams, ExportFilter
+from src.schemas.product import SearchFacets, CategoryFacet, PriceBucket, ProductImportRow
+
+
+_IMPORT_COLUMNS = ['sku', 'title', 'description', 'quantity', 'full_price', 'discount', 'is_active', 'categories']
+
+
+class SearchPage(Page):
+    def __init__(self, items=(), next_cursor: str | None = None, *, facets: SearchFacets | None = None):
+        super().__init__(items, next_cursor)
+        self.facets = facets
 
 
 class ProductCRUD(Creatable, Retrievable, Updatable, Deletable):
     model = models.Product
     key = models.Product.id
+    loader_profiles = {
+        # just the columns rendered by ProductOut (updated_at keys the fragment cache)
+        'list': [load_only(models.Product.title, models.Product.description, models.Product.full_price,
+                           models.Product.discount, models.Product.images, models.Product.rating_sum,
+                           models.Product.rating_count, models.Product.updated_at)],
+        'detail': [selectinload(models.Product.categories)],
+        'export': [selectinload(models.Product.categories), undefer(models.Product.stock)],
+    }
 
     async def get_all(self, ids: list[int] = None, *,
                       pagination: PaginationParams = None,
                       is_active: bool | None = None,
                       order_by=None,
-                      for_update=False) -> list[models.Product] | None:
+                      for_update=False,
+                      profile: str | None = None) -> Page:
         return await self._get_all(and_(
             models.Product.id.in_(ids) if ids is not None else True,
             models.Product.is_active == is_active if is_active is not None else True
-        ), pagination=pagination, order_by=order_by or self.__class__.key, for_update=for_update)
+        ), pagination=pagination, order_by=order_by or self.__class__.key, for_update=for_update, profile=profile)
+
+    async def get_final_prices(self, ids: list[int]) -> dict[int, int]:
+        result = await self.db.execute(select(models.Product.id, models.Product.final_price)
+                                       .where(models.Product.id.in_(ids)))
+        return dict(result.tuples().all())
+
+    # the stock of the given products, or of a page of all of them ordered by id
+    async def get_stock(self, ids: list[int] = None, *, after_id: int = 0, limit: int = None) -> dict[int, int]:
+        product = models.Product
+        query = select(product.id, product.stock).order_by(product.id)
+        if ids is not None:
+            query = query.where(product.id.in_(ids))
+        else:
+            query = query.where(product.id > after_id).limit(limit)
+        return dict((await self.db.execute(query)).tuples().all())
+
+    # Takes the quantities from the stock of the products that have enough of it, without a preceding
+    # SELECT ... FOR UPDATE. Returns the ids of the decremented products, the others are left untouched.
+    async def decrement_stock(self, quantities: dict[int, int]) -> set[int]:
+        product = models.Product
+        requested = _quantities_table(quantities)
+        result = await self.db.execute(
+            update(product)
+            .where(product.id == requested.c.product_id,
+                   product.is_sharded.is_(False),
+                   product.quantity >= requested.c.quantity)
+            .values(quantity=product.quantity - requested.c.quantity, version=product.version + 1)
+            .returning(product.id)
+            .execution_options(synchronize_session=False)
+        )
+        decremented = set(result.scalars().all())
+
+        # the rest are sharded products or out of stock
+        if rest := _without(quantities, decremented):
+            decremented |= await self._decrement_random_shards(rest)
+        if rest := _without(quantities, decremented):
+            decremented |= await self._decrement_rebalancing_shards(rest)
+        return decremented
+
+    async def increment_stock(self, quantities: dict[int, int]):
+        product = models.Product
+        returned = _quantities_table(quantities)
+        result = await self.db.execute(
+            update(product)
+            .where(product.id == returned.c.product_id, product.is_sharded.is_(False))
+            .values(quantity=product.quantity + returned.c.quantity, version=product.version + 1)
+            .returning(product.id)
+            .execution_options(synchronize_session=False)
+        )
+        if not (rest := _without(quantities, set(result.scalars().all()))):
+            return
+
+        # the stock of a sharded product goes back to its emptiest shard
+        shard = models.StockShard
+        returned = _quantities_table(rest)
+        emptiest = (select(shard.product_id, shard.shard, returned.c.quantity)
+                    .join(returned, returned.c.product_id == shard.product_id)
+                    .distinct(shard.product_id)
+                    .order_by(shard.product_id, shard.quantity)
+                    .subquery())
+        await self.db.execute(
+            update(shard)
+            .where(shard.product_id == emptiest.c.product_id, shard.shard == emptiest.c.shard)
+            .values(quantity=shard.quantity + emptiest.c.quantity)
+            .execution_options(synchronize_session=False)
+        )
+
+    # Concurrent orders of a sharded product pick random shards, so they rarely wait for each other.
+    # Only a shard that can cover the whole quantity is picked, and it is checked again once locked.
+    async def _decrement_random_shards(self, quantities: dict[int, int]) -> set[int]:
+        shard = models.StockShard
+        requested = _quantities_table(quantities)
+        picked = (select(shard.product_id, shard.shard, requested.c.quantity)
+                  .join(requested, requested.c.product_id == shard.product_id)
+                  .where(shard.quantity >= requested.c.quantity)
+                  .distinct(shard.product_id)
+                  .order_by(shard.product_id, func.random())
+                  .subquery())
+        result = await self.db.execute(
+            update(shard)
+            .where(shard.product_id == picked.c.product_id,
+                   shard.shard == picked.c.shard,
+                   shard.quantity >= picked.c.quantity)
+            .values(quantity=shard.quantity - picked.c.quantity)
+            .returning(shard.product_id)
+            .execution_options(synchronize_session=False)
+        )
+        return set(result.scalars().all())
+
+    # No single shard could cover the quantity (they are drained or the quantity is large): with all
+    # the shards of the product locked the quantity is taken from their sum, and the rest is spread
+    # evenly again, which refills the drained shards.
+    async def _decrement_rebalancing_shards(self, quantities: dict[int, int]) -> set[int]:
+        shards = await self._lock_shards(list(quantities))
+        totals = {product_id: sum(stock) - quantities[product_id]
+                  for product_id, stock in shards.items() if sum(stock) >= quantities[product_id]}
+        await self._update_shards(totals, {product_id: len(shards[product_id]) for product_id in totals})
+        return set(totals)
+
+    # Moves the whole stock of a product into the given number of shards.
+    async def shard_stock(self, product_id: int, count: int):
+        product = models.Product
+        shard = models.StockShard
+        quantity, shards = (await self._lock_stock([product_id]))[product_id]
+        await self.db.execute(delete(shard).where(shard.product_id == product_id))
+        await self.db.execute(insert(shard), _spread({product_id: quantity + sum(shards)}, {product_id: count}))
+        await self.db.execute(update(product)
+                              .where(product.id == product_id)
+                              .values(quantity=0, is_sharded=True, version=product.version + 1)
+                              .execution_options(synchronize_session=False))
+
+    # Moves the stock of a sharded product back into products.quantity.
+    async def unshard_stock(self, product_id: int):
+        product = models.Product
+        shard = models.StockShard
+        quantity, shards = (await self._lock_stock([product_id]))[product_id]
+        await self.db.execute(delete(shard).where(shard.product_id == product_id))
+        await self.db.execute(update(product)
+                              .where(product.id == product_id)
+                              .values(quantity=quantity + sum(shards), is_sharded=False,
+                                      version=product.version + 1)
+                              .execution_options(synchronize_session=False))
+
+    # Spreads the stock of the sharded ones among the products evenly over their shards. With replace,
+    # a quantity just written to products.quantity (an absolute stock update) replaces the stock
+    # of the shards, otherwise it is added to it. The product versions are left alone: the total stock
+    # stays the same, or the write that replaced it has bumped them already.
+    async def rebalance_stock_shards(self, product_ids: list[int], *, replace: bool = False):
+        product = models.Product
+        stock = {product_id: (quantity, shards)
+                 for product_id, (quantity, shards) in (await self._lock_stock(product_ids)).items() if shards}
+        if not stock:
+            return
+        await self._update_shards(
+            {product_id: quantity + (0 if replace else sum(shards)) for product_id, (quantity, shards) in stock.items()},
+            {product_id: len(shards) for product_id, (_, shards) in stock.items()}
+        )
+        await self.db.execute(update(product)
+                              .where(product.id.in_(list(stock)))
+                              .values(quantity=0)
+                              .execution_options(synchronize_session=False))
+
+    # products.quantity and the shard quantities of the products, locked in that order
+    async def _lock_stock(self, product_ids: list[int]) -> dict[int, tuple[int, list[int]]]:
+        product = models.Product
+        result = await self.db.execute(select(product.id, product.quantity)
+                                       .where(product.id.in_(product_ids))
+                                       .order_by(product.id)
+                                       .with_for_update())
+        shards = await self._lock_shards(product_ids)
+        return {product_id: (quantity, shards.get(product_id, [])) for product_id, quantity in result.tuples()}
+
+    async def _lock_shards(self, product_ids: list[int]) -> dict[int, list[int]]:
+        shard = models.StockShard
+        result = await self.db.execute(select(shard.product_id, shard.quantity)
+                                       .where(shard.product_id.in_(product_ids))
+                                       .order_by(shard.product_id, shard.shard)
+                                       .with_for_update())
+        shards: dict[int, list[int]] = {}
+        for product_id, quantity in result.tuples():
+            shards.setdefault(product_id, []).append(quantity)
+        return shards
+
+    # the rows are updated in place, so orders waiting for a shard lock re-check the new quantity
+    async def _update_shards(self, totals: dict[int, int], counts: dict[int, int]):
+        if not totals:
+            return
+        shard = models.StockShard
+        rows = (values(column('product_id', Integer), column('shard', Integer), column('quantity', Integer),
+                       name='shards')
+                .data([(row['product_id'], row['shard'], row['quantity']) for row in _spread(totals, counts)]))
+        await self.db.execute(
+            update(shard)
+            .where(shard.product_id == rows.c.product_id, shard.shard == rows.c.shard)
+            .values(quantity=rows.c.quantity)
+            .execution_options(synchronize_session=False)
+        )
+
+    def stream_all(self, filter: ExportFilter, *, batch_size: int):
+        return self._stream_all(
+            export_criteria(self.__class__.model, filter),
+            order_by=self.__class__.key,
+            batch_size=batch_size,
+            profile='export'
+        )
 
     async def search(self, query: str, *,
                      category_ids: list[int] | None = None,
-                     pagination: PaginationParams = None) -> list[models.Product]:
-        ts_query = func.plainto_tsquery('english', query)
-        tsvector = func.to_tsvector('english', models.Product.title + ' ' + models.Product.description)
-        rank = func.ts_rank(tsvector, ts_query)
+                     pagination: PaginationParams = None,
+                     with_facets: bool = False) -> SearchPage:
+        product = models.Product
+        assoc = product_category_association
+
+        ts_query = func.websearch_to_tsquery('english', query)
+        rank = func.ts_rank(product.search_vector, ts_query, type_=Float)
+        sort_keys = [rank, product.id]
+
+        text_match = and_(product.search_vector.op('@@')(ts_query), product.is_active == True)
+        category_match = product.id.in_(
+            select(assoc.c.product_id).where(assoc.c.category_id.in_(category_ids))
+        ) if category_ids else True
+
+        facets = self._search_facets(text_match, category_match) if with_facets else None
+
+        stmt = (select(product, rank, *([facets.label('facets')] if with_facets else []))
+                .options(*self._loader_options('list')))
+        stmt = stmt.where(text_match, category_match)
+        if pagination and pagination.cursor:
+            stmt = stmt.where(after_cursor(sort_keys, pagination.cursor, descending=True))
+            stmt = stmt.limit(pagination.limit)
+        else:
+            stmt = stmt.limit(pagination and pagination.limit).offset(pagination and pagination.offset)
+        stmt = stmt.order_by(desc(rank), desc(product.id))
+
+        rows = (await self.db.execute(stmt)).all()
+
+        next_cursor = None
+        if pagination and len(rows) == pagination.limit:
+            next_cursor = encode_cursor([rows[-1][1], rows[-1][0].id])
+
+        search_facets = None
+        if with_facets:
+            # the facets ride along with every hit, only a page past the last hit needs them fetched separately
+            raw_facets = rows[0].facets if rows else (await self.db.execute(select(facets))).scalar_one()
+            search_facets = _build_search_facets(raw_facets)
+
+        return SearchPage((row[0] for row in rows), next_cursor, facets=search_facets)
+
+    # Aggregates over all the matches of a search, computed by postgres as a single json value.
+    # Category counts ignore the category filter, so the sidebar can still offer the other categories.
+    @staticmethod
+    def _search_facets(text_match, category_match):
+        product = models.Product
+        assoc = product_category_association
+
+        text_matches = select(product.id).where(text_match).cte('text_matches')
+        matches = (select(product.id, product.final_price.label('final_price'), product.stock.label('quantity'))
+                   .where(text_match, category_match)
+                   .cte('matches'))
+
+        category_counts = (select(assoc.c.category_id, func.count().label('count'))
+                           .join(text_matches, text_matches.c.id == assoc.c.product_id)
+                           .group_by(assoc.c.category_id)
+                           .subquery())
+        price_bucket = func.width_bucket(matches.c.final_price, array(settings.SEARCH_PRICE_BUCKETS))
+        price_counts = (select(price_bucket.label('bucket'), func.count().label('count'))
+                        .group_by(price_bucket)
+                        .subquery())
+
+        return select(func.json_build_object(
+            'total', select(func.count()).select_from(matches).scalar_subquery(),
+            'in_stock', select(func.count()).where(matches.c.quantity > 0).scalar_subquery(),
+            'categories', select(func.coalesce(
+                func.json_agg(func.json_build_object('category_id', category_counts.c.category_id,
+                                                     'count', category_counts.c.count)),
+                text("'[]'::json")
+            )).scalar_subquery(),
+            'prices', select(func.coalesce(
+                func.json_object_agg(price_counts.c.bucket, price_counts.c.count),
+                text("'{}'::json")
+            )).scalar_subquery(),
+            type_=JSON
+        )).scalar_subquery()
+
+    # Loads the rows into a staging table with COPY and upserts them (matched by sku) together with
+    # their category links in one statement. Returns the number of created and updated products.
+    # Runs within a savepoint, so a rejected chunk leaves the surrounding transaction usable.
+    async def bulk_upsert(self, rows: list[tuple[int, ProductImportRow]]) -> tuple[int, int]:
+        async with self.db.begin_nested():
+            return await self._bulk_upsert(rows)
+
+    async def _bulk_upsert(self, rows: list[tuple[int, ProductImportRow]]) -> tuple[int, int]:
+        connection = await self.db.connection()
+        await connection.execute(text("""
+            CREATE TEMP TABLE IF NOT EXISTS product_import_staging (
+                line INTEGER,
+                sku TEXT,
+                title TEXT,
+                description TEXT,
+                quantity INTEGER,
+                full_price INTEGER,
+                discount INTEGER,
+                is_active BOOLEAN,
+                categories TEXT[]
+            ) ON COMMIT DROP
+        """))
+        await connection.execute(text("TRUNCATE product_import_staging"))
+
+        raw_connection = await connection.get_raw_connection()
+        await raw_connection.driver_connection.copy_records_to_table(
+            'product_import_staging',
+            columns=['line', *_IMPORT_COLUMNS],
+            records=[(line, *map(row.model_dump().get, _IMPORT_COLUMNS)) for line, row in rows]
+        )
+
+        result = await connection.execute(text("""
+            WITH latest AS (
+                -- a sku repeated within the chunk is imported from its last line
+                SELECT DISTINCT ON (sku) *
+                FROM product_import_staging
+                ORDER BY sku, line DESC
+            ), upserted AS (
+                INSERT INTO products AS p (sku, title, description, quantity, full_price, discount, is_active,
+                                           images, created_at, updated_at)
+                SELECT sku, title, description, quantity, full_price, discount, is_active,
+                       '[]'::jsonb, now() AT TIME ZONE 'utc', now() AT TIME ZONE 'utc'
+                FROM latest
+                ON CONFLICT (sku) DO UPDATE
+                    SET title = excluded.title,
+                        description = excluded.description,
+                        quantity = excluded.quantity,
+                        full_price = excluded.full_price,
+                        discount = excluded.discount,
+                        is_active = excluded.is_active,
+                        updated_at = excluded.updated_at,
+                        version = p.version + 1
+                RETURNING p.id, p.sku, p.is_sharded, (p.xmax = 0) AS created
+            ), linked AS (
+                INSERT INTO product_category_association (product_id, category_id)
+                SELECT upserted.id, categories.id
+                FROM upserted
+                JOIN latest ON latest.sku = upserted.sku
+                CROSS JOIN LATERAL unnest(latest.categories) AS category_name
+                JOIN categories ON categories.name = category_name
+                ON CONFLICT DO NOTHING
+            )
+            SELECT count(*) FILTER (WHERE created), count(*) FILTER (WHERE NOT created),
+                   coalesce(array_agg(id) FILTER (WHERE is_sharded), '{}')
+            FROM upserted
+        """))
+        created, updated, sharded = result.one()
+        # the imported quantity is the new stock of a sharded product as well
+        await self.rebalance_stock_shards(sharded, replace=True)
+        return created, updated
+
+    # weight=-1 withdraws a previously applied rating
+    async def add_rating(self, product_id: int, rating: int, *, weight: int = 1):
+        product = self.__class__.model
+        await self.db.execute(
+            update(product)
+            .where(product.id == product_id)
+            .values({
+                product.rating_sum: product.rating_sum + rating * weight,
+                product.rating_count: product.rating_count + weight,
+                product.rating_histogram[rating]: product.rating_histogram[rating] + weight,
+                # the rating is rendered, so the ETag of the product changes with it
+                product.version: product.version + 1,
+            })
+            .execution_options(synchronize_session=False)
+        )
+
+    # rebuilds the rating aggregates of every product from the reviews table
+    async def recompute_ratings(self) -> int:
+        result = await self.db.execute(text("""
+            UPDATE products AS p
+            SET rating_sum = coalesce(agg.rating_sum, 0),
+                rating_count = coalesce(agg.rating_count, 0),
+                updated_at = now() AT TIME ZONE 'utc',
+                version = p.version + 1,
+                rating_histogram = ARRAY(
+                    SELECT coalesce((agg.histogram ->> star::text)::integer, 0)
+                    FROM generate_series(0, :max_rating) AS star
+                    ORDER BY star
+                )
+            FROM products AS src
+            LEFT JOIN (
+                SELECT product_id,
+                       sum(rating * cnt) AS rating_sum,
+                       sum(cnt) AS rating_count,
+                       jsonb_object_agg(rating, cnt) AS histogram
+                FROM (
+                    SELECT product_id, rating, count(*) AS cnt
+                    FROM reviews
+                    GROUP BY product_id, rating
+                ) AS per_rating
+                GROUP BY product_id
+            ) AS agg ON agg.product_id = src.id
+            WHERE p.id = src.id
+        """), {"max_rating": rules.MAX_REVIEW_RATING})
+        return result.rowcount
+
+
+def _build_search_facets(raw_facets: dict) -> SearchFacets:
+    # width_bucket numbers the bands from 1, bucket 0 (below the lowest bound) cannot occur for prices >= 0
+    edges = settings.SEARCH_PRICE_BUCKETS
+    return SearchFacets(
+        total=raw_facets['total'],
+        in_stock=raw_facets['in_stock'],
+        categories=[CategoryFacet(**c) for c in raw_facets['categories']],
+        prices=[PriceBucket(min_price=lower,
+                            max_price=edges[i + 1] if i + 1 < len(edges) else None,
+                            count=raw_facets['prices'].get(str(i + 1), 0))
+                for i, lower in enumerate(edges)]
+    )
+
 
-        stmt = select(models.Product, rank).distinct()
+# rows in id order, so concurrent stock updates of the same products lock them in the same order
+def _quantities_table(quantities: dict[int, int]):
+    return (values(column('product_id', Integer), column('quantity', Integer), name='quantities')
+            .data(sorted(quantities.items())))
 
-        if category_ids:
-            assoc = product_category_association
 
-            stmt = stmt.join(assoc, models.Product.id == assoc.c.product_id)
-            stmt = stmt.where(assoc.c.category_id.in_(category_ids))
+def _without(quantities: dict[int, int], product_ids: set[int]) -> dict[int, int]:
+    return {product_id: quantity for product_id, quantity in quantities.items() if product_id not in product_ids}
 
-        stmt = stmt.where(and_(tsvector.op('@@')(ts_query),
-                               models.Product.is_active == True))
-        stmt = stmt.limit(pagination and pagination.limit).offset(pagination and pagination.offset)
-        stmt = stmt.order_by(desc(rank))
 
-        result = await self.db.execute(stmt)
-        return list(map(lambda x: x[0], result.all()))
+# shard rows with the totals split as evenly as possible
+def _spread(totals: dict[int, int], counts: dict[int, int]) -> list[dict]:
+    return [{'product_id': product_id, 'shard': shard, 'quantity': total // counts[product_id]
+             + (1 if shard < total % counts[product_id] else 0)}
+            for product_id, total in totals.items() for shard in range(counts[product_id])]
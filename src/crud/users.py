@@ -1,3 +1,5 @@
+from sqlalchemy import select, update
+
 from src.crud.base import Retrievable, Creatable
 from src.db import models
 
@@ -11,3 +13,14 @@ class UserCRUD(Creatable, Retrievable):
 
     async def get_by_idp_id(self, idp_id: str) -> models.User | None:
         return await self._get_one(models.User.identity_provider_id == idp_id)
+
+    async def get_token_version(self, user_id: int) -> int | None:
+        return await self.db.scalar(select(models.User.token_version).where(models.User.id == user_id))
+
+    # returns the new version, None if there is no such user
+    async def increment_token_version(self, user_id: int) -> int | None:
+        return await self.db.scalar(update(models.User)
+                                    .where(models.User.id == user_id)
+                                    .values(token_version=models.User.token_version + 1)
+                                    .returning(models.User.token_version)
+                                    .execution_options(synchronize_session=False))
@@ -65,3 +65,19 @@ class PaymentGatewayError(PetStoreApiError):
 
 class EmptyCartError(PetStoreApiError):
     pass
+
+
+class InvalidCursorError(PetStoreApiError):
+    pass
+
+
+class NotModifiedError(PetStoreApiError):
+    pass
+
+
+class VersionConflictError(PetStoreApiError):
+    pass
+
+
+class TooManyRequestsError(PetStoreApiError):
+    pass
@@ -1,6 +1,10 @@
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncAttrs
+from contextlib import asynccontextmanager
+from typing import Callable, Awaitable
+
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncAttrs, AsyncSession
 from sqlalchemy.orm import DeclarativeBase
 from src.config import settings
+from src.logger import logger
 
 engine = create_async_engine(settings.POSTGRESQL_DB_URL)
 
@@ -11,7 +15,56 @@ class Base(AsyncAttrs, DeclarativeBase):
     pass
 
 
+# schedules a callback (e.g. a cache invalidation) to run once the request transaction has been committed
+def after_commit(db: AsyncSession, callback: Callable[[], Awaitable]):
+    db.info.setdefault('after_commit', []).append(callback)
+
+
+async def run_after_commit_callbacks(db: AsyncSession):
+    for callback in db.info.pop('after_commit', []):
+        await callback()
+
+
+# schedules a compensation (e.g. releasing a redis stock hold) to run if the changes made since are rolled back
+def on_rollback(db: AsyncSession, callback: Callable[[], Awaitable]):
+    db.info.setdefault('on_rollback', []).append(callback)
+
+
+# runs the compensations registered since the start-th one; a failed compensation is logged, so it does not
+# replace the error that caused the rollback
+async def run_rollback_callbacks(db: AsyncSession, start: int = 0):
+    callbacks = db.info.get('on_rollback', [])
+    compensations = callbacks[start:]
+    del callbacks[start:]
+    for callback in reversed(compensations):
+        try:
+            await callback()
+        except Exception as e:
+            logger.error(f"Rollback compensation failed: {e}")
+
+
+# A savepoint whose after-commit callbacks are dropped and whose compensations are run if it is rolled back,
+# the enclosing transaction carries on without any trace of it.
+@asynccontextmanager
+async def savepoint(db: AsyncSession):
+    after_commit_start = len(db.info.get('after_commit', []))
+    on_rollback_start = len(db.info.get('on_rollback', []))
+    try:
+        async with db.begin_nested():
+            yield
+    except Exception:
+        del db.info.get('after_commit', [])[after_commit_start:]
+        await run_rollback_callbacks(db, on_rollback_start)
+        raise
+
+
 async def get_db():
     async with SessionLocal() as db:
-        yield db
-        await db.commit()
+        try:
+            yield db
+            await db.commit()
+        except Exception:
+            await run_rollback_callbacks(db)
+            raise
+        db.info.pop('on_rollback', None)
+        await run_after_commit_callbacks(db)
@@ -1,35 +1,157 @@
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncEngine
 
+from src.config import rules, settings
 from src.db import models
 
 
-# TODO: add support for ukrainian language
-async def create_product_fulltext_index(engine: AsyncEngine):
+# create_all does not alter existing tables, so columns added later are patched in here
+async def add_product_rating_columns(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        await conn.execute(text(f"""
+            ALTER TABLE products
+                ADD COLUMN IF NOT EXISTS rating_sum INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS rating_count INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS rating_histogram INTEGER[] NOT NULL
+                    DEFAULT array_fill(0, ARRAY[{rules.MAX_REVIEW_RATING + 1}]);
+        """))
+
+
+async def add_product_updated_at_column(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        await conn.execute(text("""
+            ALTER TABLE products
+                ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc');
+        """))
+
+
+async def add_product_sku_column(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        await conn.execute(text(f"""
+            ALTER TABLE products
+                ADD COLUMN IF NOT EXISTS sku VARCHAR({rules.MAX_PRODUCT_SKU_LENGTH});
+        """))
+
+
+async def add_product_is_sharded_column(engine: AsyncEngine):
     async with engine.begin() as conn:
         await conn.execute(text("""
-            DO $$
-            BEGIN
-                IF NOT EXISTS (
-                    SELECT 1
-                    FROM pg_indexes
-                    WHERE schemaname = 'public'
-                    AND indexname = 'idx_product_tsv'
-                ) THEN
-                    CREATE INDEX idx_product_tsv
-                    ON products
-                    USING gin(to_tsvector('english', title || ' ' || description));
-                END IF;
-            END
-            $$;
+            ALTER TABLE products
+                ADD COLUMN IF NOT EXISTS is_sharded BOOLEAN NOT NULL DEFAULT false;
         """))
 
 
+async def add_order_updated_at_column(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        await conn.execute(text("ALTER TABLE orders ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP"))
+        await conn.execute(text("UPDATE orders SET updated_at = created_at WHERE updated_at IS NULL"))
+        await conn.execute(text("""
+            ALTER TABLE orders
+                ALTER COLUMN updated_at SET DEFAULT (now() AT TIME ZONE 'utc'),
+                ALTER COLUMN updated_at SET NOT NULL;
+        """))
+
+
+async def add_cart_item_updated_at_column(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        await conn.execute(text("""
+            ALTER TABLE cart_items
+                ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc');
+        """))
+
+
+# backfills the totals of the orders placed before they were stored
+async def add_order_totals_columns(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        await conn.execute(text(f"""
+            ALTER TABLE orders
+                ADD COLUMN IF NOT EXISTS total_price INTEGER,
+                ADD COLUMN IF NOT EXISTS item_count INTEGER,
+                ADD COLUMN IF NOT EXISTS currency VARCHAR(3) NOT NULL DEFAULT '{settings.CURRENCY}';
+        """))
+        await conn.execute(text("""
+            UPDATE orders AS o
+            SET total_price = coalesce(totals.total_price, 0),
+                item_count = coalesce(totals.item_count, 0)
+            FROM orders AS src
+            LEFT JOIN (
+                SELECT order_id, sum(total_price) AS total_price, sum(quantity) AS item_count
+                FROM order_items
+                GROUP BY order_id
+            ) AS totals ON totals.order_id = src.id
+            WHERE o.id = src.id AND (o.total_price IS NULL OR o.item_count IS NULL)
+        """))
+        await conn.execute(text("""
+            ALTER TABLE orders
+                ALTER COLUMN total_price SET NOT NULL,
+                ALTER COLUMN item_count SET NOT NULL;
+        """))
+
+
+async def add_version_columns(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        for table in ('products', 'orders'):
+            await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1"))
+
+
+async def add_user_token_version_column(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        await conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS token_version INTEGER NOT NULL DEFAULT 0"))
+
+
+async def add_order_checkout_id_column(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        await conn.execute(text("ALTER TABLE orders ADD COLUMN IF NOT EXISTS checkout_id VARCHAR(32)"))
+
+
+async def add_order_refund_due_column(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        await conn.execute(text("ALTER TABLE orders ADD COLUMN IF NOT EXISTS refund_due BOOLEAN NOT NULL DEFAULT false"))
+
+
+async def add_product_search_vector(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        await conn.execute(text(f"""
+            ALTER TABLE products
+                ADD COLUMN IF NOT EXISTS search_vector TSVECTOR
+                    GENERATED ALWAYS AS ({models.PRODUCT_SEARCH_VECTOR}) STORED;
+        """))
+        # superseded by idx_product_search_vector
+        await conn.execute(text("DROP INDEX IF EXISTS idx_product_tsv"))
+
+
+# the refresh and recovery tokens live in the SessionStore now
+async def drop_token_tables(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        await conn.execute(text("DROP TABLE IF EXISTS refresh_tokens, recovery_tokens"))
+
+
 async def create_models(engine: AsyncEngine):
     async with engine.begin() as conn:
         await conn.run_sync(models.Base.metadata.create_all)
 
 
+# create_all skips the indexes of tables that already exist
+async def create_missing_indexes(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        for table in models.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                await conn.run_sync(index.create, checkfirst=True)
+
+
 async def init_db(engine: AsyncEngine):
     await create_models(engine)
-    await create_product_fulltext_index(engine)
+    await add_product_rating_columns(engine)
+    await add_product_updated_at_column(engine)
+    await add_product_sku_column(engine)
+    await add_product_is_sharded_column(engine)
+    await add_order_updated_at_column(engine)
+    await add_order_totals_columns(engine)
+    await add_cart_item_updated_at_column(engine)
+    await add_version_columns(engine)
+    await add_user_token_version_column(engine)
+    await add_order_checkout_id_column(engine)
+    await add_order_refund_due_column(engine)
+    await add_product_search_vector(engine)
+    await drop_token_tables(engine)
+    await create_missing_indexes(engine)
@@ -1,18 +1,24 @@
 from datetime import datetime, UTC
 from typing import Optional
 
-from sqlalchemy import Integer, String, TIMESTAMP, ForeignKey, Boolean, Table, Column
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import Integer, String, TIMESTAMP, ForeignKey, Boolean, Table, Column, Index, Computed, text, \
+    select, func
+from sqlalchemy.dialects.postgresql import JSONB, ARRAY, TSVECTOR
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import Mapped, declared_attr
+from sqlalchemy.orm import Mapped, declared_attr, column_property
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import relationship
 
-from src.config import rules
+from src.config import rules, settings
 from src.custom_types import OrderStatus
 from src.db.db import Base
 from src.schemas.item import Item
 
+# TODO: add support for ukrainian language
+# title matches (weight A) rank above description matches (weight B)
+PRODUCT_SEARCH_VECTOR = ("setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+                         "setweight(to_tsvector('english', coalesce(description, '')), 'B')")
+
 product_category_association = Table(
     'product_category_association', Base.metadata,
     Column('product_id', Integer, ForeignKey('products.id'), primary_key=True),
@@ -28,25 +34,13 @@ class User(Base):
     password: Mapped[Optional[str]] = mapped_column(String(rules.MAX_HASHED_PASSWORD_LENGTH), nullable=True)
     name: Mapped[str] = mapped_column(String(rules.MAX_USERNAME_LENGTH))
     is_admin: Mapped[bool] = mapped_column(Boolean, default=False)
+    # incremented to revoke every token issued to the user so far
+    token_version: Mapped[int] = mapped_column(default=0, server_default=text('0'))
 
     created_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=False),
                                                  default=lambda: datetime.now(UTC).replace(tzinfo=None))
 
 
-class TokenBase(Base):
-    __abstract__ = True
-    user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), primary_key=True)
-    token: Mapped[str] = mapped_column(String)
-
-
-class RefreshToken(TokenBase):
-    __tablename__ = 'refresh_tokens'
-
-
-class RecoveryToken(TokenBase):
-    __tablename__ = 'recovery_tokens'
-
-
 class ItemBase(Base):
     __abstract__ = True
     product_id: Mapped[int] = mapped_column(ForeignKey('products.id'), primary_key=True)
@@ -54,16 +48,21 @@ class ItemBase(Base):
 
     @declared_attr
     def product(cls) -> Mapped["Product"]:
-        return relationship('Product', lazy="selectin", uselist=False)
+        return relationship('Product', lazy='raise', uselist=False)
 
 
 class CartItem(ItemBase):
     __tablename__ = 'cart_items'
+    __table_args__ = (
+        # the reaper purges carts none of whose items changed recently
+        Index('idx_cart_items_updated_at', 'updated_at'),
+        Index('idx_cart_items_user_id_updated_at', 'user_id', 'updated_at'),
+    )
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), primary_key=True)
-
-    @hybrid_property
-    def total_price(self):
-        return self.product.final_price * self.quantity
+    updated_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=False),
+                                                 default=lambda: datetime.now(UTC).replace(tzinfo=None),
+                                                 onupdate=lambda: datetime.now(UTC).replace(tzinfo=None),
+                                                 server_default=text("(now() AT TIME ZONE 'utc')"))
 
 
 class OrderItem(ItemBase):
@@ -74,28 +73,69 @@ class OrderItem(ItemBase):
 
 class Order(Base):
     __tablename__ = 'orders'
+    __table_args__ = (
+        # keyset pagination of the admin order listing
+        Index('idx_orders_created_at_id', 'created_at', 'id'),
+        # incremental exports
+        Index('idx_orders_updated_at', 'updated_at'),
+        # the reaper looks for unpaid pending orders by age
+        Index('idx_orders_unpaid_pending_created_at', 'created_at',
+              postgresql_where=text("status = 'PENDING' AND is_paid IS false")),
+        # a queued checkout places at most one order, however often it is delivered
+        Index('idx_orders_checkout_id', 'checkout_id', unique=True),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
     status: Mapped[OrderStatus] = mapped_column(default=OrderStatus.PENDING)
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'))
     is_paid: Mapped[bool] = mapped_column(default=False)
+    # paid for although it could not be fulfilled (e.g. cancelled in the meantime), the payment is to be refunded
+    refund_due: Mapped[bool] = mapped_column(default=False, server_default=text('false'))
+    # stored when the order is placed, so listings need not load the items
+    total_price: Mapped[int]
+    # the number of units over all the items
+    item_count: Mapped[int]
+    currency: Mapped[str] = mapped_column(String(3))
+    # the queued checkout that placed the order, if any
+    checkout_id: Mapped[Optional[str]] = mapped_column(String(32), nullable=True)
     created_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=False),
                                                  default=lambda: datetime.now(UTC).replace(tzinfo=None))
+    updated_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=False),
+                                                 default=lambda: datetime.now(UTC).replace(tzinfo=None),
+                                                 onupdate=lambda: datetime.now(UTC).replace(tzinfo=None))
 
-    items: Mapped[list["OrderItem"]] = relationship('OrderItem', lazy='selectin', cascade="all, delete-orphan")
+    # incremented by every update, the ORM updates only a row still at the version it has read
+    version: Mapped[int] = mapped_column(default=1, server_default=text('1'))
 
-    @hybrid_property
-    def total_price(self):
-        return sum(item.total_price for item in self.items)
+    items: Mapped[list["OrderItem"]] = relationship('OrderItem', lazy='raise', cascade="all, delete-orphan")
+
+    __mapper_args__ = {'version_id_col': version}
 
-    def __init__(self, user_id: int, items: list[Item]):
+    def __init__(self, user_id: int, items: list[Item], currency: str = settings.CURRENCY):
         super().__init__()
         self.user_id = user_id
         self.items = [OrderItem(**item.model_dump()) for item in items]
+        self.total_price = sum(item.total_price for item in items)
+        self.item_count = sum(item.quantity for item in items)
+        self.currency = currency
+
+
+# The discount formula behind Product.final_price, used for both the python value and the sql expression.
+# Integer arithmetic keeps the two identical.
+def discounted_price(full_price, discount):
+    return full_price * (100 - discount) // 100
 
 
 class Product(Base):
     __tablename__ = 'products'
+    __table_args__ = (
+        Index('idx_product_search_vector', 'search_vector', postgresql_using='gin'),
+        Index('idx_products_sku', 'sku', unique=True),
+        # incremental exports
+        Index('idx_products_updated_at', 'updated_at'),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # supplier identifier, used to match rows of bulk imports with existing products
+    sku: Mapped[Optional[str]] = mapped_column(String(rules.MAX_PRODUCT_SKU_LENGTH), nullable=True)
     title: Mapped[str] = mapped_column(String(rules.MAX_PRODUCT_TITLE_LENGTH))
     description: Mapped[str] = mapped_column(String(rules.MAX_PRODUCT_DESCRIPTION_LENGTH))
     quantity: Mapped[int]
@@ -103,24 +143,64 @@ class Product(Base):
     discount: Mapped[int] = mapped_column(default=0)
     created_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=False),
                                                  default=lambda: datetime.now(UTC).replace(tzinfo=None))
+    updated_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=False),
+                                                 default=lambda: datetime.now(UTC).replace(tzinfo=None),
+                                                 onupdate=lambda: datetime.now(UTC).replace(tzinfo=None),
+                                                 server_default=text("(now() AT TIME ZONE 'utc')"))
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
+    # the stock of a sharded product is spread over its stock_shards rows (quantity is normally 0),
+    # so concurrent orders of a hot product decrement different rows
+    is_sharded: Mapped[bool] = mapped_column(Boolean, default=False, server_default=text('false'))
+    # incremented by every update, including the stock updates issued as plain UPDATE statements
+    # (the shards of a sharded product are not covered)
+    version: Mapped[int] = mapped_column(default=1, server_default=text('1'))
 
     images: Mapped[list[str]] = mapped_column(JSONB, default=list)
 
-    reviews: Mapped[list["Review"]] = relationship('Review', lazy='selectin')
+    search_vector: Mapped[str] = mapped_column(TSVECTOR, Computed(PRODUCT_SEARCH_VECTOR, persisted=True),
+                                               deferred=True)
+
+    # rating aggregates are maintained by the review write path (see ProductCRUD.add_rating)
+    rating_sum: Mapped[int] = mapped_column(default=0, server_default=text('0'))
+    rating_count: Mapped[int] = mapped_column(default=0, server_default=text('0'))
+    # rating_histogram[n] is the number of reviews with rating n
+    rating_histogram: Mapped[list[int]] = mapped_column(
+        ARRAY(Integer, zero_indexes=True),
+        default=lambda: [0] * (rules.MAX_REVIEW_RATING + 1),
+        server_default=text(f'array_fill(0, ARRAY[{rules.MAX_REVIEW_RATING + 1}])')
+    )
+
+    reviews: Mapped[list["Review"]] = relationship('Review', lazy='raise')
 
     categories: Mapped[list["Category"]] = relationship('Category',
-                                                        lazy='select',
+                                                        lazy='raise',
                                                         secondary=product_category_association)
 
-    # TODO: Shift computation from read time to write time 
+    __mapper_args__ = {'version_id_col': version}
+
     @hybrid_property
     def rating(self):
-        return round(sum(review.rating for review in self.reviews) / len(self.reviews), 1) if self.reviews else 0
+        return round(self.rating_sum / self.rating_count, 1) if self.rating_count else 0
 
     @hybrid_property
     def final_price(self):
-        return int(self.full_price * (1 - self.discount / 100))
+        return discounted_price(self.full_price, self.discount)
+
+
+class StockShard(Base):
+    __tablename__ = 'stock_shards'
+    product_id: Mapped[int] = mapped_column(ForeignKey('products.id', ondelete='CASCADE'), primary_key=True)
+    shard: Mapped[int] = mapped_column(primary_key=True)
+    quantity: Mapped[int]
+
+
+# the whole stock of a product, sharded or not
+Product.stock = column_property(
+    Product.quantity + func.coalesce(select(func.sum(StockShard.quantity))
+                                     .where(StockShard.product_id == Product.id)
+                                     .scalar_subquery(), 0),
+    deferred=True
+)
 
 
 class Category(Base):
@@ -1,28 +1,42 @@
+import hashlib
 from typing import Annotated
 
-from fastapi import Depends
+from fastapi import Depends, Request, Response
 from fastapi.security import OAuth2PasswordBearer
 from redis import Redis
 from sqlalchemy.ext.asyncio import AsyncSession
 from aiohttp import ClientSession
 
+from src.cart_store import CartStore, RedisCartStore, DatabaseCartStore, ProductPriceCache
+from src.catalog_cache import CatalogCache
+from src.checkout_queue import CheckoutQueue
 from src.clients.http_client import get_http_client
 from src.clients.redis_client import get_redis_client
 from src.config import settings
-from src.crud import CartItemCRUD, ProductCRUD, CategoryCRUD, OrderCRUD, RefreshTokenCRUD, RecoveryTokenCRUD
+from src.custom_exceptions import NotModifiedError, VersionConflictError, InvalidTokenError, TooManyRequestsError
+from src.crud import CartItemCRUD, ProductCRUD, CategoryCRUD, OrderCRUD, ReviewCRUD
 from src.crud.users import UserCRUD
-from src.db import models
-from src.db.db import get_db
+from src.db.db import get_db, SessionLocal
 from src.file_storage import FileStorage, local_file_storage
+from src.inventory import Inventory, ReservationInventory, DatabaseInventory
 from src.logger import logger
+from src.principal_cache import PrincipalCache, Principal
+from src.rate_limiter import RateLimiter
 from src.schemas.user import GoogleUserInfo
 from src.service.cart import CartService
 from src.service.category import CategoryService
+from src.service.checkout import CheckoutService
+from src.service.export import ExportService
 from src.service.order import OrderService
 from src.service.product import ProductService
+from src.service.product_import import ProductImportService
+from src.service.review import ReviewService
 from src.service.token import TokenService
 from src.service.user import UserService
-from src.utils import get_user_id_from_jwt
+from src.session_store import SessionStore
+from src.token_versions import TokenVersions
+from src.utils import TokenClaims, get_claims_from_jwt
+from src.versioning import ResourceVersions, CATALOG_VERSION_KEY, cart_version_key, orders_version_key
 
 oauth2_schema = OAuth2PasswordBearer(tokenUrl="auth/login")
 
@@ -74,51 +88,267 @@ GoogleUserInfoDep = Annotated[GoogleUserInfo, Depends(get_google_user_info)]
 RedisClientDep = Annotated[Redis, Depends(get_redis_client)]
 
 
-def get_cart_service(db: SessionDep):
-    return CartService(CartItemCRUD(db), ProductCRUD(db))
+def get_catalog_cache(db: SessionDep, redis: RedisClientDep):
+    return CatalogCache(redis, db)
+
+
+CatalogCacheDep = Annotated[CatalogCache, Depends(get_catalog_cache)]
+
+
+def get_resource_versions(db: SessionDep, redis: RedisClientDep):
+    return ResourceVersions(redis, db)
+
+
+ResourceVersionsDep = Annotated[ResourceVersions, Depends(get_resource_versions)]
+
+
+def get_cart_store(db: SessionDep, redis: RedisClientDep, versions: ResourceVersionsDep) -> CartStore:
+    if settings.CART_BACKEND == 'redis':
+        return RedisCartStore(redis, db, CartItemCRUD(db), ProductPriceCache(redis, ProductCRUD(db), versions))
+    return DatabaseCartStore(CartItemCRUD(db))
+
+
+CartStoreDep = Annotated[CartStore, Depends(get_cart_store)]
+
+
+def get_cart_service(cart_store: CartStoreDep, versions: ResourceVersionsDep):
+    return CartService(cart_store, versions)
 
 
 CartServiceDep = Annotated[CartService, Depends(get_cart_service)]
 
 
-def get_category_service(db: SessionDep):
-    return CategoryService(CategoryCRUD(db), ProductCRUD(db))
+# the cart service outside of a request, e.g. for the reaper
+def build_cart_service(db: AsyncSession, redis: Redis) -> CartService:
+    versions = get_resource_versions(db, redis)
+    return get_cart_service(get_cart_store(db, redis, versions), versions)
+
+
+def get_category_service(db: SessionDep, catalog_cache: CatalogCacheDep):
+    return CategoryService(CategoryCRUD(db), ProductCRUD(db), catalog_cache)
 
 
 CategoryServiceDep = Annotated[CategoryService, Depends(get_category_service)]
 
 
-def get_order_service(db: SessionDep):
-    return OrderService(OrderCRUD(db), CartItemCRUD(db), ProductCRUD(db))
+def get_inventory(db: SessionDep, redis: RedisClientDep) -> Inventory:
+    if settings.INVENTORY_BACKEND == 'redis':
+        return ReservationInventory(redis, db, ProductCRUD(db))
+    return DatabaseInventory(ProductCRUD(db))
+
+
+InventoryDep = Annotated[Inventory, Depends(get_inventory)]
+
+
+def get_order_service(db: SessionDep, cart_store: CartStoreDep, inventory: InventoryDep,
+                      versions: ResourceVersionsDep):
+    return OrderService(OrderCRUD(db), cart_store, ProductCRUD(db), inventory, versions)
 
 
 OrderServiceDep = Annotated[OrderService, Depends(get_order_service)]
 
 
-def get_product_service(db: SessionDep, file_storage: FileStorageDep):
-    return ProductService(ProductCRUD(db), file_storage)
+# the order service outside of a request, e.g. for the checkout workers
+def build_order_service(db: AsyncSession, redis: Redis) -> OrderService:
+    versions = get_resource_versions(db, redis)
+    return get_order_service(db, get_cart_store(db, redis, versions), get_inventory(db, redis), versions)
+
+
+def get_checkout_service(cart_store: CartStoreDep, redis: RedisClientDep):
+    return CheckoutService(cart_store, CheckoutQueue(redis))
+
+
+CheckoutServiceDep = Annotated[CheckoutService, Depends(get_checkout_service)]
+
+
+def get_product_service(db: SessionDep, file_storage: FileStorageDep, catalog_cache: CatalogCacheDep):
+    return ProductService(ProductCRUD(db), file_storage, catalog_cache)
 
 
 ProductServiceDep = Annotated[ProductService, Depends(get_product_service)]
 
 
+def get_product_import_service(db: SessionDep, catalog_cache: CatalogCacheDep):
+    return ProductImportService(ProductCRUD(db), CategoryCRUD(db), catalog_cache)
+
+
+ProductImportServiceDep = Annotated[ProductImportService, Depends(get_product_import_service)]
+
+
+def get_export_service():
+    return ExportService(SessionLocal)
+
+
+ExportServiceDep = Annotated[ExportService, Depends(get_export_service)]
+
+
+def get_review_service(db: SessionDep, catalog_cache: CatalogCacheDep):
+    return ReviewService(ReviewCRUD(db), ProductCRUD(db), catalog_cache)
+
+
+ReviewServiceDep = Annotated[ReviewService, Depends(get_review_service)]
+
+
 def get_user_service(db: SessionDep, redis: RedisClientDep):
-    return UserService(UserCRUD(db), redis)
+    return UserService(UserCRUD(db), redis, PrincipalCache(redis, db))
 
 
 UserServiceDep = Annotated[UserService, Depends(get_user_service)]
 
 
-def get_token_service(db: SessionDep):
-    return TokenService(RefreshTokenCRUD(db), RecoveryTokenCRUD(db))
+def get_token_service(redis: RedisClientDep):
+    return TokenService(SessionStore(redis))
 
 
 TokenServiceDep = Annotated[TokenService, Depends(get_token_service)]
 
 
-async def get_current_user(token: TokenDep, user_service: UserServiceDep):
-    user_id = get_user_id_from_jwt(token)
-    return await user_service.get_user_by_id(user_id)
+def get_token_versions(db: SessionDep, redis: RedisClientDep):
+    return TokenVersions(redis, db, UserCRUD(db))
+
+
+TokenVersionsDep = Annotated[TokenVersions, Depends(get_token_versions)]
+
+
+# The verified claims of the access token: the signature, the expiration and the token version
+# (a single redis read) are checked, the user is not loaded. Enough for the endpoints that need
+# just the id or the role of the user.
+async def get_claims(token: TokenDep, token_versions: TokenVersionsDep) -> TokenClaims:
+    claims = get_claims_from_jwt(token)
+    await token_versions.check(claims)
+    return claims
+
+
+ClaimsDep = Annotated[TokenClaims, Depends(get_claims)]
+
+
+# the profile of the user, for the endpoints that need more than the claims; the database is only
+# queried if the user is in neither tier of the principal cache
+async def get_current_user(claims: ClaimsDep, user_service: UserServiceDep) -> Principal:
+    return await user_service.get_principal(claims.user_id)
+
+
+CurrentUserDep = Annotated[Principal, Depends(get_current_user)]
+
+
+# region conditional GET
+# The ETag dependencies only read version counters from redis, so a matching If-None-Match
+# is answered with 304 before the endpoint (or any other dependency) touches postgres.
+# They must therefore be declared before the dependencies that do, e.g. in the route decorator.
+
+def _check_if_none_match(request: Request, etag: str):
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is None:
+        return
+    # weak comparison, as the ETags describe semantically equal rather than byte-identical bodies
+    candidates = {candidate.strip().removeprefix('W/') for candidate in if_none_match.split(',')}
+    if '*' in candidates or etag.removeprefix('W/') in candidates:
+        raise NotModifiedError(headers={'ETag': etag})
+
+
+def _query_digest(request: Request) -> str:
+    query = '&'.join(sorted(f"{k}={v}" for k, v in request.query_params.multi_items()))
+    return hashlib.sha1(f"{request.url.path}?{query}".encode()).hexdigest()[:16]
+
+
+async def get_catalog_etag(request: Request, catalog_cache: CatalogCacheDep) -> str:
+    etag = f'W/"catalog-{await catalog_cache.version()}-{_query_digest(request)}"'
+    _check_if_none_match(request, etag)
+    return etag
+
+
+CatalogETagDep = Annotated[str, Depends(get_catalog_etag)]
+
+
+async def check_cart_etag(request: Request, response: Response, claims: ClaimsDep, versions: ResourceVersionsDep):
+    user_id = claims.user_id
+    # cart totals are derived from the current product prices
+    cart_version, catalog_version = await versions.get(cart_version_key(user_id), CATALOG_VERSION_KEY)
+    etag = f'W/"cart-{user_id}-{cart_version}-{catalog_version}"'
+    _check_if_none_match(request, etag)
+    response.headers['ETag'] = etag
+
+
+CartETag = Depends(check_cart_etag)
+
+
+async def check_orders_etag(request: Request, response: Response, claims: ClaimsDep,
+                            versions: ResourceVersionsDep):
+    user_id = claims.user_id
+    orders_version, = await versions.get(orders_version_key(user_id))
+    # the listing with and without the items are different representations
+    etag = f'W/"orders-{user_id}-{orders_version}-{_query_digest(request)}"'
+    _check_if_none_match(request, etag)
+    response.headers['ETag'] = etag
+
+
+OrdersETag = Depends(check_orders_etag)
+
+# endregion
+
+
+# region conditional updates
+# An update with If-Match is applied only to the version of the entity its ETag (see version_etag)
+# was taken from, a stale ETag fails the update with 409. Without If-Match the update is unconditional.
+
+def get_if_match_version(request: Request) -> int | None:
+    if_match = request.headers.get('if-match', '').strip()
+    if if_match in ('', '*'):
+        return None
+    # strong comparison, a weak ETag never matches
+    if not (len(if_match) > 2 and if_match[0] == if_match[-1] == '"' and if_match[1:-1].isdigit()):
+        raise VersionConflictError("If-Match does not match the current version of the resource")
+    return int(if_match[1:-1])
+
+
+IfMatchDep = Annotated[int | None, Depends(get_if_match_version)]
+
+# endregion
+
+
+# region rate limiting
+# rate_limit(...) goes into the dependencies of the route decorator: they are resolved before those of
+# the endpoint, so a rejected request is answered with 429 before it reaches postgres or bcrypt.
+
+async def _request_email(request: Request) -> str | None:
+    if (email := request.path_params.get('email')) is None:
+        # the OAuth2 password form of /auth/login, already parsed (and cached on the request) by FastAPI
+        if request.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+            email = (await request.form()).get('username')
+    return email.strip().lower() if email else None
+
+
+# the user of the access token or, on /auth/refresh, of the refresh token; the token version is not checked
+def _request_user_id(request: Request) -> int | None:
+    scheme, _, token = request.headers.get('authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        token = request.cookies.get('refresh_token')
+    if not token:
+        return None
+    try:
+        return get_claims_from_jwt(token).user_id
+    except InvalidTokenError:
+        return None
+
+
+# Counts the request in a sliding window of window_seconds per client IP, per email (the email path parameter
+# or the username of the login form) and per user, each with its own limit; None disables a key.
+def rate_limit(scope: str, window_seconds: float, *, per_ip: int | None = None, per_email: int | None = None,
+               per_user: int | None = None):
+    async def check_rate_limit(request: Request, redis: RedisClientDep):
+        if not settings.RATE_LIMIT_ENABLED:
+            return
+        limits = []
+        if per_ip is not None and request.client is not None:
+            limits.append((f"{scope}:ip:{request.client.host}", per_ip))
+        if per_email is not None and (email := await _request_email(request)) is not None:
+            limits.append((f"{scope}:email:{email}", per_email))
+        if per_user is not None and (user_id := _request_user_id(request)) is not None:
+            limits.append((f"{scope}:user:{user_id}", per_user))
+
+        if retry_after := await RateLimiter(redis).hit(limits, window_seconds):
+            raise TooManyRequestsError(f"Too many requests, retry in {retry_after} s", {'Retry-After': str(retry_after)})
 
+    return Depends(check_rate_limit)
 
-CurrentUserDep = Annotated[models.User, Depends(get_current_user)]
+# endregion
@@ -0,0 +1,324 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import settings
+from src.crud import ProductCRUD
+from src.custom_exceptions import InsufficientStockError
+from src.db.db import SessionLocal, after_commit, on_rollback
+from src.logger import logger
+
+AVAILABLE_STOCK_KEY = 'stock:available'
+# order id -> 'product id:quantity,...'
+HOLDS_KEY = 'stock:holds'
+# order id -> expiration timestamp (ms)
+HOLD_EXPIRATIONS_KEY = 'stock:holds:expirations'
+# product id -> number of stock changes committed to the database through the counters
+STOCK_EPOCHS_KEY = 'stock:epochs'
+
+# takes a hold for all the items of an order or none of them; returns {1} on success,
+# {0, product id} if a product lacks stock and {-1, *product ids} if counters have to be loaded first
+# KEYS: available, holds, hold expirations; ARGV: order id, expires at, *(product id, quantity)
+_HOLD_SCRIPT = """
+local missing = {}
+for i = 3, #ARGV, 2 do
+    if redis.call('HEXISTS', KEYS[1], ARGV[i]) == 0 then
+        missing[#missing + 1] = ARGV[i]
+    end
+end
+if #missing > 0 then
+    return {-1, unpack(missing)}
+end
+for i = 3, #ARGV, 2 do
+    if tonumber(redis.call('HGET', KEYS[1], ARGV[i])) < tonumber(ARGV[i + 1]) then
+        return {0, ARGV[i]}
+    end
+end
+local items = {}
+for i = 3, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1]))
+    items[#items + 1] = ARGV[i] .. ':' .. ARGV[i + 1]
+end
+redis.call('HSET', KEYS[2], ARGV[1], table.concat(items, ','))
+redis.call('ZADD', KEYS[3], ARGV[2], ARGV[1])
+return {1}
+"""
+
+# returns the stock of the given holds to the counters; returns the number of released holds
+# KEYS: available, holds, hold expirations; ARGV: *order ids
+_RELEASE_SCRIPT = """
+local released = 0
+for i = 1, #ARGV do
+    local items = redis.call('HGET', KEYS[2], ARGV[i])
+    if items then
+        for product_id, quantity in string.gmatch(items, '(%d+):(%d+)') do
+            redis.call('HINCRBY', KEYS[1], product_id, quantity)
+        end
+        redis.call('HDEL', KEYS[2], ARGV[i])
+        released = released + 1
+    end
+    redis.call('ZREM', KEYS[3], ARGV[i])
+end
+return released
+"""
+
+# releases the holds that expired by now, a batch of them; returns the numbers of expirations looked at and
+# of holds released. The expirations are read by the script, so a hold extended meanwhile is not released.
+# KEYS: available, holds, hold expirations; ARGV: now, batch size
+_RELEASE_EXPIRED_SCRIPT = """
+local order_ids = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local released = 0
+for _, order_id in ipairs(order_ids) do
+    local items = redis.call('HGET', KEYS[2], order_id)
+    if items then
+        for product_id, quantity in string.gmatch(items, '(%d+):(%d+)') do
+            redis.call('HINCRBY', KEYS[1], product_id, quantity)
+        end
+        redis.call('HDEL', KEYS[2], order_id)
+        released = released + 1
+    end
+    redis.call('ZREM', KEYS[3], order_id)
+end
+return {#order_ids, released}
+"""
+
+# postpones the expiration of a hold (never brings it forward); returns 0 if the order holds no stock
+# KEYS: holds, hold expirations; ARGV: order id, expires at
+_EXTEND_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+local expires_at = redis.call('ZSCORE', KEYS[2], ARGV[1])
+if not expires_at or tonumber(expires_at) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+end
+return 1
+"""
+
+# turns a hold into a permanent decrement (the counters already exclude it);
+# a hold that expired in the meantime has returned its stock, so the stock is taken once more
+# KEYS: available, holds, hold expirations, epochs; ARGV: order id, *(product id, quantity)
+_COMMIT_SCRIPT = """
+for i = 2, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[4], ARGV[i], 1)
+end
+redis.call('ZREM', KEYS[3], ARGV[1])
+if redis.call('HDEL', KEYS[2], ARGV[1]) == 1 then
+    return 1
+end
+for i = 2, #ARGV, 2 do
+    if redis.call('HEXISTS', KEYS[1], ARGV[i]) == 1 then
+        redis.call('HINCRBY', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1]))
+    end
+end
+return 0
+"""
+
+# KEYS: available, epochs; ARGV: *(product id, quantity)
+_RESTOCK_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[2], ARGV[i], 1)
+    if redis.call('HEXISTS', KEYS[1], ARGV[i]) == 1 then
+        redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+"""
+
+# sets the counters to the stock in the database minus the active holds; a product whose epoch moved since
+# it was read before the database was queried is skipped, as its stock may have changed after the query
+# (its counter has been kept up to date by the commit or restock meanwhile)
+# KEYS: available, holds, epochs; ARGV: *(product id, quantity in the database, epoch)
+_RECONCILE_SCRIPT = """
+local held = {}
+for _, items in ipairs(redis.call('HVALS', KEYS[2])) do
+    for product_id, quantity in string.gmatch(items, '(%d+):(%d+)') do
+        held[product_id] = (held[product_id] or 0) + tonumber(quantity)
+    end
+end
+for i = 1, #ARGV, 3 do
+    if (redis.call('HGET', KEYS[3], ARGV[i]) or '0') == ARGV[i + 2] then
+        redis.call('HSET', KEYS[1], ARGV[i], tonumber(ARGV[i + 1]) - (held[ARGV[i]] or 0))
+    end
+end
+"""
+
+
+class Inventory(ABC):
+    # takes the stock of a new order, raises InsufficientStockError if there is not enough of it
+    @abstractmethod
+    async def take(self, order_id: int, quantities: dict[int, int]):
+        pass
+
+    # keeps the stock of an unpaid order at least until the given time (unix seconds), so it can be paid for;
+    # returns False if the stock is no longer kept for the order
+    @abstractmethod
+    async def extend_hold(self, order_id: int, until: int) -> bool:
+        pass
+
+    # the order has been paid for, raises InsufficientStockError if its stock is gone
+    @abstractmethod
+    async def confirm(self, order_id: int, quantities: dict[int, int]):
+        pass
+
+    # puts the stock of a cancelled or withdrawn order back
+    @abstractmethod
+    async def give_back(self, order_id: int, quantities: dict[int, int], *, paid: bool):
+        pass
+
+    # puts the stock of a batch of cancelled unpaid orders back, quantities are per order id
+    @abstractmethod
+    async def release_unpaid(self, quantities: dict[int, dict[int, int]]):
+        pass
+
+
+# The stock in the products table is decremented as soon as an order is placed.
+class DatabaseInventory(Inventory):
+    def __init__(self, product_crud: ProductCRUD):
+        self.product_crud = product_crud
+
+    async def take(self, order_id: int, quantities: dict[int, int]):
+        decremented = await self.product_crud.decrement_stock(quantities)
+        if failed := [product_id for product_id in quantities if product_id not in decremented]:
+            raise InsufficientStockError(f"Insufficient stock for product ID {failed[0]}")
+
+    # the stock is taken for good until the order is cancelled
+    async def extend_hold(self, order_id: int, until: int) -> bool:
+        return True
+
+    async def confirm(self, order_id: int, quantities: dict[int, int]):
+        pass
+
+    async def give_back(self, order_id: int, quantities: dict[int, int], *, paid: bool):
+        await self.product_crud.increment_stock(quantities)
+
+    async def release_unpaid(self, quantities: dict[int, dict[int, int]]):
+        totals: dict[int, int] = {}
+        for order_quantities in quantities.values():
+            for product_id, quantity in order_quantities.items():
+                totals[product_id] = totals.get(product_id, 0) + quantity
+        if totals:
+            await self.product_crud.increment_stock(totals)
+
+
+# Placing an order only takes a hold on redis counters of the available stock, no product row is locked.
+# The products table is decremented once the order is paid for; holds of orders that are not paid
+# within STOCK_HOLD_SECONDS are released by run_inventory_maintenance, which also reconciles
+# the counters with the database, the source of truth.
+class ReservationInventory(Inventory):
+    def __init__(self, redis: Redis, db: AsyncSession, product_crud: ProductCRUD):
+        self.redis = redis
+        self.db = db
+        self.product_crud = product_crud
+        self._hold_script = redis.register_script(_HOLD_SCRIPT)
+        self._release_script = redis.register_script(_RELEASE_SCRIPT)
+        self._commit_script = redis.register_script(_COMMIT_SCRIPT)
+        self._restock_script = redis.register_script(_RESTOCK_SCRIPT)
+        self._extend_script = redis.register_script(_EXTEND_SCRIPT)
+
+    # the hold is released if the transaction (or the savepoint) taking it is rolled back;
+    # one left behind by a process that died expires
+    async def take(self, order_id: int, quantities: dict[int, int]):
+        args = [order_id, _now_ms() + settings.STOCK_HOLD_SECONDS * 1000, *_flatten(quantities)]
+        result = await self._hold_script(keys=_KEYS, args=args)
+        # a counter is not loaded while a payment of its product is being committed, so loading may take a retry
+        for _ in range(_LOAD_ATTEMPTS):
+            if result[0] != -1:
+                break
+            await reconcile_stock(self.redis, self.product_crud, [int(product_id) for product_id in result[1:]])
+            result = await self._hold_script(keys=_KEYS, args=args)
+        if result[0] == -1:
+            raise InsufficientStockError(f"The stock of product ID {result[1]} could not be loaded, try again")
+        if result[0] != 1:
+            raise InsufficientStockError(f"Insufficient stock for product ID {result[1]}")
+        on_rollback(self.db, lambda: self._release_script(keys=_KEYS, args=[order_id]))
+
+    # a hold that has expired already is not taken again, its stock may have been sold
+    async def extend_hold(self, order_id: int, until: int) -> bool:
+        return bool(await self._extend_script(keys=[HOLDS_KEY, HOLD_EXPIRATIONS_KEY], args=[order_id, until * 1000]))
+
+    # the stock of an order paid for after its hold expired may have been sold meanwhile
+    async def confirm(self, order_id: int, quantities: dict[int, int]):
+        decremented = await self.product_crud.decrement_stock(quantities)
+        if oversold := [product_id for product_id in quantities if product_id not in decremented]:
+            raise InsufficientStockError(f"Insufficient stock for product ID {oversold[0]}")
+        # dropped after the decrement is committed, so a reconciliation that reads the decremented stock still
+        # subtracts the hold; one that read the stock before the decrement skips the product (see its epoch)
+        after_commit(self.db, lambda: self._commit_script(keys=[*_KEYS, STOCK_EPOCHS_KEY],
+                                                          args=[order_id, *_flatten(quantities)]))
+
+    async def give_back(self, order_id: int, quantities: dict[int, int], *, paid: bool):
+        # the hold is released once the cancellation is committed; a failed one leaves the order holding it
+        if not paid:
+            after_commit(self.db, lambda: self._release_script(keys=_KEYS, args=[order_id]))
+            return
+        await self.product_crud.increment_stock(quantities)
+        after_commit(self.db, lambda: self._restock_script(keys=[AVAILABLE_STOCK_KEY, STOCK_EPOCHS_KEY],
+                                                           args=_flatten(quantities)))
+
+    # only the holds are dropped, and only once the cancellation is committed
+    async def release_unpaid(self, quantities: dict[int, dict[int, int]]):
+        if quantities:
+            after_commit(self.db, lambda: self._release_script(keys=_KEYS, args=list(quantities)))
+
+
+# loads the counters of the given products, or of all of them, from the database
+async def reconcile_stock(redis: Redis, product_crud: ProductCRUD, product_ids: list[int] = None):
+    reconcile = redis.register_script(_RECONCILE_SCRIPT)
+    if product_ids is not None:
+        await _reconcile_products(redis, reconcile, product_crud, product_ids)
+        return
+
+    after_id = 0
+    while stock := await product_crud.get_stock(after_id=after_id, limit=settings.STOCK_RECONCILE_BATCH_SIZE):
+        await _reconcile_products(redis, reconcile, product_crud, list(stock))
+        after_id = max(stock)
+
+
+# the epochs are read before the stock, so a payment committed after the stock query is detected
+async def _reconcile_products(redis: Redis, reconcile, product_crud: ProductCRUD, product_ids: list[int]):
+    epochs = await redis.hmget(STOCK_EPOCHS_KEY, product_ids)
+    stock = await product_crud.get_stock(product_ids)
+    args = [value for product_id, epoch in zip(product_ids, epochs) if product_id in stock
+            for value in (product_id, stock[product_id], epoch or '0')]
+    if args:
+        await reconcile(keys=[AVAILABLE_STOCK_KEY, HOLDS_KEY, STOCK_EPOCHS_KEY], args=args)
+
+
+async def release_expired_holds(redis: Redis) -> int:
+    release = redis.register_script(_RELEASE_EXPIRED_SCRIPT)
+    released = 0
+    while True:
+        expired, batch_released = await release(keys=_KEYS, args=[_now_ms(), settings.STOCK_HOLD_RELEASE_BATCH_SIZE])
+        released += batch_released
+        if not expired:
+            return released
+
+
+async def run_inventory_maintenance(redis: Redis):
+    reconciled_at = 0
+    while True:
+        try:
+            if released := await release_expired_holds(redis):
+                logger.info(f"Released {released} expired stock holds")
+            if time.monotonic() - reconciled_at >= settings.STOCK_RECONCILE_INTERVAL_SECONDS:
+                async with SessionLocal() as db:
+                    await reconcile_stock(redis, ProductCRUD(db))
+                reconciled_at = time.monotonic()
+        except Exception as e:
+            logger.error(f"Inventory maintenance failed: {e}")
+        await asyncio.sleep(settings.STOCK_HOLD_RELEASE_INTERVAL_SECONDS)
+
+
+_KEYS = [AVAILABLE_STOCK_KEY, HOLDS_KEY, HOLD_EXPIRATIONS_KEY]
+_LOAD_ATTEMPTS = 3
+
+
+def _now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+
+def _flatten(quantities: dict[int, int]) -> list[int]:
+    return [value for item in quantities.items() for value in item]
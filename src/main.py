@@ -1,14 +1,20 @@
+import asyncio
 import os
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
 
-from fastapi import FastAPI, Request, status
+from fastapi import FastAPI, Request, Response, status
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 
+from src.cart_store import run_cart_flusher
+from src.checkout_queue import run_checkout_worker
+from src.clients.redis_client import redis
 from src.config import settings
 from src.db.db import engine
 from src.db.db_init import init_db
+from src.deps import build_order_service
+from src.inventory import run_inventory_maintenance
 from src.routers import auth, users, orders, products, categories, reviews, cart, payments
 from src.custom_exceptions import (
     PetStoreApiError,
@@ -26,17 +32,33 @@ from src.custom_exceptions import (
     EmailNotConfirmedError,
     DependentEntityExistsError,
     PaymentGatewayError,
-    EmptyCartError
+    EmptyCartError,
+    InvalidCursorError,
+    VersionConflictError,
+    TooManyRequestsError,
+    NotModifiedError
 )
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db(engine)
+    workers = []
+    if settings.CART_BACKEND == 'redis':
+        workers.append(asyncio.create_task(run_cart_flusher(redis)))
+    if settings.INVENTORY_BACKEND == 'redis':
+        workers.append(asyncio.create_task(run_inventory_maintenance(redis)))
+    if settings.CHECKOUT_MODE == 'queued':
+        workers.extend(asyncio.create_task(run_checkout_worker(redis, lambda db: build_order_service(db, redis)))
+                       for _ in range(settings.CHECKOUT_WORKERS))
     yield
+    for worker in workers:
+        worker.cancel()
+        with suppress(asyncio.CancelledError):
+            await worker
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -44,6 +66,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 app.include_router(auth.router)
@@ -86,6 +109,9 @@ exception_handlers = [
     (DependentEntityExistsError, status.HTTP_409_CONFLICT, "Dependent entity exists"),
     (PaymentGatewayError, status.HTTP_500_INTERNAL_SERVER_ERROR, "Payment gateway error"),
     (EmptyCartError, status.HTTP_409_CONFLICT, "Cart is empty"),
+    (InvalidCursorError, status.HTTP_400_BAD_REQUEST, "Invalid pagination cursor"),
+    (VersionConflictError, status.HTTP_409_CONFLICT, "Resource has been modified"),
+    (TooManyRequestsError, status.HTTP_429_TOO_MANY_REQUESTS, "Too many requests"),
 ]
 
 for exc, code, message in exception_handlers:
@@ -93,3 +119,11 @@ for exc, code, message in exception_handlers:
         exc_class_or_status_code=exc,
         handler=create_exception_handler(code, message)
     )
+
+
+# a 304 response must not carry a body
+async def not_modified_handler(_: Request, exception: NotModifiedError) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=exception.headers)
+
+
+app.add_exception_handler(NotModifiedError, not_modified_handler)
@@ -0,0 +1,50 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+from passlib.context import CryptContext
+
+from src.config import settings
+from src.logger import logger
+
+T = TypeVar('T')
+
+# hashes of any other cost factor are reported by verify as needing a rehash
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__rounds=settings.BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+                           bcrypt__max_rounds=settings.BCRYPT_ROUNDS)
+
+# bcrypt releases the GIL, so the hashing threads run in parallel with each other and with the event loop;
+# at most PASSWORD_HASHING_THREADS operations run at once, the rest wait in the queue of the pool
+_executor = ThreadPoolExecutor(max_workers=settings.PASSWORD_HASHING_THREADS, thread_name_prefix='password-hashing')
+
+
+async def hash_password(password: str) -> str:
+    return await _run('hash', lambda: pwd_context.hash(password))
+
+
+# returns whether the password matches and, if the hash was made with another cost factor, a new hash
+# of the password to be stored instead
+async def verify_password(password: str, hashed_password: str) -> tuple[bool, str | None]:
+    return await _run('verify', lambda: pwd_context.verify_and_update(password, hashed_password))
+
+
+async def _run(operation: str, work: Callable[[], T]) -> T:
+    submitted = time.monotonic()
+    started = None
+
+    def timed():
+        nonlocal started
+        started = time.monotonic()
+        return work()
+
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, timed)
+    finally:
+        finished = time.monotonic()
+        queue_wait = ((started or finished) - submitted) * 1000
+        log = logger.warning if queue_wait >= settings.PASSWORD_HASHING_SLOW_QUEUE_MILLISECONDS else logger.debug
+        log(f"password_hashing operation={operation} queue_wait_ms={queue_wait:.1f} "
+            f"duration_ms={(finished - (started or finished)) * 1000:.1f}")
@@ -4,7 +4,8 @@ from src.config import settings
 from src.db import models
 
 
-def create_checkout_session(order: models.Order):
+# expires_at is a unix timestamp
+def create_checkout_session(order: models.Order, expires_at: int):
     metadata = {
         "order_id": str(order.id),
     }
@@ -12,7 +13,7 @@ def create_checkout_session(order: models.Order):
     line_items = [
         {
             "price_data": {
-                "currency": "uah",
+                "currency": order.currency,
                 "unit_amount": int(item.total_price / item.quantity),
                 "product_data": {
                     "name": item.product.title
@@ -24,8 +25,9 @@ def create_checkout_session(order: models.Order):
 
     return stripe.checkout.Session.create(
         line_items=line_items,
-        currency="uah",
+        currency=order.currency,
         mode="payment",
+        expires_at=expires_at,
         metadata=metadata,
         payment_intent_data={
             "metadata": metadata
@@ -1,11 +1,12 @@
 from fastapi import Depends
 
-from src.deps import CurrentUserDep
+from src.deps import ClaimsDep
 from src.custom_exceptions import NotEnoughRightsError
 
 
-def assert_admin_role(user: CurrentUserDep):
-    if not user.is_admin:
+# authorized from the role claim of the token alone, a demoted admin's tokens are revoked
+def assert_admin_role(claims: ClaimsDep):
+    if not claims.is_admin:
         raise NotEnoughRightsError("Only admin user can access this endpoint")
 
 
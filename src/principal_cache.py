@@ -0,0 +1,118 @@
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import settings
+from src.db import models
+from src.db.db import after_commit
+
+# stores a record only if the user has not been invalidated since the record was loaded
+# KEYS: record, generation; ARGV: generation seen before loading, ttl, record
+_STORE_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[3], 'EX', ARGV[2])
+return 1
+"""
+
+# KEYS: record, generation
+_INVALIDATE_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('DEL', KEYS[1])
+"""
+
+
+# what authentication and authorization need to know about the user behind a token
+@dataclass(frozen=True, slots=True)
+class Principal:
+    id: int
+    email: str
+    name: str
+    is_admin: bool
+
+    @classmethod
+    def from_user(cls, user: models.User) -> 'Principal':
+        return cls(id=user.id, email=user.email, name=user.name, is_admin=user.is_admin)
+
+
+# A size bounded LRU whose entries expire after ttl seconds.
+class _LocalTier:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[int, tuple[float, Principal]] = OrderedDict()
+
+    def get(self, user_id: int) -> Principal | None:
+        if (entry := self._entries.get(user_id)) is None:
+            return None
+        expires_at, principal = entry
+        if expires_at < time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return principal
+
+    def put(self, principal: Principal):
+        self._entries[principal.id] = (time.monotonic() + self.ttl, principal)
+        self._entries.move_to_end(principal.id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def discard(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+
+_local = _LocalTier(settings.PRINCIPAL_CACHE_SIZE, settings.PRINCIPAL_CACHE_LOCAL_TTL_SECONDS)
+
+
+# Resolves the user behind a token without a database round trip per request: an in-process LRU
+# in front of compact records in redis. Invalidations are applied after the request transaction commits;
+# the redis tier is exact (a record loaded before an invalidation is not stored), while the in-process
+# tiers of the other workers may serve the old record for up to PRINCIPAL_CACHE_LOCAL_TTL_SECONDS.
+class PrincipalCache:
+    def __init__(self, redis: Redis, db: AsyncSession):
+        self.redis = redis
+        self.db = db
+        self._store_script = redis.register_script(_STORE_SCRIPT)
+        self._invalidate_script = redis.register_script(_INVALIDATE_SCRIPT)
+
+    async def get(self, user_id: int, load: Callable[[int], Awaitable[models.User]]) -> Principal:
+        if not settings.PRINCIPAL_CACHE_ENABLED:
+            return Principal.from_user(await load(user_id))
+        if (principal := _local.get(user_id)) is not None:
+            return principal
+
+        record, generation = await self.redis.mget(_record_key(user_id), _generation_key(user_id))
+        if record is not None:
+            principal = Principal(user_id, *json.loads(record))
+        else:
+            principal = Principal.from_user(await load(user_id))
+            await self._store_script(
+                keys=[_record_key(user_id), _generation_key(user_id)],
+                args=[generation or '', settings.PRINCIPAL_CACHE_TTL_SECONDS,
+                      json.dumps([principal.email, principal.name, principal.is_admin])]
+            )
+        _local.put(principal)
+        return principal
+
+    def invalidate(self, user_id: int):
+        _local.discard(user_id)
+        after_commit(self.db, lambda: self._apply_invalidation(user_id))
+
+    async def _apply_invalidation(self, user_id: int):
+        _local.discard(user_id)
+        await self._invalidate_script(keys=[_record_key(user_id), _generation_key(user_id)])
+
+
+def _record_key(user_id: int) -> str:
+    return f"principal:{user_id}"
+
+
+def _generation_key(user_id: int) -> str:
+    return f"principal:generation:{user_id}"
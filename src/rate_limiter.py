@@ -0,0 +1,54 @@
+import math
+import time
+import uuid
+
+from redis.asyncio import Redis
+
+# Sliding window log: a sorted set per key holds the timestamps of the requests counted in the last window.
+# A request is counted against all of its keys or, if any of them is at its limit, against none, so the
+# rejected requests do not push the window forward.
+# KEYS: counters; ARGV: now (ms), window (ms), request id, limit of every key
+# returns 0 if the request is allowed, otherwise the milliseconds until it would be
+_HIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local retry_after = 0
+for i = 1, #KEYS do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now - window)
+    local limit = tonumber(ARGV[i + 3])
+    if redis.call('ZCARD', KEYS[i]) >= limit then
+        local oldest = redis.call('ZRANGE', KEYS[i], -limit, -limit, 'WITHSCORES')
+        retry_after = math.max(retry_after, tonumber(oldest[2]) + window - now)
+    end
+end
+if retry_after > 0 then
+    return retry_after
+end
+for i = 1, #KEYS do
+    redis.call('ZADD', KEYS[i], now, ARGV[3])
+    redis.call('PEXPIRE', KEYS[i], window)
+end
+return 0
+"""
+
+
+class RateLimiter:
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self._hit_script = redis.register_script(_HIT_SCRIPT)
+
+    # limits are (key, requests per window) pairs; returns the seconds to wait before retrying,
+    # 0 if the request is allowed and has been counted
+    async def hit(self, limits: list[tuple[str, int]], window_seconds: float) -> int:
+        if not limits:
+            return 0
+        retry_after = await self._hit_script(
+            keys=[_counter_key(key) for key, _ in limits],
+            args=[int(time.time() * 1000), int(window_seconds * 1000), uuid.uuid4().hex,
+                  *(limit for _, limit in limits)]
+        )
+        return math.ceil(retry_after / 1000)
+
+
+def _counter_key(key: str) -> str:
+    return f"rate_limit:{key}"
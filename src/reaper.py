@@ -0,0 +1,67 @@
+import time
+from datetime import datetime, UTC, timedelta
+from typing import Callable, Awaitable
+
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.pool import NullPool
+
+from src.config import settings
+from src.db.db import run_after_commit_callbacks
+from src.deps import build_order_service, build_cart_service
+from src.logger import logger
+
+
+# Periodic clean-up run by celery beat. Every job works in batches of REAPER_BATCH_SIZE rows, a transaction
+# each, so no lock is held for long, and stops after REAPER_MAX_BATCHES of them.
+
+# unpaid pending orders hold stock that nobody else can buy
+async def reap_stale_orders() -> int:
+    placed_before = _utcnow() - timedelta(seconds=settings.STALE_ORDER_AGE_SECONDS)
+    return await _run_in_batches(
+        'stale_orders',
+        lambda db, redis: build_order_service(db, redis).cancel_stale_orders(placed_before, settings.REAPER_BATCH_SIZE)
+    )
+
+
+async def purge_idle_carts() -> int:
+    changed_before = _utcnow() - timedelta(seconds=settings.IDLE_CART_AGE_SECONDS)
+    return await _run_in_batches(
+        'idle_carts',
+        lambda db, redis: build_cart_service(db, redis).purge_idle_carts(changed_before, settings.REAPER_BATCH_SIZE)
+    )
+
+
+# A celery task runs every job in an event loop of its own, so the connections are opened per run
+# instead of being taken from the pools of the api.
+async def _run_in_batches(job: str, run_batch: Callable[[AsyncSession, Redis], Awaitable[int]]) -> int:
+    engine = create_async_engine(settings.POSTGRESQL_DB_URL, poolclass=NullPool)
+    sessions = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    redis = Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, decode_responses=True)
+
+    started = time.monotonic()
+    total = batches = 0
+    try:
+        while batches < settings.REAPER_MAX_BATCHES:
+            batch_started = time.monotonic()
+            async with sessions() as db:
+                rows = await run_batch(db, redis)
+                await db.commit()
+                await run_after_commit_callbacks(db)
+            total += rows
+            batches += 1
+            logger.info(f"reaper job={job} batch={batches} rows={rows} "
+                        f"duration_ms={(time.monotonic() - batch_started) * 1000:.1f}")
+            if rows < settings.REAPER_BATCH_SIZE:
+                break
+    finally:
+        await redis.aclose()
+        await engine.dispose()
+
+    logger.info(f"reaper job={job} batches={batches} rows={total} "
+                f"duration_ms={(time.monotonic() - started) * 1000:.1f}")
+    return total
+
+
+def _utcnow() -> datetime:
+    return datetime.now(UTC).replace(tzinfo=None)
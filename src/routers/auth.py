@@ -8,18 +8,18 @@ from pydantic import EmailStr
 
 from src.config import settings
 from src.custom_exceptions import (
-    InvalidCredentialsError,
     InvalidTokenError,
     ResourceDoesNotExistError,
     ResourceAlreadyExistsError,
 )
-from src.deps import TokenDep, GoogleUserInfoDep, RedisClientDep, TokenServiceDep, UserServiceDep
+from src.deps import TokenDep, GoogleUserInfoDep, RedisClientDep, TokenServiceDep, UserServiceDep, TokenVersionsDep, \
+    ClaimsDep, rate_limit
 from src.schemas.message import Message
 from src.schemas.new_password import NewPasswordIn
 from src.schemas.token import Token
 from src.schemas.user import UserIn, UserOut
-from src.service.token import TokenService
-from src.utils import create_jwt_token, get_user_id_from_jwt, verify_password, generate_confirmation_code
+from src.token_versions import TokenVersions
+from src.utils import create_jwt_token, get_claims_from_jwt, generate_confirmation_code
 from src.celery_.tasks import send_password_recovery_email, send_confirmation_code_email
 
 router = APIRouter(
@@ -28,12 +28,17 @@ router = APIRouter(
 )
 
 
-async def _handle_user_tokens(user_id: int, response: Response, token_service: TokenService):
+# the role is read from the user when the tokens are issued, the token version from TokenVersions;
+# the refresh token is the current token of the session (see SessionStore)
+async def _handle_user_tokens(user_id: int, is_admin: bool, session_id: str, refresh_token_id: str,
+                              response: Response, token_versions: TokenVersions):
+    token_version = await token_versions.get(user_id)
     access_token = create_jwt_token(user_id=user_id,
-                                    expires_in=timedelta(minutes=settings.ACCESS_TOKEN_EXPIRATION_MINUTES))
+                                    expires_in=timedelta(minutes=settings.ACCESS_TOKEN_EXPIRATION_MINUTES),
+                                    is_admin=is_admin, token_version=token_version, session_id=session_id)
     refresh_token = create_jwt_token(user_id=user_id,
-                                     expires_in=timedelta(days=settings.REFRESH_TOKEN_EXPIRATION_DAYS))
-    await token_service.upsert_refresh_token(user_id, refresh_token)
+                                     expires_in=timedelta(days=settings.REFRESH_TOKEN_EXPIRATION_DAYS),
+                                     token_version=token_version, session_id=session_id, token_id=refresh_token_id)
 
     response.set_cookie(key="refresh_token",
                         value=refresh_token,
@@ -58,14 +63,19 @@ async def authenticate_with_google():
 async def google_callback(res: Response,
                           google_user: GoogleUserInfoDep,
                           user_service: UserServiceDep,
-                          token_service: TokenServiceDep):
+                          token_service: TokenServiceDep,
+                          token_versions: TokenVersionsDep):
     if (user := await user_service.get_user_by_identity_provider_id(google_user.id)) is None:
         user = await user_service.register_user_using_google(google_user)
 
-    return await _handle_user_tokens(user.id, res, token_service)
+    session_id, refresh_token_id = await token_service.start_session(user.id)
+    return await _handle_user_tokens(user.id, user.is_admin, session_id, refresh_token_id, res, token_versions)
 
 
-@router.post('/{email}/send_confirmation_code', status_code=status.HTTP_200_OK, response_model=Message)
+@router.post('/{email}/send_confirmation_code', status_code=status.HTTP_200_OK, response_model=Message,
+             dependencies=[rate_limit('confirmation_code', settings.CONFIRMATION_CODE_RATE_LIMIT_WINDOW_SECONDS,
+                                      per_ip=settings.CONFIRMATION_CODE_RATE_LIMIT_PER_IP,
+                                      per_email=settings.CONFIRMATION_CODE_RATE_LIMIT_PER_EMAIL)])
 async def send_confirmation_code(email: EmailStr, user_service: UserServiceDep, redis: RedisClientDep):
     if await user_service.get_user_by_email(email):
         raise ResourceAlreadyExistsError("Email is already registered")
@@ -83,43 +93,49 @@ async def register(user: UserIn, user_service: UserServiceDep):
     return await user_service.register_user(user)
 
 
-@router.post('/login', status_code=status.HTTP_200_OK, response_model=Token)
+@router.post('/login', status_code=status.HTTP_200_OK, response_model=Token,
+             dependencies=[rate_limit('login', settings.LOGIN_RATE_LIMIT_WINDOW_SECONDS,
+                                      per_ip=settings.LOGIN_RATE_LIMIT_PER_IP,
+                                      per_email=settings.LOGIN_RATE_LIMIT_PER_EMAIL)])
 async def login(user_credentials: Annotated[OAuth2PasswordRequestForm, Depends()],
                 res: Response,
                 user_service: UserServiceDep,
-                token_service: TokenServiceDep):
-    user = await user_service.get_user_by_email(user_credentials.username)
-    if user is not None and user.password is None:
-        raise InvalidCredentialsError("Account is registered with an external provider")
-
-    if not (user and verify_password(user_credentials.password, user.password)):
-        raise InvalidCredentialsError("No account with the given email exists or the password is wrong")
-
-    return await _handle_user_tokens(user.id, res, token_service)
-
-
-@router.post('/refresh', status_code=status.HTTP_200_OK, response_model=Token)
-async def refresh(req: Request, res: Response, token_service: TokenServiceDep):
+                token_service: TokenServiceDep,
+                token_versions: TokenVersionsDep):
+    user = await user_service.authenticate(user_credentials.username, user_credentials.password)
+    session_id, refresh_token_id = await token_service.start_session(user.id)
+    return await _handle_user_tokens(user.id, user.is_admin, session_id, refresh_token_id, res, token_versions)
+
+
+@router.post('/refresh', status_code=status.HTTP_200_OK, response_model=Token,
+             dependencies=[rate_limit('refresh', settings.REFRESH_RATE_LIMIT_WINDOW_SECONDS,
+                                      per_user=settings.REFRESH_RATE_LIMIT_PER_USER)])
+async def refresh(req: Request, res: Response, token_service: TokenServiceDep, token_versions: TokenVersionsDep,
+                  user_service: UserServiceDep):
     token = req.cookies.get('refresh_token')
     if not token:
         raise InvalidTokenError("No token found")
-    user_id = get_user_id_from_jwt(token)
-
-    if (await token_service.is_refresh_token_valid(user_id, token)) is False:
-        raise InvalidTokenError("Invalid refresh token")
+    claims = get_claims_from_jwt(token)
+    await token_versions.check(claims)
+    refresh_token_id = await token_service.rotate_session(claims)
 
-    return await _handle_user_tokens(user_id, res, token_service)
+    # the role may have changed since the refresh token was issued
+    principal = await user_service.get_principal(claims.user_id)
+    return await _handle_user_tokens(claims.user_id, principal.is_admin, claims.session_id, refresh_token_id, res,
+                                     token_versions)
 
 
-@router.post('/password-recovery/{email}', status_code=status.HTTP_200_OK, response_model=Message)
+@router.post('/password-recovery/{email}', status_code=status.HTTP_200_OK, response_model=Message,
+             dependencies=[rate_limit('password_recovery', settings.PASSWORD_RECOVERY_RATE_LIMIT_WINDOW_SECONDS,
+                                      per_ip=settings.PASSWORD_RECOVERY_RATE_LIMIT_PER_IP,
+                                      per_email=settings.PASSWORD_RECOVERY_RATE_LIMIT_PER_EMAIL)])
 async def recover_password(email: EmailStr, user_service: UserServiceDep, token_service: TokenServiceDep):
     if (user := await user_service.get_user_by_email(email)) is None:
         raise ResourceDoesNotExistError("The given email is not registered yet")
 
     recovery_token = create_jwt_token(user_id=user.id,
-                                      expires_in=timedelta(minutes=settings.RECOVERY_TOKEN_EXPIRATION_MINUTES))
-
-    await token_service.upsert_recovery_token(user.id, recovery_token)
+                                      expires_in=timedelta(minutes=settings.RECOVERY_TOKEN_EXPIRATION_MINUTES),
+                                      token_id=await token_service.issue_recovery_token(user.id))
 
     send_password_recovery_email.delay(username=user.name,
                                        link=recovery_token,
@@ -128,22 +144,34 @@ async def recover_password(email: EmailStr, user_service: UserServiceDep, token_
 
 
 @router.put('/me/password/', status_code=status.HTTP_200_OK, response_model=Message)
-async def reset_password(new_password: NewPasswordIn, token_service: TokenServiceDep, user_service: UserServiceDep):
-    user_id = get_user_id_from_jwt(new_password.token)
+async def reset_password(new_password: NewPasswordIn, token_service: TokenServiceDep, user_service: UserServiceDep,
+                         token_versions: TokenVersionsDep):
+    claims = get_claims_from_jwt(new_password.token)
 
-    if (await token_service.is_recovery_token_valid(user_id, new_password.token)) is False:
+    if not await token_service.consume_recovery_token(claims):
         raise InvalidTokenError("Invalid recovery token")
 
-    user = await user_service.get_user(user_id)
-    user.password = new_password
-
-    await token_service.revoke_recovery_token(user_id)
+    await user_service.change_password(claims.user_id, new_password.password)
+    # whoever knew the old password is signed out everywhere
+    await token_versions.revoke(claims.user_id)
+    await token_service.revoke_all_sessions(claims.user_id)
     return Message(message="New password set")
 
 
 @router.post('/logout', status_code=status.HTTP_200_OK, response_model=Message)
 async def logout(token: TokenDep, res: Response, token_service: TokenServiceDep):
-    user_id = get_user_id_from_jwt(token)
-    await token_service.revoke_refresh_token(user_id)
+    claims = get_claims_from_jwt(token)
+    # ends the session of this device only
+    await token_service.revoke_session(claims.user_id, claims.session_id)
     res.delete_cookie('refresh_token')
     return Message(message='logged out')
+
+
+# signs the user out on every device: all the access and refresh tokens issued so far are revoked
+@router.post('/logout-all', status_code=status.HTTP_200_OK, response_model=Message)
+async def logout_all(claims: ClaimsDep, res: Response, token_service: TokenServiceDep,
+                     token_versions: TokenVersionsDep):
+    await token_versions.revoke(claims.user_id)
+    await token_service.revoke_all_sessions(claims.user_id)
+    res.delete_cookie('refresh_token')
+    return Message(message='logged out everywhere')
@@ -1,10 +1,11 @@
-from typing import Optional
+from typing import Optional, Annotated
 
-from fastapi import APIRouter, status
+from fastapi import APIRouter, status, Body
 
+from src.config import rules
 from src.schemas.cart import CartOut
-from src.schemas.item import ItemIn
-from src.deps import CurrentUserDep, CartServiceDep
+from src.schemas.item import ItemIn, ItemDelta
+from src.deps import ClaimsDep, CartServiceDep, CartETag
 
 router = APIRouter(
     prefix='/cart',
@@ -12,24 +13,32 @@ router = APIRouter(
 )
 
 
-@router.get('', response_model=CartOut, status_code=status.HTTP_200_OK)
-async def get_my_cart(user: CurrentUserDep, cart_service: CartServiceDep):
-    return await cart_service.get_cart(user.id)
+@router.get('', response_model=CartOut, status_code=status.HTTP_200_OK, dependencies=[CartETag])
+async def get_my_cart(claims: ClaimsDep, cart_service: CartServiceDep):
+    return await cart_service.get_cart(claims.user_id)
 
 
 @router.post('/items', response_model=Optional[CartOut], status_code=status.HTTP_200_OK)
-async def add_item_to_cart(user: CurrentUserDep, item: ItemIn, cart_service: CartServiceDep):
-    await cart_service.add_item(user.id, item)
-    return await cart_service.get_cart(user.id)
+async def add_item_to_cart(claims: ClaimsDep, item: ItemIn, cart_service: CartServiceDep):
+    await cart_service.add_item(claims.user_id, item)
+    return await cart_service.get_cart(claims.user_id)
 
 
 @router.delete('/items', response_model=Optional[CartOut], status_code=status.HTTP_200_OK)
-async def remove_item_from_cart(user: CurrentUserDep, item: ItemIn, cart_service: CartServiceDep):
-    await cart_service.remove_item(user.id, item)
-    return await cart_service.get_cart(user.id)
+async def remove_item_from_cart(claims: ClaimsDep, item: ItemIn, cart_service: CartServiceDep):
+    await cart_service.remove_item(claims.user_id, item)
+    return await cart_service.get_cart(claims.user_id)
+
+
+@router.patch('/items', response_model=CartOut, status_code=status.HTTP_200_OK)
+async def change_cart_items(claims: ClaimsDep,
+                            deltas: Annotated[list[ItemDelta], Body(max_length=rules.MAX_CART_DELTAS_PER_REQUEST)],
+                            cart_service: CartServiceDep):
+    await cart_service.apply_deltas(claims.user_id, deltas)
+    return await cart_service.get_cart(claims.user_id)
 
 
 @router.post('/clear', response_model=CartOut, status_code=status.HTTP_200_OK)
-async def clear_cart(user: CurrentUserDep, cart_service: CartServiceDep):
-    await cart_service.clear_cart(user.id)
-    return await cart_service.get_cart(user.id)
+async def clear_cart(claims: ClaimsDep, cart_service: CartServiceDep):
+    await cart_service.clear_cart(claims.user_id)
+    return await cart_service.get_cart(claims.user_id)
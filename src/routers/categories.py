@@ -23,6 +23,6 @@ async def delete_category(category_id: int, category_service: CategoryServiceDep
 
 @router.post('/{category_id}/products/{product_id}', status_code=status.HTTP_201_CREATED, dependencies=[AdminRole])
 async def link_category_to_product(category_id: int, product_id: int, category_service: CategoryServiceDep):
-    category_service.link_category_to_product(category_id, product_id)
+    await category_service.link_category_to_product(category_id, product_id)
 
     return Message(message=f"Category {category_id} has been successfully linked to product with id {product_id}")
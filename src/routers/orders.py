@@ -1,14 +1,15 @@
-from fastapi import APIRouter, status, Depends
+from fastapi import APIRouter, status, Depends, Response
 
+from src.config import settings
 from src.custom_types import OrderStatus
 from src.permissions import AdminRole
-from src.schemas.filtration import PaginationParams, OrderFilter
+from src.schemas.filtration import PaginationParams, OrderFilter, ExportFilter
 from src.schemas.message import Message
-from src.schemas.order import OrderOut
-from src.deps import CurrentUserDep, CartServiceDep, OrderServiceDep
-from src.custom_exceptions import (
-    EmptyCartError, NotEnoughRightsError,
-)
+from src.schemas.order import OrderOut, OrderSummaryOut, CheckoutOut, order_listing
+from src.deps import ClaimsDep, OrderServiceDep, ExportServiceDep, CheckoutServiceDep, IfMatchDep
+from src.custom_exceptions import NotEnoughRightsError
+from src.service.export import ExportFormat
+from src.utils import set_next_cursor_header, export_response, version_etag
 
 router = APIRouter(
     prefix='/orders',
@@ -16,39 +17,58 @@ router = APIRouter(
 )
 
 
-@router.post('', status_code=status.HTTP_201_CREATED, response_model=OrderOut)
-async def create_order(user: CurrentUserDep, order_service: OrderServiceDep, cart_service: CartServiceDep):
-    cart = await cart_service.get_cart(user.id)
-
-    if len(cart.items) == 0:
-        raise EmptyCartError("The user's cart is empty")
-
-    order = await order_service.create_order(user.id, cart)
+# in the queued checkout mode the order is placed in the background, its outcome is polled at Location
+@router.post('', status_code=status.HTTP_201_CREATED, response_model=OrderOut | CheckoutOut)
+async def create_order(response: Response, claims: ClaimsDep, order_service: OrderServiceDep,
+                       checkout_service: CheckoutServiceDep):
+    if settings.CHECKOUT_MODE == 'queued':
+        checkout = await checkout_service.queue_checkout(claims.user_id)
+        response.status_code = status.HTTP_202_ACCEPTED
+        response.headers['Location'] = f"{router.prefix}/checkouts/{checkout.checkout_id}"
+        return checkout
+    return await order_service.create_order(claims.user_id)
 
-    await cart_service.clear_cart(user.id)
 
-    return order
+@router.get('/checkouts/{checkout_id}', status_code=status.HTTP_200_OK, response_model=CheckoutOut)
+async def get_checkout(checkout_id: str, response: Response, claims: ClaimsDep,
+                       checkout_service: CheckoutServiceDep):
+    checkout = await checkout_service.get_checkout(checkout_id, claims.user_id)
+    if checkout.status == 'queued':
+        response.headers['Retry-After'] = '1'
+    return checkout
 
 
 @router.post('/{order_id}/cancel', status_code=status.HTTP_204_NO_CONTENT)
-async def cancel_order(order_id: int, user: CurrentUserDep, order_service: OrderServiceDep):
+async def cancel_order(order_id: int, claims: ClaimsDep, order_service: OrderServiceDep):
     order = await order_service.get_order(order_id)
-    if order.user_id != user.id:
+    if order.user_id != claims.user_id:
         raise NotEnoughRightsError("User is not the order owner")
     await order_service.cancel_order(order_id)
 
 
 @router.patch('/{order_id}/status', status_code=status.HTTP_200_OK, response_model=Message,
               dependencies=[AdminRole])
-async def change_order_status(order_id: int, new_status: OrderStatus, order_service: OrderServiceDep):
-    order = await order_service.get_order(order_id)
-    order.status = new_status
+async def change_order_status(order_id: int, new_status: OrderStatus, response: Response, if_match: IfMatchDep,
+                              order_service: OrderServiceDep):
+    order = await order_service.change_order_status(order_id, new_status, expected_version=if_match)
+    response.headers['ETag'] = version_etag(order.version)
     return Message(message=f"The order status updated to {new_status.value}")
 
 
-@router.get('/', response_model=list[OrderOut], status_code=status.HTTP_200_OK,
+@router.get('/', response_model=list[OrderOut | OrderSummaryOut], status_code=status.HTTP_200_OK,
             dependencies=[AdminRole])
-async def get_orders(order_service: OrderServiceDep,
+async def get_orders(response: Response,
+                     order_service: OrderServiceDep,
                      filter: OrderFilter = Depends(),
-                     pagination: PaginationParams = Depends()):
-    return await order_service.get_orders(filter=filter, pagination=pagination)
+                     pagination: PaginationParams = Depends(),
+                     include_items: bool = False):
+    orders = await order_service.get_orders(filter=filter, pagination=pagination, include_items=include_items)
+    set_next_cursor_header(response, orders)
+    return order_listing(orders, include_items)
+
+
+@router.get('/export', status_code=status.HTTP_200_OK, dependencies=[AdminRole])
+async def export_orders(export_service: ExportServiceDep,
+                        format: ExportFormat = 'ndjson',
+                        filter: ExportFilter = Depends()):
+    return export_response(export_service.export_orders(format, filter), 'orders', format)
@@ -17,10 +17,10 @@ router = APIRouter(
 
 @router.get('/{order_id}/pay', status_code=status.HTTP_307_TEMPORARY_REDIRECT)
 async def pay(order_id: int, order_service: OrderServiceDep):
-    order = await order_service.get_order(order_id)
+    order, expires_at = await order_service.start_payment(order_id)
 
     try:
-        checkout_session = create_checkout_session(order)
+        checkout_session = create_checkout_session(order, expires_at)
     except stripe.error.StripeError as e:
         logger.error(f"Failed to create checkout session: {e}")
         raise PaymentGatewayError("Failed to create checkout session")
@@ -58,8 +58,7 @@ async def handle_payment_succeeded(event, order_service: OrderServiceDep):
     metadata = session['metadata']
 
     if order_id := metadata.get('order_id'):
-        order = await order_service.get_order(int(order_id))
-        order.is_paid = True
+        await order_service.confirm_payment(int(order_id))
 
 
 async def handle_payment_failed(event, order_service: OrderServiceDep):
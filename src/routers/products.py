@@ -1,18 +1,24 @@
 import uuid
 from typing import Annotated
 
-from fastapi import APIRouter, status, Depends, UploadFile, Query
+from fastapi import APIRouter, status, Depends, UploadFile, Query, Request, Response
 
 from src.config import settings
 from src.custom_exceptions import (
     FileTooLargeError,
     NotSupportedFileTypeError,
 )
-from src.deps import SessionDep, ProductServiceDep
+from src.catalog_cache import category_tag
+from src.deps import SessionDep, ProductServiceDep, CatalogCacheDep, CatalogETagDep, ProductImportServiceDep, \
+    ExportServiceDep, IfMatchDep
 from src.permissions import AdminRole
-from src.schemas.filtration import PaginationParams
-from src.schemas.product import ProductIn, ProductOut, ProductUpdate
+from src.schemas.filtration import PaginationParams, ExportFilter
+from src.schemas.product import ProductIn, ProductOut, ProductUpdate, FacetedSearchOut, ProductImportReport, \
+    StockShardingIn
 from src.schemas.review import ReviewOut
+from src.serialization import product_fragments
+from src.service.export import ExportFormat
+from src.utils import set_next_cursor_header, export_response, version_etag
 
 router = APIRouter(
     prefix='/products',
@@ -21,22 +27,47 @@ router = APIRouter(
 
 
 @router.get('', status_code=status.HTTP_200_OK, response_model=list[ProductOut])
-async def get_products(product_service: ProductServiceDep, pagination: PaginationParams = Depends()):
-    return await product_service.get_products(pagination=pagination, is_active=True)
-
-
-@router.get('/search', status_code=status.HTTP_200_OK, response_model=list[ProductOut])
-async def search_products(product_service: ProductServiceDep, q: str,
+async def get_products(etag: CatalogETagDep, product_service: ProductServiceDep, catalog_cache: CatalogCacheDep,
+                       pagination: PaginationParams = Depends()):
+    page = await catalog_cache.get_or_compute(
+        'products', pagination.model_dump(),
+        lambda: product_service.get_products(pagination=pagination, is_active=True)
+    )
+    return page.to_response(etag)
+
+
+# with facets=true the hits are wrapped together with category counts, price bands and the total hit count
+@router.get('/search', status_code=status.HTTP_200_OK, response_model=list[ProductOut] | FacetedSearchOut)
+async def search_products(etag: CatalogETagDep, product_service: ProductServiceDep, catalog_cache: CatalogCacheDep,
+                          q: str,
                           categories: Annotated[list[int], Query(alias="category")] = None,
+                          facets: bool = False,
                           pagination: PaginationParams = Depends()):
-    return await product_service.search_products(q, categories=categories, pagination=pagination)
+    page = await catalog_cache.get_or_compute(
+        'products/search',
+        {'q': q, 'categories': sorted(categories or []), 'facets': facets, **pagination.model_dump()},
+        lambda: product_service.search_products(q, categories=categories, pagination=pagination,
+                                                with_facets=facets),
+        tags=map(category_tag, categories or [])
+    )
+    return page.to_response(etag)
 
 
 @router.get('/all', status_code=status.HTTP_200_OK, response_model=list[ProductOut], dependencies=[AdminRole])
 async def get_products_admin(product_service: ProductServiceDep,
                              pagination: PaginationParams = Depends(),
                              is_active: bool = None):
-    return await product_service.get_products(pagination=pagination, is_active=is_active)
+    products = await product_service.get_products(pagination=pagination, is_active=is_active)
+    response = Response(content=product_fragments.render_list(products), media_type='application/json')
+    set_next_cursor_header(response, products)
+    return response
+
+
+@router.get('/export', status_code=status.HTTP_200_OK, dependencies=[AdminRole])
+async def export_products(export_service: ExportServiceDep,
+                          format: ExportFormat = 'ndjson',
+                          filter: ExportFilter = Depends()):
+    return export_response(export_service.export_products(format, filter), 'products', format)
 
 
 @router.post('', status_code=status.HTTP_201_CREATED, response_model=ProductOut, dependencies=[AdminRole])
@@ -44,9 +75,38 @@ async def create_product(product: ProductIn, product_service: ProductServiceDep)
     return await product_service.create_product(product)
 
 
+IMPORT_FORMATS = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+}
+
+
+# the body is consumed as a stream, so arbitrarily large catalogs can be uploaded
+@router.post('/import', status_code=status.HTTP_200_OK, response_model=ProductImportReport,
+             dependencies=[AdminRole])
+async def import_products(req: Request, import_service: ProductImportServiceDep):
+    content_type = req.headers.get('content-type', '').split(';')[0].strip()
+    if (fmt := IMPORT_FORMATS.get(content_type)) is None:
+        raise NotSupportedFileTypeError(f"Supported content types are: {', '.join(IMPORT_FORMATS)}")
+
+    return await import_service.import_products(req.stream(), fmt)
+
+
+# the ETag is the version of the product, for the If-Match of its updates
+@router.get('/{product_id}', status_code=status.HTTP_200_OK, response_model=ProductOut, dependencies=[AdminRole])
+async def get_product(product_id: int, response: Response, product_service: ProductServiceDep):
+    product = await product_service.get_product(product_id)
+    response.headers['ETag'] = version_etag(product.version)
+    return product
+
+
 @router.patch('/{product_id}', status_code=status.HTTP_200_OK, response_model=ProductOut, dependencies=[AdminRole])
-async def update_product(product_id: int, product_update: ProductUpdate, product_service: ProductServiceDep):
-    return await product_service.update_product(product_id, product_update)
+async def update_product(product_id: int, product_update: ProductUpdate, response: Response,
+                         if_match: IfMatchDep, product_service: ProductServiceDep):
+    product = await product_service.update_product(product_id, product_update, expected_version=if_match)
+    response.headers['ETag'] = version_etag(product.version)
+    return product
 
 
 @router.delete('/{product_id}', status_code=status.HTTP_204_NO_CONTENT, dependencies=[AdminRole])
@@ -54,6 +114,22 @@ async def delete_product(product_id: int, product_service: ProductServiceDep):
     await product_service.delete_product(product_id)
 
 
+@router.put('/{product_id}/stock-shards', status_code=status.HTTP_204_NO_CONTENT, dependencies=[AdminRole])
+async def enable_stock_sharding(product_id: int, sharding: StockShardingIn, product_service: ProductServiceDep):
+    await product_service.enable_stock_sharding(product_id, sharding.shards)
+
+
+@router.delete('/{product_id}/stock-shards', status_code=status.HTTP_204_NO_CONTENT, dependencies=[AdminRole])
+async def disable_stock_sharding(product_id: int, product_service: ProductServiceDep):
+    await product_service.disable_stock_sharding(product_id)
+
+
+@router.post('/{product_id}/stock-shards/rebalance', status_code=status.HTTP_204_NO_CONTENT,
+             dependencies=[AdminRole])
+async def rebalance_stock_shards(product_id: int, product_service: ProductServiceDep):
+    await product_service.rebalance_stock_shards(product_id)
+
+
 # TODO: add resolution/aspect ratio regulation
 @router.post('/{product_id}/images', status_code=status.HTTP_204_NO_CONTENT,
              dependencies=[AdminRole])
@@ -1,9 +1,9 @@
 from fastapi import APIRouter, status
 
-from src.schemas.order import OrderOut
+from src.schemas.order import OrderOut, OrderSummaryOut, order_listing
 from src.schemas.review import ReviewOut
 from src.schemas.user import UserOut
-from src.deps import CurrentUserDep, OrderServiceDep
+from src.deps import CurrentUserDep, ClaimsDep, OrderServiceDep, OrdersETag
 
 router = APIRouter(
     prefix='/users',
@@ -16,11 +16,12 @@ async def get_me(user: CurrentUserDep):
     return user
 
 
-@router.get('/me/orders', response_model=list[OrderOut], status_code=status.HTTP_200_OK)
-async def get_my_orders(user: CurrentUserDep, order_service: OrderServiceDep):
-    return await order_service.get_by_user(user.id)
+@router.get('/me/orders', response_model=list[OrderOut | OrderSummaryOut], status_code=status.HTTP_200_OK,
+            dependencies=[OrdersETag])
+async def get_my_orders(claims: ClaimsDep, order_service: OrderServiceDep, include_items: bool = False):
+    return order_listing(await order_service.get_by_user(claims.user_id, include_items), include_items)
 
 
 @router.get('/me/reviews', response_model=list[ReviewOut], status_code=status.HTTP_200_OK)
-async def get_my_reviews(user: CurrentUserDep):
+async def get_my_reviews(claims: ClaimsDep):
     return []
@@ -3,13 +3,25 @@ from pydantic import BaseModel, field_serializer
 from src.schemas.item import ItemOut, Item
 
 
+class CartItem(Item):
+    unit_price: int
+
+
+class CartItemOut(ItemOut):
+    unit_price: int
+
+    @field_serializer('unit_price')
+    def serialize_unit_price(self, value) -> float:
+        return round(value / 100, 2)
+
+
 class Cart(BaseModel):
-    items: list[Item]
+    items: list[CartItem]
     total_price: int
 
 
 class CartOut(BaseModel):
-    items: list[ItemOut]
+    items: list[CartItemOut]
     total_price: int
 
     @field_serializer('total_price')
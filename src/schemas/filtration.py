@@ -1,6 +1,6 @@
 from typing import Optional
-from datetime import datetime
-from pydantic import BaseModel, Field
+from datetime import datetime, UTC
+from pydantic import BaseModel, Field, field_validator
 
 from src.custom_types import OrderStatus
 
@@ -8,8 +8,25 @@ from src.custom_types import OrderStatus
 class PaginationParams(BaseModel):
     limit: int = Field(50, gt=0, le=100)
     offset: int = Field(0, ge=0)
+    # opaque keyset cursor taken from the X-Next-Cursor header of the previous page, overrides offset
+    cursor: Optional[str] = Field(None)
 
 
 class OrderFilter(BaseModel):
     status: Optional[OrderStatus] = Field(None)
+    refund_due: Optional[bool] = Field(None)
     created_after: Optional[datetime] = Field(None)
+
+
+# incremental exports only include the rows created or modified after the given moments
+class ExportFilter(BaseModel):
+    created_after: Optional[datetime] = Field(None)
+    updated_after: Optional[datetime] = Field(None)
+
+    # timestamps are stored as naive utc
+    @field_validator('created_after', 'updated_after', mode='after')
+    @classmethod
+    def to_naive_utc(cls, v: Optional[datetime]) -> Optional[datetime]:
+        if v is not None and v.tzinfo is not None:
+            v = v.astimezone(UTC).replace(tzinfo=None)
+        return v
@@ -1,5 +1,7 @@
 from pydantic import BaseModel, Field, field_serializer
 
+from src.config import rules
+
 
 class Item(BaseModel):
     product_id: int
@@ -9,7 +11,13 @@ class Item(BaseModel):
 
 class ItemIn(BaseModel):
     product_id: int = Field(gt=0)
-    quantity: int = Field(gt=0)
+    quantity: int = Field(gt=0, le=rules.MAX_CART_ITEM_QUANTITY)
+
+
+# a positive quantity adds to the cart, a negative one removes from it
+class ItemDelta(BaseModel):
+    product_id: int = Field(gt=0)
+    quantity: int = Field(ge=-rules.MAX_CART_ITEM_QUANTITY, le=rules.MAX_CART_ITEM_QUANTITY)
 
 
 class ItemOut(BaseModel):
@@ -1,14 +1,7 @@
-from pydantic import BaseModel, field_validator, Field
-
-from src.utils import hash_pass
+from pydantic import BaseModel, Field
 
 
 class NewPasswordIn(BaseModel):
     token: str
     password: str = Field(min_length=5)
 
-    @field_validator('password', mode='after')
-    @classmethod
-    def hash_password(cls, password) -> str:
-        return hash_pass(password)
-
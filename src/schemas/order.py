@@ -1,8 +1,10 @@
 from datetime import datetime
+from typing import Literal, Optional
 
 from pydantic import BaseModel, field_serializer
 
 from src.custom_types import OrderStatus
+from src.schemas.base import ObjUpdate
 from src.schemas.item import ItemOut, ItemIn
 
 
@@ -10,11 +12,58 @@ class OrderIn(BaseModel):
     items: list[ItemIn]
 
 
-class OrderOut(BaseModel):
+# an order as listed without its items
+class OrderSummaryOut(BaseModel):
     id: int
     status: OrderStatus
+    is_paid: bool
+    refund_due: bool
     created_at: datetime
     total_price: int
+    item_count: int
+    currency: str
+    # the ETag of the order, for the If-Match of its updates
+    version: int
+
+    @field_serializer('total_price')
+    def convert_price_to_float(self, v: int) -> float:
+        return round(v / 100, 2)
+
+
+class OrderOut(OrderSummaryOut):
+    items: list[ItemOut]
+
+
+class OrderUpdate(ObjUpdate):
+    status: Optional[OrderStatus] = None
+
+
+# the outcome of a queued checkout, order_id is set once the order has been placed
+class CheckoutOut(BaseModel):
+    checkout_id: str
+    status: Literal['queued', 'completed', 'failed']
+    order_id: Optional[int] = None
+    detail: Optional[str] = None
+
+
+# order listings carry the items only on request
+def order_listing(orders, include_items: bool) -> list[OrderOut | OrderSummaryOut]:
+    schema = OrderOut if include_items else OrderSummaryOut
+    return [schema.model_validate(order, from_attributes=True) for order in orders]
+
+
+# a row of the order export
+class OrderExportRow(BaseModel):
+    id: int
+    user_id: int
+    status: OrderStatus
+    is_paid: bool
+    refund_due: bool
+    created_at: datetime
+    updated_at: datetime
+    total_price: int
+    item_count: int
+    currency: str
     items: list[ItemOut]
 
     @field_serializer('total_price')
@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import Optional
 
 from pydantic import BaseModel, Field, field_validator, field_serializer
@@ -18,6 +19,39 @@ class ProductIn(BaseModel):
         return int(v * 100)
 
 
+class ProductImportRow(ProductIn):
+    sku: str = Field(min_length=1, max_length=rules.MAX_PRODUCT_SKU_LENGTH)
+    discount: int = Field(default=0, ge=0, le=100)
+    is_active: bool = Field(default=True)
+    categories: list[str] = Field(default_factory=list)
+
+    # csv rows list the category names separated by '|'
+    @field_validator('categories', mode='before')
+    @classmethod
+    def split_category_names(cls, v):
+        if isinstance(v, str):
+            v = [name for name in v.split('|') if name.strip()]
+        return v
+
+    @field_validator('categories', mode='after')
+    @classmethod
+    def to_lower_case(cls, v: list[str]) -> list[str]:
+        return [name.strip().lower() for name in v]
+
+
+class ImportRowError(BaseModel):
+    line: int
+    errors: list[str]
+
+
+class ProductImportReport(BaseModel):
+    created: int = 0
+    updated: int = 0
+    failed: int = 0
+    # capped at PRODUCT_IMPORT_MAX_REPORTED_ERRORS, failed holds the full count
+    errors: list[ImportRowError] = []
+
+
 class ProductOut(BaseModel):
     id: int
     rating: float
@@ -37,6 +71,33 @@ class ProductOut(BaseModel):
         return list(map(lambda filename: f"{settings.IMAGES_BASE_URL}{info.data['id']}/{filename}", images))
 
 
+# a row of the product export, the csv form can be fed back into the product import
+class ProductExportRow(BaseModel):
+    id: int
+    sku: Optional[str]
+    title: str
+    description: str
+    full_price: int
+    discount: int
+    final_price: int
+    # the whole stock, including the shards of a sharded product
+    quantity: int = Field(validation_alias='stock')
+    is_active: bool
+    rating: float
+    created_at: datetime
+    updated_at: datetime
+    categories: list[str]
+
+    @field_validator('categories', mode='before')
+    @classmethod
+    def take_category_names(cls, v):
+        return [getattr(category, 'name', category) for category in v]
+
+    @field_serializer('full_price', 'final_price')
+    def convert_price_to_float(self, v: int) -> float:
+        return round(v / 100, 2)
+
+
 class ProductUpdate(ObjUpdate):
     title: Optional[str] = Field(default=None, max_length=rules.MAX_PRODUCT_TITLE_LENGTH)
     description: Optional[str] = Field(default=None, max_length=rules.MAX_PRODUCT_DESCRIPTION_LENGTH)
@@ -48,3 +109,34 @@ class ProductUpdate(ObjUpdate):
     @field_serializer('full_price')
     def convert_price_to_int(self, v: float) -> int:
         return v and int(v * 100)
+
+
+class StockShardingIn(BaseModel):
+    shards: int = Field(default=rules.DEFAULT_STOCK_SHARDS, ge=rules.MIN_STOCK_SHARDS, le=rules.MAX_STOCK_SHARDS)
+
+
+class CategoryFacet(BaseModel):
+    category_id: int
+    count: int
+
+
+class PriceBucket(BaseModel):
+    min_price: int
+    max_price: Optional[int]
+    count: int
+
+    @field_serializer('min_price', 'max_price')
+    def convert_price_to_float(self, v: int | None) -> float | None:
+        return v and round(v / 100, 2)
+
+
+class SearchFacets(BaseModel):
+    total: int
+    in_stock: int
+    categories: list[CategoryFacet]
+    prices: list[PriceBucket]
+
+
+class FacetedSearchOut(BaseModel):
+    items: list[ProductOut]
+    facets: SearchFacets
@@ -2,9 +2,11 @@ from datetime import datetime
 
 from pydantic import BaseModel, Field
 
+from src.config import rules
+
 
 class ReviewIn(BaseModel):
-    rating: int = Field(le=10, ge=0)
+    rating: int = Field(ge=rules.MIN_REVIEW_RATING, le=rules.MAX_REVIEW_RATING)
     content: str = Field(max_length=1024)
 
 
@@ -1,7 +1,6 @@
-from pydantic import BaseModel, EmailStr, field_validator, Field
+from pydantic import BaseModel, EmailStr, Field
 
 from src.config import rules
-from src.utils import hash_pass
 
 
 class UserIn(BaseModel):
@@ -11,11 +10,6 @@ class UserIn(BaseModel):
     confirmation_code: int = Field(ge=rules.CONFIRMATION_CODE_LOWER_BOUND,
                                    le=rules.CONFIRMATION_CODE_UPPER_BOUND)
 
-    @field_validator('password', mode='after')
-    @classmethod
-    def hash_password(cls, password) -> str:
-        return hash_pass(password)
-
 
 class UserOut(BaseModel):
     id: int
@@ -0,0 +1,37 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import Iterable
+
+from src.config import settings
+from src.db import models
+from src.schemas.product import ProductOut, SearchFacets
+
+
+# Keeps the rendered ProductOut json of recently served products. A product is only validated again
+# once its updated_at changes, every other request just stitches the cached fragments together.
+class ProductFragmentCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._fragments: OrderedDict[int, tuple[datetime, bytes]] = OrderedDict()
+
+    def render(self, product: models.Product) -> bytes:
+        cached = self._fragments.get(product.id)
+        if cached is not None and cached[0] == product.updated_at:
+            self._fragments.move_to_end(product.id)
+            return cached[1]
+
+        fragment = ProductOut.model_validate(product, from_attributes=True).model_dump_json().encode()
+        self._fragments[product.id] = (product.updated_at, fragment)
+        self._fragments.move_to_end(product.id)
+        if len(self._fragments) > self.max_size:
+            self._fragments.popitem(last=False)
+        return fragment
+
+    def render_list(self, products: Iterable[models.Product]) -> bytes:
+        return b'[' + b','.join(map(self.render, products)) + b']'
+
+    def render_search(self, products: Iterable[models.Product], facets: SearchFacets) -> bytes:
+        return b'{"items":' + self.render_list(products) + b',"facets":' + facets.model_dump_json().encode() + b'}'
+
+
+product_fragments = ProductFragmentCache(settings.PRODUCT_FRAGMENT_CACHE_SIZE)
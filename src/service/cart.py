@@ -1,45 +1,43 @@
-from src.crud import CartItemCRUD
-from src.crud.products import ProductCRUD
-from src.custom_exceptions import ResourceDoesNotExistError
-from src.db.models import CartItem
+from datetime import datetime
+
+from src.cart_store import CartStore
 from src.schemas.cart import Cart
-from src.schemas.item import ItemIn, Item
+from src.schemas.item import ItemIn, ItemDelta
+from src.versioning import ResourceVersions, cart_version_key
 
 
 class CartService:
-    def __init__(self, cart_item_crud: CartItemCRUD, product_crud: ProductCRUD):
-        self.cart_crud = cart_item_crud
-        self.product_crud = product_crud
+    def __init__(self, cart_store: CartStore, versions: ResourceVersions):
+        self.cart_store = cart_store
+        self.versions = versions
 
     async def get_cart(self, user_id: int) -> Cart:
-        items = await self.cart_crud.get_all_by_user_id(user_id)
-        return Cart(
-            items=[Item(product_id=item.product_id,
-                        quantity=item.quantity,
-                        total_price=item.total_price) for item in items],
-            total_price=sum(item.total_price for item in items)
-        )
+        return await self.cart_store.get_cart(user_id)
 
     async def add_item(self, user_id: int, item: ItemIn):
-        if (await self.product_crud.get(item.product_id)) is None:
-            raise ResourceDoesNotExistError("Product with the given id does not exist")
-
-        if existing_item := await self.cart_crud.get(user_id, item.product_id):
-            existing_item.quantity += item.quantity
-        else:
-            await self.cart_crud.create(
-                CartItem(
-                    user_id=user_id,
-                    product_id=item.product_id,
-                    quantity=item.quantity)
-            )
+        await self.cart_store.add_item(user_id, item.product_id, item.quantity)
+        self.versions.bump(cart_version_key(user_id))
 
     async def remove_item(self, user_id: int, item: ItemIn):
-        if existing_item := await self.cart_crud.get(user_id, item.product_id):
-            if item.quantity >= existing_item.quantity:
-                await self.cart_crud.delete(user_id, item.product_id)
-            else:
-                existing_item.quantity -= item.quantity
+        await self.cart_store.remove_item(user_id, item.product_id, item.quantity)
+        self.versions.bump(cart_version_key(user_id))
+
+    # applies all the changes at once, several deltas of the same product add up
+    async def apply_deltas(self, user_id: int, deltas: list[ItemDelta]):
+        totals: dict[int, int] = {}
+        for delta in deltas:
+            totals[delta.product_id] = totals.get(delta.product_id, 0) + delta.quantity
+        if totals := {product_id: quantity for product_id, quantity in totals.items() if quantity != 0}:
+            await self.cart_store.apply_deltas(user_id, totals)
+            self.versions.bump(cart_version_key(user_id))
 
     async def clear_cart(self, user_id: int):
-        await self.cart_crud.delete_all_by_user_id(user_id)
+        await self.cart_store.clear(user_id)
+        self.versions.bump(cart_version_key(user_id))
+
+    # returns the number of purged carts
+    async def purge_idle_carts(self, changed_before: datetime, limit: int) -> int:
+        user_ids = await self.cart_store.purge_idle(changed_before, limit)
+        if user_ids:
+            self.versions.bump(*(cart_version_key(user_id) for user_id in user_ids))
+        return len(user_ids)
@@ -1,3 +1,4 @@
+from src.catalog_cache import CatalogCache, FACETS_TAG, category_tag
 from src.crud import ProductCRUD, CategoryCRUD
 from src.custom_exceptions import ResourceAlreadyExistsError
 from src.db.models import Category
@@ -5,21 +6,24 @@ from src.schemas.category import CategoryIn
 
 
 class CategoryService:
-    def __init__(self, category_crud: CategoryCRUD, product_crud: ProductCRUD):
+    def __init__(self, category_crud: CategoryCRUD, product_crud: ProductCRUD, catalog_cache: CatalogCache):
         self.category_crud = category_crud
         self.product_crud = product_crud
+        self.catalog_cache = catalog_cache
 
     async def create_category(self, category: CategoryIn):
         return await self.category_crud.create(Category(**category.model_dump()))
 
     async def delete_category(self, category_id: int):
         await self.category_crud.delete(category_id)
+        self.catalog_cache.invalidate(category_tag(category_id), FACETS_TAG)
 
     async def link_category_to_product(self, category_id: int, product_id: int):
         category = await self.category_crud.get(category_id)
-        product = await self.product_crud.get(product_id)
+        product = await self.product_crud.get(product_id, profile='detail')
 
-        if category in await product.awaitable_attrs.categories:
+        if category in product.categories:
             raise ResourceAlreadyExistsError(f"Product is already associated with the {category_id} category")
 
         product.categories.append(category)
+        self.catalog_cache.invalidate(category_tag(category_id), FACETS_TAG)
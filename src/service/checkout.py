@@ -0,0 +1,28 @@
+from src.cart_store import CartStore
+from src.checkout_queue import CheckoutQueue
+from src.custom_exceptions import EmptyCartError, ResourceDoesNotExistError
+from src.schemas.order import CheckoutOut
+
+
+class CheckoutService:
+    def __init__(self, cart_store: CartStore, checkout_queue: CheckoutQueue):
+        self.cart_store = cart_store
+        self.checkout_queue = checkout_queue
+
+    # the order is placed later by a checkout worker, from the cart as it is by then
+    async def queue_checkout(self, user_id: int) -> CheckoutOut:
+        cart = await self.cart_store.get_cart(user_id)
+        if len(cart.items) == 0:
+            raise EmptyCartError("The user's cart is empty")
+
+        checkout_id = await self.checkout_queue.enqueue(user_id, [item.product_id for item in cart.items])
+        return CheckoutOut(checkout_id=checkout_id, status='queued')
+
+    async def get_checkout(self, checkout_id: str, user_id: int) -> CheckoutOut:
+        checkout = await self.checkout_queue.get(checkout_id)
+        if checkout is None or int(checkout['user_id']) != user_id:
+            raise ResourceDoesNotExistError("Checkout does not exist")
+        return CheckoutOut(checkout_id=checkout_id,
+                           status=checkout['status'],
+                           order_id=checkout.get('order_id'),
+                           detail=checkout.get('detail'))
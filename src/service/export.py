@@ -0,0 +1,67 @@
+import csv
+import io
+from typing import AsyncIterator, Callable, Literal
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import settings
+from src.crud import ProductCRUD, OrderCRUD
+from src.schemas.filtration import ExportFilter
+from src.schemas.order import OrderExportRow
+from src.schemas.product import ProductExportRow
+
+ExportFormat = Literal['csv', 'ndjson']
+
+PRODUCT_CSV_COLUMNS = list(ProductExportRow.model_fields)
+# csv has no nesting, so an order is written as one line per item
+ORDER_CSV_COLUMNS = [*(column for column in OrderExportRow.model_fields if column != 'items'),
+                     'product_id', 'quantity', 'item_total_price']
+
+
+class ExportService:
+    # The response is streamed after the request scoped session has been closed,
+    # so every export reads through a session of its own.
+    def __init__(self, session_factory: Callable[[], AsyncSession]):
+        self.session_factory = session_factory
+
+    async def export_products(self, fmt: ExportFormat, filter: ExportFilter) -> AsyncIterator[bytes]:
+        async with self.session_factory() as db:
+            if fmt == 'csv':
+                yield _to_csv([PRODUCT_CSV_COLUMNS])
+            async for batch in ProductCRUD(db).stream_all(filter, batch_size=settings.EXPORT_BATCH_SIZE):
+                rows = [ProductExportRow.model_validate(product, from_attributes=True) for product in batch]
+                yield _to_csv(map(_product_csv_line, rows)) if fmt == 'csv' else _to_ndjson(rows)
+
+    async def export_orders(self, fmt: ExportFormat, filter: ExportFilter) -> AsyncIterator[bytes]:
+        async with self.session_factory() as db:
+            if fmt == 'csv':
+                yield _to_csv([ORDER_CSV_COLUMNS])
+            async for batch in OrderCRUD(db).stream_all(filter, batch_size=settings.EXPORT_BATCH_SIZE):
+                rows = [OrderExportRow.model_validate(order, from_attributes=True) for order in batch]
+                if fmt == 'csv':
+                    yield _to_csv(line for row in rows for line in _order_csv_lines(row))
+                else:
+                    yield _to_ndjson(rows)
+
+
+def _to_ndjson(rows: list[ProductExportRow | OrderExportRow]) -> bytes:
+    return b''.join(row.model_dump_json().encode() + b'\n' for row in rows)
+
+
+def _to_csv(lines) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(lines)
+    return buffer.getvalue().encode()
+
+
+def _product_csv_line(row: ProductExportRow) -> list:
+    values = row.model_dump(mode='json')
+    # the same notation as the product import expects
+    values['categories'] = '|'.join(values['categories'])
+    return [values[column] for column in PRODUCT_CSV_COLUMNS]
+
+
+def _order_csv_lines(row: OrderExportRow) -> list[list]:
+    values = row.model_dump(mode='json')
+    order_values = [values[column] for column in ORDER_CSV_COLUMNS[:-3]]
+    return [[*order_values, item['product_id'], item['quantity'], item['total_price']] for item in values['items']]
@@ -1,69 +1,157 @@
-from src.crud import OrderCRUD, CartItemCRUD, ProductCRUD
-from src.custom_exceptions import ResourceDoesNotExistError, InsufficientStockError, NotEnoughRightsError, \
-    InvalidOrderStatusError
+import time
+from datetime import datetime, timedelta, UTC
+
+from src.cart_store import CartStore
+from src.config import settings
+from src.crud import OrderCRUD, ProductCRUD
+from src.custom_exceptions import ResourceDoesNotExistError, NotEnoughRightsError, InvalidOrderStatusError, \
+    EmptyCartError, InsufficientStockError
 from src.custom_types import OrderStatus
+from src.db.db import savepoint
 from src.db.models import Order
-from src.schemas.cart import Cart
+from src.inventory import Inventory
+from src.logger import logger
+from src.schemas.item import Item
+from src.schemas.order import OrderUpdate
+from src.versioning import ResourceVersions, orders_version_key, cart_version_key
 
 
 class OrderService:
-    def __init__(self, order_crud: OrderCRUD, cart_item_crud: CartItemCRUD, product_crud: ProductCRUD):
+    def __init__(self, order_crud: OrderCRUD, cart_store: CartStore, product_crud: ProductCRUD,
+                 inventory: Inventory, versions: ResourceVersions):
         self.order_crud = order_crud
-        self.cart_item_crud = cart_item_crud
+        self.cart_store = cart_store
         self.product_crud = product_crud
+        self.inventory = inventory
+        self.versions = versions
 
-    async def create_order(self, user_id: int, cart: Cart):
-        product_ids = list(map(lambda i: i.product_id, cart.items))
-        products = {product.id: product for product in (await self.product_crud.get_all(product_ids, for_update=True))}
+    # places an order for the content of the user's cart; checkout_id is that of the queued checkout placing it
+    async def create_order(self, user_id: int, checkout_id: str = None):
+        cart = await self.cart_store.get_cart(user_id)
+        if len(cart.items) == 0:
+            raise EmptyCartError("The user's cart is empty")
 
-        for item in cart.items:
-            product = products.get(item.product_id, None)
-
-            if product is None:
-                raise ResourceDoesNotExistError(f"Product with id {item.product_id} does not exist")
-
-            if product.quantity < item.quantity:
-                raise InsufficientStockError(f"Insufficient stock for product ID {item.product_id}")
-
-            product.quantity -= item.quantity
+        quantities = {item.product_id: item.quantity for item in cart.items}
+        # priced from the products table, the cart totals may come from a cache
+        final_prices = await self.product_crud.get_final_prices(list(quantities))
+        if missing := [product_id for product_id in quantities if product_id not in final_prices]:
+            raise ResourceDoesNotExistError(f"Product with id {missing[0]} does not exist")
 
         order = await self.order_crud.create(Order(
-            items=cart.items,
-            user_id=user_id
+            items=[Item(product_id=product_id,
+                        quantity=quantity,
+                        total_price=final_prices[product_id] * quantity)
+                   for product_id, quantity in quantities.items()],
+            user_id=user_id,
+            checkout_id=checkout_id
         ))
+        # the refresh after the insert expires the items
+        order = await self.order_crud.get(order.id, profile='detail')
 
+        # The stock is taken right before the commit, so the product rows stay locked (if at all)
+        # only until then. Without enough stock the whole order is rolled back.
+        await self.inventory.take(order.id, quantities)
+
+        await self.cart_store.clear_on_checkout(user_id)
+        self.versions.bump(orders_version_key(user_id), cart_version_key(user_id))
         return order
 
     async def cancel_order(self, order_id: int):
-        order = await self.order_crud.get(order_id)
+        order = await self.order_crud.get(order_id, profile='detail')
 
         # TODO: reconsider order cancellation behavior for different statuses
         if order.status != OrderStatus.PENDING:
             raise InvalidOrderStatusError("Order cannot be cancelled")
 
-        product_ids = list(map(lambda i: i.product_id, order.items))
-        products = {product.id: product for product in (await self.product_crud.get_all(product_ids, for_update=True))}
-        for item in order.items:
-            products[item.product_id].quantity += item.quantity
+        await self.inventory.give_back(order.id, _quantities(order), paid=order.is_paid)
 
         order.status = OrderStatus.CANCELLED
+        await self.order_crud.flush()
+        self.versions.bump(orders_version_key(order.user_id))
+
+    async def change_order_status(self, order_id: int, new_status: OrderStatus, expected_version: int = None):
+        order = await self.order_crud.update(order_id, OrderUpdate(status=new_status),
+                                             expected_version=expected_version)
+        self.versions.bump(orders_version_key(order.user_id))
+        return order
 
     async def withdraw_order(self, order_id: int):
-        order = await self.order_crud.get(order_id)
+        order = await self.order_crud.get(order_id, profile='detail')
 
         # TODO: reconsider order withdrawal behavior for different statuses
 
-        product_ids = list(map(lambda i: i.product_id, order.items))
-        products = {product.id: product for product in (await self.product_crud.get_all(product_ids, for_update=True))}
-        for item in order.items:
-            products[item.product_id].quantity += item.quantity
+        await self.inventory.give_back(order.id, _quantities(order), paid=order.is_paid)
+        self.versions.bump(orders_version_key(order.user_id))
         return await self.order_crud.delete(order_id)
 
+    # a repeated notification of the same payment is ignored
+    async def confirm_payment(self, order_id: int):
+        order = await self.order_crud.get(order_id, profile='detail')
+        if order.is_paid:
+            return
+        order.is_paid = True
+        # only a pending order is fulfilled; the stock of one cancelled before it was paid for (by the user,
+        # or as stale while its payment session was open) has been released, the payment is to be refunded
+        if order.status != OrderStatus.PENDING:
+            logger.error(f"Order {order.id} has been paid for in the status {order.status.value}")
+            order.refund_due = True
+            await self.order_crud.flush()
+            self.versions.bump(orders_version_key(order.user_id))
+            return
+        # a payment of an order changed in the meantime (e.g. cancelled) fails, the notification is retried
+        await self.order_crud.flush()
+        try:
+            async with savepoint(self.order_crud.db):
+                await self.inventory.confirm(order.id, _quantities(order))
+        except InsufficientStockError as e:
+            # paid for after its stock was released and sold, the order is cancelled and the payment to be refunded
+            logger.error(f"Order {order.id} has been paid for, but cannot be fulfilled: {e.message}")
+            await self.inventory.give_back(order.id, _quantities(order), paid=False)
+            order.status = OrderStatus.CANCELLED
+            order.refund_due = True
+            await self.order_crud.flush()
+        self.versions.bump(orders_version_key(order.user_id))
+
+    # Cancels a batch of the unpaid pending orders placed before the cutoff and puts their stock back,
+    # returns the number of cancelled orders.
+    async def cancel_stale_orders(self, placed_before: datetime, limit: int) -> int:
+        cancelled = await self.order_crud.cancel_stale(placed_before, limit)
+        if cancelled:
+            await self.inventory.release_unpaid(await self.order_crud.get_item_quantities([row.id for row in cancelled]))
+            self.versions.bump(*{orders_version_key(row.user_id) for row in cancelled})
+        return len(cancelled)
+
     async def get_order(self, order_id: int):
         return await self.order_crud.get(order_id)
 
-    async def get_orders(self, filter=None, pagination=None):
-        return await self.order_crud.get_all(filter=filter, pagination=pagination)
-
-    async def get_by_user(self, user_id: int):
-        return await self.order_crud.get_by_user(user_id)
+    # Checks that the order can be paid for and keeps its stock while it is being paid for. Returns the order
+    # with the time (unix seconds) its payment session is to expire at.
+    async def start_payment(self, order_id: int) -> tuple[Order, int]:
+        order = await self.order_crud.get(order_id, profile='checkout')
+        if order.status != OrderStatus.PENDING or order.is_paid:
+            raise InvalidOrderStatusError("Order cannot be paid for")
+
+        expires_at = int(time.time()) + settings.PAYMENT_SESSION_EXPIRATION_SECONDS
+        # the session would outlive the order, which is cancelled as stale (created_at is naive utc)
+        cancelled_at = order.created_at.replace(tzinfo=UTC) + timedelta(seconds=settings.STALE_ORDER_AGE_SECONDS)
+        if cancelled_at.timestamp() < expires_at:
+            raise InvalidOrderStatusError("Order is about to be cancelled, place it again")
+        if not await self.inventory.extend_hold(order.id, expires_at + settings.PAYMENT_NOTIFICATION_GRACE_SECONDS):
+            raise InsufficientStockError("The stock of the order is no longer reserved, place it again")
+        return order, expires_at
+
+    # the listings load the items only if asked to, the totals are stored on the orders
+    async def get_orders(self, filter=None, pagination=None, include_items: bool = False):
+        return await self.order_crud.get_all(filter=filter, pagination=pagination,
+                                             profile='detail' if include_items else None)
+
+    async def get_by_user(self, user_id: int, include_items: bool = False):
+        return await self.order_crud.get_by_user(user_id, profile='detail' if include_items else None)
+
+    # checkout id -> id of the order placed by it, for the checkouts that have placed one
+    async def get_orders_of_checkouts(self, checkout_ids: list[str]) -> dict[str, int]:
+        return await self.order_crud.get_ids_by_checkout(checkout_ids)
+
+
+def _quantities(order: Order) -> dict[int, int]:
+    return {item.product_id: item.quantity for item in order.items}
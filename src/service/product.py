@@ -1,3 +1,4 @@
+from src.catalog_cache import CatalogCache, COLLECTION_TAG, FACETS_TAG, product_tag
 from src.config import rules
 from src.crud import ProductCRUD
 from src.custom_exceptions import LimitExceededError, ResourceDoesNotExistError
@@ -8,28 +9,62 @@ from src.schemas.product import ProductUpdate, ProductIn
 
 
 class ProductService:
-    def __init__(self, product_crud: ProductCRUD, file_storage: FileStorage):
+    def __init__(self, product_crud: ProductCRUD, file_storage: FileStorage, catalog_cache: CatalogCache):
         self.product_crud = product_crud
         self.file_storage = file_storage
+        self.catalog_cache = catalog_cache
 
     async def get_products(self, pagination: PaginationParams = None, is_active: bool = None):
-        return await self.product_crud.get_all(pagination=pagination, is_active=is_active)
+        return await self.product_crud.get_all(pagination=pagination, is_active=is_active, profile='list')
+
+    async def get_product(self, product_id: int):
+        return await self.product_crud.get(product_id)
 
     async def search_products(self, q: str,
                               categories: list[int] = None,
-                              pagination: PaginationParams = None):
-        return await self.product_crud.search(q, category_ids=categories, pagination=pagination)
+                              pagination: PaginationParams = None,
+                              with_facets: bool = False):
+        return await self.product_crud.search(q, category_ids=categories, pagination=pagination,
+                                              with_facets=with_facets)
 
     async def create_product(self, product: ProductIn):
-        return await self.product_crud.create(Product(
+        created_product = await self.product_crud.create(Product(
             **product.model_dump()
         ))
+        self.catalog_cache.invalidate(COLLECTION_TAG)
+        return created_product
+
+    async def update_product(self, product_id: int, product_update: ProductUpdate, expected_version: int = None):
+        updated_product = await self.product_crud.update(product_id, product_update,
+                                                         expected_version=expected_version)
+        if 'quantity' in product_update.model_fields_set:
+            # the new quantity replaces the stock held by the shards of a sharded product
+            await self.product_crud.rebalance_stock_shards([product_id], replace=True)
 
-    async def update_product(self, product_id: int, product_update: ProductUpdate):
-        return await self.product_crud.update(product_id, product_update)
+        # visibility and searchable text decide which listings the product appears in at all
+        if product_update.model_fields_set & {'is_active', 'title', 'description'}:
+            self.catalog_cache.invalidate(product_tag(product_id), COLLECTION_TAG)
+        else:
+            self.catalog_cache.invalidate(product_tag(product_id), FACETS_TAG)
+        return updated_product
 
     async def delete_product(self, product_id: int):
         await self.product_crud.delete(product_id)
+        self.catalog_cache.invalidate(product_tag(product_id), COLLECTION_TAG)
+
+    # Spreads the stock of a hot product over several rows, so that concurrent orders do not queue up
+    # on a single one. Enabling it again changes the number of shards.
+    async def enable_stock_sharding(self, product_id: int, shards: int):
+        await self.product_crud.get(product_id)
+        await self.product_crud.shard_stock(product_id, shards)
+
+    async def disable_stock_sharding(self, product_id: int):
+        await self.product_crud.get(product_id)
+        await self.product_crud.unshard_stock(product_id)
+
+    async def rebalance_stock_shards(self, product_id: int):
+        await self.product_crud.get(product_id)
+        await self.product_crud.rebalance_stock_shards([product_id])
 
     # TODO: add resolution/aspect ratio regulation
     async def add_product_image(self, product_id: int, file: bytes, filename: str):
@@ -38,9 +73,12 @@ class ProductService:
         if len(product.images) >= rules.MAX_IMAGES_PER_PRODUCT:
             raise LimitExceededError("Product already has the maximum number of images")
 
-        await self.file_storage.save(file, f"{product_id}/{filename}")
         # creating a new list is necessary for sqlalchemy to recognize the change
         product.images = product.images + [filename]
+        # a concurrent change of the product fails the upload before the file is stored
+        await self.product_crud.flush()
+        await self.file_storage.save(file, f"{product_id}/{filename}")
+        self.catalog_cache.invalidate(product_tag(product_id))
 
     async def change_product_images(self, product_id: int, images: list[str]):
         product = await self.product_crud.get(product_id)
@@ -51,7 +89,9 @@ class ProductService:
         if not new_images.issubset(current_images):
             raise ResourceDoesNotExistError("One or more of the specified images does not exist")
 
+        product.images = images
+        await self.product_crud.flush()
+
         for filename in current_images - new_images:
             await self.file_storage.delete(f"{product_id}/{filename}")
-
-        product.images = images
+        self.catalog_cache.invalidate(product_tag(product_id))
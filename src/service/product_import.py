@@ -0,0 +1,131 @@
+import codecs
+import csv
+import json
+from typing import AsyncIterator, Literal
+
+from pydantic import ValidationError
+from sqlalchemy.exc import DBAPIError
+
+from src.catalog_cache import CatalogCache, COLLECTION_TAG
+from src.config import settings
+from src.crud import ProductCRUD, CategoryCRUD
+from src.logger import logger
+from src.schemas.product import ProductImportRow, ProductImportReport, ImportRowError
+
+ImportFormat = Literal['csv', 'ndjson']
+
+
+class ProductImportService:
+    def __init__(self, product_crud: ProductCRUD, category_crud: CategoryCRUD, catalog_cache: CatalogCache):
+        self.product_crud = product_crud
+        self.category_crud = category_crud
+        self.catalog_cache = catalog_cache
+
+    # Rows are validated and loaded chunk by chunk, so the whole input never has to be held in memory.
+    # Invalid rows are reported and skipped, a chunk the database rejects does not affect the other chunks.
+    async def import_products(self, chunks: AsyncIterator[bytes], fmt: ImportFormat) -> ProductImportReport:
+        report = ProductImportReport()
+        records = _parse_csv(_iter_lines(chunks)) if fmt == 'csv' else _parse_ndjson(_iter_lines(chunks))
+
+        batch: list[tuple[int, dict | None, str | None]] = []
+        async for record in records:
+            batch.append(record)
+            if len(batch) == settings.PRODUCT_IMPORT_CHUNK_SIZE:
+                await self._import_chunk(batch, report)
+                batch = []
+        if batch:
+            await self._import_chunk(batch, report)
+
+        if report.created or report.updated:
+            self.catalog_cache.invalidate(COLLECTION_TAG)
+        return report
+
+    async def _import_chunk(self, records: list[tuple[int, dict | None, str | None]], report: ProductImportReport):
+        rows: list[tuple[int, ProductImportRow]] = []
+        for line, data, parse_error in records:
+            if parse_error is not None:
+                _report_error(report, line, [parse_error])
+                continue
+            try:
+                rows.append((line, ProductImportRow.model_validate(data)))
+            except ValidationError as e:
+                _report_error(report, line, [f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()])
+
+        category_names = {name for _, row in rows for name in row.categories}
+        known_categories = await self.category_crud.get_existing_names(category_names) if category_names else set()
+        valid_rows = []
+        for line, row in rows:
+            if unknown := [name for name in row.categories if name not in known_categories]:
+                _report_error(report, line, [f"categories: unknown category '{name}'" for name in unknown])
+            else:
+                valid_rows.append((line, row))
+
+        if not valid_rows:
+            return
+        try:
+            created, updated = await self.product_crud.bulk_upsert(valid_rows)
+        except DBAPIError as e:
+            logger.error(f"Product import chunk rejected by the database: {e}")
+            for line, _ in valid_rows:
+                _report_error(report, line, ["rejected by the database, see the server logs"])
+            return
+        report.created += created
+        report.updated += updated
+
+
+def _report_error(report: ProductImportReport, line: int, errors: list[str]):
+    report.failed += 1
+    if len(report.errors) < settings.PRODUCT_IMPORT_MAX_REPORTED_ERRORS:
+        report.errors.append(ImportRowError(line=line, errors=errors))
+
+
+async def _iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+    pending = ''
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split('\n')
+        for line in lines:
+            yield line + '\n'
+    if pending := pending + decoder.decode(b'', final=True):
+        yield pending
+
+
+async def _parse_ndjson(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, dict | None, str | None]]:
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line), None
+        except ValueError as e:
+            yield line_number, None, f"invalid json: {e}"
+
+
+# The first line holds the column names. A quoted field may span several physical lines,
+# so lines are collected until the quotes are balanced before a record is parsed.
+async def _parse_csv(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, dict | None, str | None]]:
+    header = None
+    record, record_line, line_number = '', 0, 0
+    async for line in lines:
+        line_number += 1
+        if not record:
+            record_line = line_number
+        record += line
+        if record.count('"') % 2:
+            continue
+
+        values, record = next(csv.reader([record]), []), ''
+        if not values:
+            continue
+        if header is None:
+            header = [column.strip() for column in values]
+        elif len(values) != len(header):
+            yield record_line, None, f"expected {len(header)} columns, got {len(values)}"
+        else:
+            # empty cells fall back to the defaults of ProductImportRow
+            yield record_line, {k: v for k, v in zip(header, values) if v != ''}, None
+
+    if record:
+        yield record_line, None, "unterminated quoted field"
@@ -0,0 +1,33 @@
+from src.catalog_cache import CatalogCache, product_tag
+from src.crud import ReviewCRUD, ProductCRUD
+from src.custom_exceptions import NotEnoughRightsError
+from src.db.models import Review
+from src.schemas.review import ReviewIn
+
+
+class ReviewService:
+    def __init__(self, review_crud: ReviewCRUD, product_crud: ProductCRUD, catalog_cache: CatalogCache):
+        self.review_crud = review_crud
+        self.product_crud = product_crud
+        self.catalog_cache = catalog_cache
+
+    async def create_review(self, user_id: int, product_id: int, review: ReviewIn):
+        product = await self.product_crud.get(product_id)
+        created_review = await self.review_crud.create(Review(
+            product_id=product.id,
+            user_id=user_id,
+            **review.model_dump(),
+        ))
+        await self.product_crud.add_rating(product.id, created_review.rating)
+        # the cached pages render the rating of the product
+        self.catalog_cache.invalidate(product_tag(product.id))
+        return created_review
+
+    async def delete_review(self, user_id: int, review_id: int):
+        review = await self.review_crud.get(review_id)
+        if review.user_id != user_id:
+            raise NotEnoughRightsError("Only the owner can delete the review")
+
+        await self.review_crud.delete(review_id)
+        await self.product_crud.add_rating(review.product_id, review.rating, weight=-1)
+        self.catalog_cache.invalidate(product_tag(review.product_id))
@@ -1,31 +1,50 @@
-from typing import Literal
+import secrets
 
-from src.crud import RefreshTokenCRUD, RecoveryTokenCRUD
+from src.custom_exceptions import InvalidTokenError
+from src.logger import logger
+from src.session_store import SessionStore
+from src.utils import TokenClaims
 
 
-class TokenService:
-    def __init__(self, refresh_token_crud: RefreshTokenCRUD, recovery_token_crud: RecoveryTokenCRUD):
-        self.refresh_token_crud = refresh_token_crud
-        self.recovery_token_crud = recovery_token_crud
-
-    async def upsert_refresh_token(self, user_id: int, token: str):
-        await self.refresh_token_crud.upsert(user_id, token)
-
-    async def upsert_recovery_token(self, user_id: int, token: str):
-        await self.recovery_token_crud.upsert(user_id, token)
-
-    async def revoke_refresh_token(self, user_id: int):
-        await self.refresh_token_crud.delete(user_id)
+def _new_id() -> str:
+    return secrets.token_urlsafe(16)
 
-    async def revoke_recovery_token(self, user_id: int):
-        await self.recovery_token_crud.delete(user_id)
 
-    async def is_recovery_token_valid(self, user_id: int, token: str) -> bool:
-        db_token = await self.recovery_token_crud.get(user_id, on_not_found='return-none')
-
-        return db_token and db_token.token == token
-
-    async def is_refresh_token_valid(self, user_id: int, token: str) -> bool:
-        db_token = await self.refresh_token_crud.get(user_id, on_not_found='return-none')
-
-        return db_token and db_token.token == token
+class TokenService:
+    def __init__(self, session_store: SessionStore):
+        self.session_store = session_store
+
+    # returns the ids of the new session and of its first refresh token
+    async def start_session(self, user_id: int) -> tuple[str, str]:
+        session_id, token_id = _new_id(), _new_id()
+        await self.session_store.start(user_id, session_id, token_id)
+        return session_id, token_id
+
+    # returns the id of the refresh token replacing the presented one, which can no longer be used
+    async def rotate_session(self, claims: TokenClaims) -> str:
+        if claims.session_id is None or claims.token_id is None:
+            raise InvalidTokenError("Invalid refresh token")
+        token_id = _new_id()
+        rotated = await self.session_store.rotate(claims.user_id, claims.session_id, claims.token_id, token_id)
+        if rotated == -1:
+            logger.warning(f"Refresh token of user {claims.user_id} reused, its session was revoked")
+        if rotated != 1:
+            raise InvalidTokenError("Invalid refresh token")
+        return token_id
+
+    async def revoke_session(self, user_id: int, session_id: str | None):
+        if session_id is not None:
+            await self.session_store.revoke(user_id, session_id)
+
+    async def revoke_all_sessions(self, user_id: int):
+        await self.session_store.revoke_all(user_id)
+
+    # returns the id of the recovery token, replacing the pending one of the user
+    async def issue_recovery_token(self, user_id: int) -> str:
+        token_id = _new_id()
+        await self.session_store.set_recovery(user_id, token_id)
+        return token_id
+
+    async def consume_recovery_token(self, claims: TokenClaims) -> bool:
+        return claims.token_id is not None and await self.session_store.consume_recovery(claims.user_id,
+                                                                                         claims.token_id)
@@ -2,15 +2,19 @@ from redis.asyncio import Redis
 
 from src.config import rules
 from src.crud import UserCRUD
-from src.custom_exceptions import InvalidConfirmationCodeError, ResourceAlreadyExistsError, EmailNotConfirmedError
+from src.custom_exceptions import InvalidConfirmationCodeError, ResourceAlreadyExistsError, EmailNotConfirmedError, \
+    InvalidCredentialsError
 from src.db.models import User
+from src.passwords import hash_password, verify_password
+from src.principal_cache import PrincipalCache, Principal
 from src.schemas.user import UserIn, GoogleUserInfo
 
 
 class UserService:
-    def __init__(self, user_crud: UserCRUD, redis: Redis):
+    def __init__(self, user_crud: UserCRUD, redis: Redis, principal_cache: PrincipalCache):
         self.user_crud = user_crud
         self.redis = redis
+        self.principal_cache = principal_cache
 
     async def register_user(self, user: UserIn):
         confirmation_code = await self.redis.get(f"confirmation_code:{user.email}")
@@ -20,7 +24,8 @@ class UserService:
                 raise InvalidConfirmationCodeError("Invalid confirmation code")
         await self.redis.delete(f"confirmation_code:{user.email}")
 
-        return await self.user_crud.create(User(**user.model_dump(exclude={'confirmation_code'})))
+        return await self.user_crud.create(User(**user.model_dump(exclude={'confirmation_code', 'password'}),
+                                                password=await hash_password(user.password)))
 
     async def register_user_using_google(self, user: GoogleUserInfo):
         if (await self.user_crud.get_by_email(user.email)) is not None:
@@ -42,5 +47,28 @@ class UserService:
     async def get_user_by_id(self, user_id: int):
         return await self.user_crud.get(user_id)
 
+    async def get_principal(self, user_id: int) -> Principal:
+        return await self.principal_cache.get(user_id, self.get_user_by_id)
+
+    async def change_password(self, user_id: int, password: str):
+        user = await self.user_crud.get(user_id)
+        user.password = await hash_password(password)
+        self.principal_cache.invalidate(user_id)
+
+    # Returns the user with the given credentials. A password hashed with an outdated cost factor
+    # is hashed again with the current one.
+    async def authenticate(self, email: str, password: str) -> User:
+        user = await self.user_crud.get_by_email(email)
+        if user is not None and user.password is None:
+            raise InvalidCredentialsError("Account is registered with an external provider")
+
+        if user is not None:
+            is_valid, new_hash = await verify_password(password, user.password)
+            if is_valid:
+                if new_hash is not None:
+                    user.password = new_hash
+                return user
+        raise InvalidCredentialsError("No account with the given email exists or the password is wrong")
+
     async def get_user_by_email(self, email: str):
         return await self.user_crud.get_by_email(email)
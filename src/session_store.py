@@ -0,0 +1,108 @@
+import time
+
+from redis.asyncio import Redis
+
+from src.config import settings
+
+# A user's sessions are kept in a single hash, field per session, so a session is started, rotated or
+# revoked with one script and revoking all of them is a single DEL. The hash expires with its latest session;
+# the sessions that expired before it are pruned whenever a session is started.
+
+# KEYS: sessions; ARGV: session id, token id, now, expires at, ttl, max sessions
+_START_SCRIPT = """
+local now = tonumber(ARGV[3])
+local fields = redis.call('HGETALL', KEYS[1])
+local live = {}
+for i = 1, #fields, 2 do
+    local expires_at = tonumber(string.match(fields[i + 1], ':(%d+)$'))
+    if expires_at <= now then
+        redis.call('HDEL', KEYS[1], fields[i])
+    else
+        table.insert(live, {fields[i], expires_at})
+    end
+end
+table.sort(live, function(a, b) return a[2] < b[2] end)
+for i = 1, #live - tonumber(ARGV[6]) + 1 do
+    redis.call('HDEL', KEYS[1], live[i][1])
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2] .. ':' .. ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+"""
+
+# replaces the token of a session, provided the presented one is its current token; a token that has been
+# rotated already is presented only if it leaked, so the session is revoked then
+# KEYS: sessions; ARGV: session id, presented token id, new token id, now, expires at, ttl
+# returns 1 if rotated, 0 if there is no such session, -1 if the presented token was reused
+_ROTATE_SCRIPT = """
+local session = redis.call('HGET', KEYS[1], ARGV[1])
+if not session then
+    return 0
+end
+local token_id, expires_at = string.match(session, '^(.*):(%d+)$')
+if tonumber(expires_at) <= tonumber(ARGV[4]) then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    return 0
+end
+if token_id ~= ARGV[2] then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    return -1
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3] .. ':' .. ARGV[5])
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+return 1
+"""
+
+# KEYS: recovery token; ARGV: token id
+_CONSUME_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+# The refresh sessions of the users (one per signed in device) and their pending password recoveries.
+# The refresh and recovery tokens themselves are JWTs; only their ids are stored.
+class SessionStore:
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self._start_script = redis.register_script(_START_SCRIPT)
+        self._rotate_script = redis.register_script(_ROTATE_SCRIPT)
+        self._consume_script = redis.register_script(_CONSUME_SCRIPT)
+
+    # the oldest sessions are evicted beyond MAX_SESSIONS_PER_USER
+    async def start(self, user_id: int, session_id: str, token_id: str):
+        now, ttl = int(time.time()), _session_ttl()
+        await self._start_script(keys=[_sessions_key(user_id)],
+                                 args=[session_id, token_id, now, now + ttl, ttl, settings.MAX_SESSIONS_PER_USER])
+
+    async def rotate(self, user_id: int, session_id: str, presented_token_id: str, new_token_id: str) -> int:
+        now, ttl = int(time.time()), _session_ttl()
+        return await self._rotate_script(keys=[_sessions_key(user_id)],
+                                         args=[session_id, presented_token_id, new_token_id, now, now + ttl, ttl])
+
+    async def revoke(self, user_id: int, session_id: str):
+        await self.redis.hdel(_sessions_key(user_id), session_id)
+
+    async def revoke_all(self, user_id: int):
+        await self.redis.delete(_sessions_key(user_id))
+
+    # a newer recovery token replaces the pending one
+    async def set_recovery(self, user_id: int, token_id: str):
+        await self.redis.set(_recovery_key(user_id), token_id, ex=settings.RECOVERY_TOKEN_EXPIRATION_MINUTES * 60)
+
+    # a recovery token can be used once
+    async def consume_recovery(self, user_id: int, token_id: str) -> bool:
+        return bool(await self._consume_script(keys=[_recovery_key(user_id)], args=[token_id]))
+
+
+def _session_ttl() -> int:
+    return settings.REFRESH_TOKEN_EXPIRATION_DAYS * 24 * 60 * 60
+
+
+def _sessions_key(user_id: int) -> str:
+    return f"sessions:{user_id}"
+
+
+def _recovery_key(user_id: int) -> str:
+    return f"recovery_token:{user_id}"
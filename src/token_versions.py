@@ -0,0 +1,55 @@
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import settings
+from src.crud.users import UserCRUD
+from src.custom_exceptions import InvalidTokenError
+from src.db.db import after_commit
+from src.utils import TokenClaims
+
+# stores a version unless a higher one is stored already, so a version read before a revocation
+# cannot replace the revoking one
+# KEYS: version; ARGV: version, ttl
+_STORE_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current and tonumber(current) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+
+# Per-user token versions: users.token_version, cached in redis. Every token carries the version
+# of its user at the time it was issued; incrementing it revokes all of them at once.
+class TokenVersions:
+    def __init__(self, redis: Redis, db: AsyncSession, user_crud: UserCRUD):
+        self.redis = redis
+        self.db = db
+        self.user_crud = user_crud
+        self._store_script = redis.register_script(_STORE_SCRIPT)
+
+    async def get(self, user_id: int) -> int:
+        if (version := await self.redis.get(_version_key(user_id))) is not None:
+            return int(version)
+        if (version := await self.user_crud.get_token_version(user_id)) is None:
+            raise InvalidTokenError("The user of the token does not exist", {"WWW-Authenticate": "Bearer"})
+        await self._store(user_id, version)
+        return version
+
+    # raises InvalidTokenError for the tokens issued before a revocation
+    async def check(self, claims: TokenClaims):
+        if claims.token_version < await self.get(claims.user_id):
+            raise InvalidTokenError("The token has been revoked", {"WWW-Authenticate": "Bearer"})
+
+    # revokes every token issued to the user so far, including the admin claims of a demoted admin
+    async def revoke(self, user_id: int):
+        if (version := await self.user_crud.increment_token_version(user_id)) is not None:
+            after_commit(self.db, lambda: self._store(user_id, version))
+
+    async def _store(self, user_id: int, version: int):
+        await self._store_script(keys=[_version_key(user_id)], args=[version, settings.TOKEN_VERSION_CACHE_SECONDS])
+
+
+def _version_key(user_id: int) -> str:
+    return f"token_version:{user_id}"
@@ -1,32 +1,43 @@
 import random
+from dataclasses import dataclass
 from datetime import datetime, timedelta, UTC
 
-from passlib.context import CryptContext
+from fastapi import Response
+from fastapi.responses import StreamingResponse
 from jose import JWTError, ExpiredSignatureError, jwt
 
 from src.config import settings, rules
 from src.custom_exceptions import InvalidTokenError
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-
-def hash_pass(password: str):
-    return pwd_context.hash(password)
-
-
-def verify_password(raw_password: str, hashed_password: str):
-    return pwd_context.verify(raw_password, hashed_password)
-
-
-def create_jwt_token(*, user_id: int, expires_in: timedelta):
+def create_jwt_token(*, user_id: int, expires_in: timedelta, is_admin: bool = False, token_version: int = 0,
+                     session_id: str | None = None, token_id: str | None = None):
     data_to_encode = {
         "sub": str(user_id),
-        "exp": datetime.now(UTC) + expires_in
+        "exp": datetime.now(UTC) + expires_in,
+        "role": "admin" if is_admin else "customer",
+        # tokens issued before the user's tokens were revoked carry a lower version (see TokenVersions)
+        "ver": token_version,
     }
+    # the refresh and recovery tokens are matched against the ones stored in the SessionStore by their ids
+    if session_id is not None:
+        data_to_encode["sid"] = session_id
+    if token_id is not None:
+        data_to_encode["jti"] = token_id
     return jwt.encode(data_to_encode, settings.TOKEN_SECRET_KEY, algorithm=settings.ALGORITHM)
 
 
-def get_user_id_from_jwt(token: str) -> int:
+# what a verified token says about its user, enough to authorize a request without a database lookup
+@dataclass(frozen=True, slots=True)
+class TokenClaims:
+    user_id: int
+    is_admin: bool
+    token_version: int
+    session_id: str | None = None
+    token_id: str | None = None
+
+
+def get_claims_from_jwt(token: str) -> TokenClaims:
     try:
         payload = jwt.decode(token, settings.TOKEN_SECRET_KEY, algorithms=[settings.ALGORITHM])
         user_id: str = payload.get('sub')
@@ -36,9 +47,38 @@ def get_user_id_from_jwt(token: str) -> int:
         raise InvalidTokenError("The token has expired", {"WWW-Authenticate": "Bearer"})
     except JWTError:
         raise InvalidTokenError("Could not validate the token", {"WWW-Authenticate": "Bearer {}"})
-    return int(user_id)
+    return TokenClaims(user_id=int(user_id),
+                       is_admin=payload.get('role') == 'admin',
+                       token_version=int(payload.get('ver', 0)),
+                       session_id=payload.get('sid'),
+                       token_id=payload.get('jti'))
+
+
+def get_user_id_from_jwt(token: str) -> int:
+    return get_claims_from_jwt(token).user_id
 
 
 def generate_confirmation_code():
     return random.randint(rules.CONFIRMATION_CODE_LOWER_BOUND,
                           rules.CONFIRMATION_CODE_UPPER_BOUND)
+
+
+def set_next_cursor_header(response: Response, page):
+    if next_cursor := getattr(page, 'next_cursor', None):
+        response.headers['X-Next-Cursor'] = next_cursor
+
+
+# the ETag of an entity with a version_id_col, If-Match takes it back (see IfMatchDep)
+def version_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+EXPORT_MEDIA_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def export_response(chunks, name: str, fmt: str) -> StreamingResponse:
+    return StreamingResponse(chunks, media_type=EXPORT_MEDIA_TYPES[fmt],
+                             headers={'Content-Disposition': f'attachment; filename="{name}.{fmt}"'})
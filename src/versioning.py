@@ -0,0 +1,61 @@
+import time
+
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.db.db import after_commit
+
+CATALOG_VERSION_KEY = 'catalog:version'
+
+# A missing counter (e.g. after a redis restart) starts from the current time instead of 0,
+# so a version number is never handed out twice for different content.
+BUMP_VERSION_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return redis.call('INCR', KEYS[1])
+"""
+
+
+def cart_version_key(user_id: int) -> str:
+    return f"cart:version:{user_id}"
+
+
+def orders_version_key(user_id: int) -> str:
+    return f"orders:version:{user_id}"
+
+
+def initial_version() -> int:
+    return time.time_ns() // 1_000_000
+
+
+# Version counters behind the ETags of frequently polled resources.
+# Bumps are applied after the request transaction commits, and readers fetch the version before the data,
+# so an ETag can only ever be older than the content it is sent with.
+class ResourceVersions:
+    def __init__(self, redis: Redis, db: AsyncSession):
+        self.redis = redis
+        self.db = db
+        self._bump_script = redis.register_script(BUMP_VERSION_SCRIPT)
+        self._pending: set[str] = set()
+
+    async def get(self, *keys: str) -> list[int]:
+        versions = await self.redis.mget(keys)
+        if all(v is not None for v in versions):
+            return [int(v) for v in versions]
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.set(key, initial_version(), nx=True)
+            await pipe.execute()
+        return [int(v) for v in await self.redis.mget(keys)]
+
+    def bump(self, *keys: str):
+        if not self._pending:
+            after_commit(self.db, self.apply_bumps)
+        self._pending.update(keys)
+
+    async def apply_bumps(self):
+        keys, self._pending = self._pending, set()
+        for key in keys:
+            await self._bump_script(keys=[key], args=[initial_version()])